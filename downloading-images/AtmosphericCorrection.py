@@ -1,38 +1,26 @@
 # Standard library imports
 import os
 import numpy as np
-from math import cos
+from math import cos, radians
 
 # Third-party library imports
 import rasterio
-import unpackqa
 import rioxarray as rxr
 import xarray as xr
 
 # External library imports
 
 # Project-specific library imports
-from osgeo import gdal
+from kernels import get_backend
+from metadata import load_metadata
+from profiles import open_product
 
 
 def radiometric_rescaling_coefficients(path_landsat8_metadata, band):
-    with open(path_landsat8_metadata, 'r') as open_metaLandsat:
-        content = open_metaLandsat.readlines()
-        open_metaLandsat.close()
-        rescaling_coefficients = []
-        for line in content:
-            if 'RADIANCE_MULT_BAND_' + str(band) in line:
-                print(line)
-                multiplicative_rescaling = line.split()
-                multiplicative_rescaling = float(multiplicative_rescaling[-1])
-                rescaling_coefficients.append(multiplicative_rescaling)  # getting the G value
-            elif 'RADIANCE_ADD_BAND_' + str(band) in line:
-                print(line)
-                additive_rescaling = line.split()
-                additive_rescaling = float(additive_rescaling[-1])
-                rescaling_coefficients.append(additive_rescaling)  # Getting the B value
-        print('get data')
-        return rescaling_coefficients
+    """
+    extract the radiance rescaling coefficients [ML, AL] of a band from Landsat metadata.
+    """
+    return list(load_metadata(path_landsat8_metadata).radiance_coefficients(band))
 
 
 def reflectance_rescaling_coefficients(protected_area_date, path_landsat8_metadata, band):
@@ -40,49 +28,60 @@ def reflectance_rescaling_coefficients(protected_area_date, path_landsat8_metada
     extract the reflectance rescaling coefficients from Landsat metadata. These coefficients are used to convert the
     raw digital numbers (DN) to at-sensor reflectance values.
     """
-    with open(path_landsat8_metadata, 'r') as open_metaLandsat:
-        content = open_metaLandsat.readlines()
-        open_metaLandsat.close()
-        rescaling_coefficients = []
-        for line in content:
-            if 'REFLECTANCE_MULT_BAND_' + str(band) in line:
-                print(line)
-                multiplicative_rescaling = line.split()
-                multiplicative_rescaling = float(multiplicative_rescaling[-1])
-                rescaling_coefficients.append(multiplicative_rescaling)  # getting the G value
-            elif 'REFLECTANCE_ADD_BAND_' + str(band) in line:
-                print(line)
-                additive_rescaling = line.split()
-                additive_rescaling = float(additive_rescaling[-1])
-                rescaling_coefficients.append(additive_rescaling)  # Getting the B value
-
-        filename = os.path.basename(protected_area_date)
-        split_folder = filename.split('-')
-
-        if 'LC08' in split_folder[-1]:
-            rescaling_coefficients = rescaling_coefficients[:-2]
-            return rescaling_coefficients
-
-        rescaling_coefficients = rescaling_coefficients[2:]
-        return rescaling_coefficients
+    filename = os.path.basename(protected_area_date)
+    split_folder = filename.split('-')
+
+    # LC08 scenes use the surface reflectance scaling, the other sensors the TOA rescaling
+    level = 'surface' if 'LC08' in split_folder[-1] else 'toa'
+    return list(load_metadata(path_landsat8_metadata).reflectance_coefficients(band, level))
 
 
 def sun_elevation(path_landsat8_metadata):
-    with open(path_landsat8_metadata, 'r') as open_metaLandsat:
-        content = open_metaLandsat.readlines()
-        open_metaLandsat.close()
-        _sun_elevation_ = None
-        for line in content:
-            if 'SUN_ELEVATION' in line:
-                print(line)
-                _sun_elevation = line.split()
-                _sun_elevation = float(_sun_elevation[-1])
-                _sun_elevation_ = _sun_elevation  # getting sun elevation
-        print('get data')
-        return _sun_elevation_
-
-
-def dn_to_radiance(band, arr, ML, AL):
+    return load_metadata(path_landsat8_metadata).sun_elevation
+
+
+def nodata_mask(arr, nodata=None):
+    """
+    Returns a boolean mask that is True where the pixel carries no data: NaN pixels and, when given, pixels equal to
+    the band nodata value (Landsat Collection 2 uses 0 as fill DN).
+    """
+    if np.issubdtype(arr.dtype, np.floating):
+        invalid = np.isnan(arr)
+    else:
+        invalid = np.zeros(arr.shape, dtype=bool)
+
+    if nodata is not None and not np.isnan(nodata):
+        invalid |= arr == nodata
+
+    return invalid
+
+
+def rescale(arr, gain, offset, nodata=None, dtype='float32', out=None, divisor=1):
+    """
+    Applies `(gain * arr + offset) / divisor` to the whole array at once and sets the nodata pixels to NaN.
+
+    Args:
+        arr (ndarray): Input band values (DN).
+        gain (float): Multiplicative rescaling factor.
+        offset (float): Additive rescaling factor.
+        nodata (float): Band nodata value; NaN pixels are always treated as nodata.
+        dtype (str): Floating output dtype, ignored when `out` is given.
+        out (ndarray): Optional floating array to write the result into. It may be `arr` itself.
+        divisor (float): Value the rescaled band is divided by.
+
+    Returns:
+        ndarray: The rescaled band.
+    """
+    # The mask has to be taken before `out` is written, because `out` may be `arr`
+    invalid = nodata_mask(arr, nodata)
+
+    if out is None:
+        out = np.empty(arr.shape, dtype=dtype)
+
+    return get_backend().rescale(arr, gain, offset, divisor, invalid, out)
+
+
+def dn_to_radiance(band, arr, ML, AL, nodata=None, dtype='float32', out=None):
     """
     # DN to Radiance: Gain And Bias method:
 
@@ -94,19 +93,15 @@ def dn_to_radiance(band, arr, ML, AL):
         ML: Band-specific multiplicative rescaling factor from the metadata (RADIANCE_MULT_BAND_x, where x is the band number)
         Qcal: Quantized and calibrated standard product pixel values (DN)
         AL: Band-specific additive rescaling factor from the metadata (RADIANCE_ADD_BAND_x, where x is the band number)
-        """
-    new_data_array = np.empty_like(arr)
-    for i, row in enumerate(arr):
-        for j, col in enumerate(row):
-
-            # checking if the pixel value is not nan, to avoid background correction
-            if arr[i][j] != np.nan:
-                new_data_array[i][j] = ML * arr[i][j] + AL
+
+    Nodata pixels (NaN or `nodata`) are left as NaN, to avoid background correction.
+    """
+    new_data_array = rescale(arr, ML, AL, nodata=nodata, dtype=dtype, out=out)
     print(f'Radiance calculated for band {band}')
     return new_data_array
 
 
-def radiance_to_reflectance(band, arr, Mp, Ap, SUME):
+def radiance_to_reflectance(band, arr, Mp, Ap, SUME, nodata=None, dtype='float32', out=None, verbose=True):
     """
     ρλ′= Mρ*Qcal+Aρ
 
@@ -116,16 +111,7 @@ def radiance_to_reflectance(band, arr, Mp, Ap, SUME):
     Qcal: Quantized and calibrated standard product pixel values (DN)
     Mρ: Band-specific multiplicative rescaling factor from the metadata (REFLECTANCE_MULT_BAND_x, where x is the band number)
     Aρ: Band-specific additive rescaling factor from the metadata (REFLECTANCE_ADD_BAND_x, where x is the band number)
-    """
-    new_data_array = np.empty_like(arr)
-    for i, row in enumerate(arr):
-        for j, col in enumerate(row):
-
-            # checking if the pixel value is not nan, to avoid background correction
-            if arr[i][j] != np.nan:
-                new_data_array[i][j] = Mp * arr[i][j] + Ap
 
-    """
     TOA reflectance with a correction for the sun angle is then:
 
     ρλ= ρλ′/cos(θSZ) = ρλ′/sin(θSE)
@@ -135,37 +121,58 @@ def radiance_to_reflectance(band, arr, Mp, Ap, SUME):
     ρλ:  TOA planetary reflectance
     θSE: Local sun elevation angle. The scene center sun elevation angle in degrees is provided in the metadata (SUN_ELEVATION).
     θSZ: Local solar zenith angle;  θSZ = 90° - θSE
+
+    Nodata pixels (NaN or `nodata`) are left as NaN, to avoid background correction. `verbose` False skips the
+    message, for bands corrected block by block.
     """
     θSZ = 90 - SUME
-    new_data_array = new_data_array / cos(θSZ)
+    new_data_array = rescale(arr, Mp, Ap, nodata=nodata, dtype=dtype, out=out, divisor=cos(radians(θSZ)))
+    if verbose:
+        print(f'Reflectance calculated for band {band}')
     return new_data_array
 
 
-def apply_cloud_mask(qa_path, product='LANDSAT_8_C2_L2_QAPixel', flags=['Cloud', 'Cloud Shadow']):
-    # Apply a cloud mask to an image using Landsat Quality Assessment (QA) data
+# Bits of the Landsat Collection 2 QA_PIXEL band
+QA_PIXEL_BITS = {
+    'Fill': 0,
+    'Dilated Cloud': 1,
+    'Cirrus': 2,
+    'Cloud': 3,
+    'Cloud Shadow': 4,
+    'Snow': 5,
+    'Clear': 6,
+    'Water': 7,
+}
+
+
+def qa_pixel_mask(qa_data, flags=('Fill', 'Dilated Cloud', 'Cloud', 'Cloud Shadow')):
+    """
+    Decodes a QA_PIXEL array into one boolean mask that is True where any of the flags is set.
+    """
+    bits = 0
+    for flag in flags:
+        bits |= 1 << QA_PIXEL_BITS[flag]
+    return (qa_data & bits) != 0
+
+
+def apply_cloud_mask(qa_path, flags=('Fill', 'Dilated Cloud', 'Cloud', 'Cloud Shadow')):
+    # Cloud mask of an image using Landsat Quality Assessment (QA) data
     with rasterio.open(qa_path) as src:
         qa_data = src.read(1)
 
-    cloud_mask = unpackqa.unpack_to_dict(qa_data, product=product, flags=flags)
+    cloud_mask = qa_pixel_mask(qa_data, flags)
 
     return cloud_mask
 
 
 def create_multiband_color_tiff(tif_list, output_path):
     # Load the first TIFF file to get the dimensions and metadata
-    first_tif = gdal.Open(tif_list[0])
-    data_type = first_tif.GetRasterBand(1).DataType
-    driver = gdal.GetDriverByName('GTiff')
+    with rasterio.open(tif_list[0]) as first_tif:
+        out_meta = first_tif.meta.copy()
+    out_meta.update(driver='GTiff', count=len(tif_list))
     # Create the output TIFF file
-    out_tif = driver.Create(output_path, first_tif.RasterXSize, first_tif.RasterYSize, len(tif_list), data_type)
-    out_tif.SetGeoTransform(first_tif.GetGeoTransform())
-    out_tif.SetProjection(first_tif.GetProjection())
-    # Loop through the input TIFF files and write each band to the output TIFF
-    for i, tif_file in enumerate(tif_list):
-        tif = gdal.Open(tif_file)
-        band_data = tif.GetRasterBand(1).ReadAsArray()
-        band = out_tif.GetRasterBand(i+1)
-        band.WriteArray(band_data)
-        tif = None
-        band.FlushCache()
-    out_tif = None
+    with open_product(output_path, out_meta, 'composite') as out_tif:
+        # Loop through the input TIFF files and write each band to the output TIFF
+        for i, tif_file in enumerate(tif_list):
+            with rasterio.open(tif_file) as tif:
+                out_tif.write(tif.read(1), i + 1)
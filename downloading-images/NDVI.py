@@ -4,111 +4,337 @@ import os
 # Third-party library imports
 import numpy as np
 import rasterio
-from rasterio.mask import mask
+from rasterio.features import geometry_mask
 
 # External library imports
 import gdal
 
 # Project-specific library imports
 from AtmosphericCorrection import *
+from geometry import BLOCK_EDGE, BLOCK_INSIDE, BLOCK_OUTSIDE, crop_array, dataset_blocks, read_cropped
+from kernels import get_backend
+from profiles import open_product, write_product
+import settings
 
+# NDVI stored with the int16 policy: round(NDVI * NDVI_INT16_SCALE), NDVI_INT16_NODATA where there is no data
+NDVI_STORAGE_POLICIES = ('float32', 'int16')
+NDVI_INT16_SCALE = 10000
+NDVI_INT16_NODATA = -32768
 
+# Lowest NDVI counted as forest cover in the composites, see compositing.py. The int16 policy keeps every value on the
+# same side of it as the float32 policy, see encode_ndvi
+FOREST_COVER_THRESHOLD = 0.6
 
-def ndvi(band4_path, band5_path, shapes, output_path):
-    with rasterio.open(band4_path) as band4:
-        with rasterio.open(band5_path) as band5:
+
+def ndvi_storage_profile(policy=None):
+    """
+    Returns the profile entries (dtype, nodata, scales, offsets) of the NDVI products stored with `policy`, by default
+    the NDVI_STORAGE setting:
+
+        float32: float32 NDVI, NaN where there is no data.
+        int16: NDVI scaled by NDVI_INT16_SCALE and rounded, NDVI_INT16_NODATA where there is no data. The band scale
+            is stored in the file, so GDAL based readers decode it to NDVI. The decoded values are classified as forest
+            cover as the float32 values are, see encode_ndvi.
+    """
+    if policy is None:
+        policy = settings.NDVI_STORAGE
+
+    if policy == 'float32':
+        return {'dtype': 'float32', 'nodata': np.nan}
+    if policy == 'int16':
+        return {'dtype': 'int16', 'nodata': NDVI_INT16_NODATA, 'scales': [1 / NDVI_INT16_SCALE], 'offsets': [0.0]}
+    raise ValueError(f'Unknown NDVI storage {policy!r}, choose one of {NDVI_STORAGE_POLICIES}')
+
+
+def encode_ndvi(ndvi_data, dtype):
+    """
+    Converts a float NDVI array, NaN where there is no data, to the stored `dtype`.
+
+    The int16 values are rounded, except the values that would cross FOREST_COVER_THRESHOLD once decoded: they are
+    moved one step back to their side of it, so the forest cover of the decoded NDVI is the forest cover of the float32
+    NDVI, pixel for pixel.
+    """
+    if np.dtype(dtype).kind == 'f':
+        return ndvi_data.astype(dtype, copy=False)
+
+    encoded = np.full(ndvi_data.shape, NDVI_INT16_NODATA, dtype=dtype)
+    valid = ~np.isnan(ndvi_data)
+    values = ndvi_data[valid].astype('float32', copy=False)
+    scaled = np.rint(values * NDVI_INT16_SCALE).astype(dtype)
+
+    # The forest cover is classified on the float32 values, as the float32 policy stores them
+    forest = values > FOREST_COVER_THRESHOLD
+    decoded_forest = decode_ndvi(scaled, None, 1 / NDVI_INT16_SCALE) > FOREST_COVER_THRESHOLD
+    scaled[forest & ~decoded_forest] += 1
+    scaled[~forest & decoded_forest] -= 1
+
+    encoded[valid] = scaled
+    return encoded
+
+
+def decode_ndvi(data, nodata, scale=1.0, offset=0.0):
+    """
+    Converts a stored NDVI array back to float32 NDVI with NaN where there is no data. Float arrays are returned as
+    they are.
+    """
+    if data.dtype.kind == 'f':
+        return data
+
+    decoded = data.astype('float32') * np.float32(scale) + np.float32(offset)
+    if nodata is not None:
+        decoded[data == nodata] = np.nan
+    return decoded
+
+
+def read_ndvi(src, window=None):
+    """
+    Reads the first band of an open NDVI product as float32 NDVI, whatever its storage policy.
+    """
+    return decode_ndvi(src.read(1, window=window), src.nodata, src.scales[0], src.offsets[0])
+
+
+def write_ndvi(output_path, ndvi_data, profile, product='ndvi', policy=None):
+    """
+    Writes a float NDVI array as an NDVI product stored with `policy`, see ndvi_storage_profile. The statistics (forest
+    area...) are computed on the float array before it is encoded.
+    """
+    storage = ndvi_storage_profile(policy)
+    profile = dict(profile, **storage)
+    write_product(output_path, encode_ndvi(ndvi_data, storage['dtype']), profile, product)
+
+
+def calculate_ndvi(red, nir, dtype='float32', out=None):
+    """
+    Calculates NDVI = (nir - red) / (nir + red) for whole arrays. Pixels where nir + red is 0 or any input is NaN are
+    NaN.
+    """
+    if out is None:
+        out = np.empty(red.shape, dtype=dtype)
+
+    return get_backend().ndvi(red, nir, out)
+
+
+def apply_forest_threshold(ndvi_data, threshold):
+    """
+    Sets the NDVI values lower than the threshold, and the 0 values, to NaN in place.
+    """
+    return get_backend().forest_threshold(ndvi_data, threshold)
+
+
+def stream_ndvi(band4_path, band5_path, shapes, threshold, ndvi_path, forest_path, cloud_mask=None):
+    """
+    Calculates the NDVI and the forest NDVI block by block, so the peak memory depends on the raster block size and not
+    on the scene size. Both outputs keep the extent of the input bands, which are already cropped to the protected
+    area, and pixels outside the shapes are set to NaN. The blocks entirely outside the shapes are written as nodata
+    without being read, so the work follows the area of the shapes rather than their bounding box.
+
+    Args:
+        band4_path (str): Filepath of the red band.
+        band5_path (str): Filepath of the near-infrared band.
+        shapes (list): Geometries of the protected area, or None to keep every pixel.
+        threshold (float): Lowest NDVI value considered forest.
+        ndvi_path (str): Filepath of the output NDVI raster.
+        forest_path (str): Filepath of the output forest NDVI raster.
+        cloud_mask (ndarray): Boolean mask on the grid of the bands, True where the pixel is cloud, shadow or fill.
+
+    Returns:
+        tuple: The forest NDVI filepath and the total forest area in hectares.
+    """
+    num_pixels = 0
+    block_counts = {BLOCK_INSIDE: 0, BLOCK_EDGE: 0, BLOCK_OUTSIDE: 0}
+    with rasterio.open(band4_path) as band4, rasterio.open(band5_path) as band5:
+        profile = band4.profile.copy()
+        profile.update(driver='GTiff', count=1, **ndvi_storage_profile())
+        pixel_size = band4.res[0] * band4.res[1]  # assuming square pixels
+        nodata_blocks = {}
+
+        # The outputs are written window by window, their temporary files stay on disk
+        with open_product(ndvi_path, profile, 'ndvi', in_memory=False) as ndvi_dst, \
+                open_product(forest_path, profile, 'forest', in_memory=False) as forest_dst:
+            # The blocks of the outputs are classified against the shapes: the blocks outside them are neither read
+            # nor computed, and only the blocks on their edge are masked pixel by pixel
+            for window, block_class in dataset_blocks(ndvi_dst, shapes):
+                block_counts[block_class] += 1
+
+                if block_class == BLOCK_OUTSIDE:
+                    block_shape = (int(window.height), int(window.width))
+                    if block_shape not in nodata_blocks:
+                        nodata_blocks[block_shape] = np.full(block_shape, profile['nodata'], dtype=profile['dtype'])
+                    ndvi_dst.write(nodata_blocks[block_shape], 1, window=window)
+                    forest_dst.write(nodata_blocks[block_shape], 1, window=window)
+                    continue
+
+                red = band4.read(1, window=window)
+                nir = band5.read(1, window=window)
+                ndvi_data = calculate_ndvi(red, nir)
+
+                if block_class == BLOCK_EDGE:
+                    outside = geometry_mask(shapes, out_shape=ndvi_data.shape,
+                                            transform=band4.window_transform(window))
+                    ndvi_data[outside] = np.nan
+
+                if cloud_mask is not None:
+                    ndvi_data[cloud_mask[window.toslices()]] = np.nan
+
+                ndvi_dst.write(encode_ndvi(ndvi_data, profile['dtype']), 1, window=window)
+
+                # The forest NDVI reuses the window buffer
+                apply_forest_threshold(ndvi_data, threshold)
+                forest_dst.write(encode_ndvi(ndvi_data, profile['dtype']), 1, window=window)
+                num_pixels += np.count_nonzero(ndvi_data > 0)
+
+    print(f'NDVI blocks: {block_counts[BLOCK_INSIDE]} inside, {block_counts[BLOCK_EDGE]} on the edge, '
+          f'{block_counts[BLOCK_OUTSIDE]} outside skipped')
+
+    # Calculate the total area of the forest pixels in hectares
+    total_area = num_pixels * pixel_size / 10000
+    print(f"Total area of NDVI: {total_area} hectares")
+
+    return forest_path, total_area
+
+
+class NDVIProduct:
+    """
+    NDVI of a scene, calculated once. The raw NDVI, the forest NDVI, their clipped versions and the forest area all
+    derive from the same in-memory array.
+
+    Attributes:
+        data (ndarray): float32 NDVI, NaN where there is no data.
+        transform (Affine): Transform of the NDVI.
+        crs (CRS): Coordinate reference system of the NDVI.
+    """
+
+    def __init__(self, data, transform, crs):
+        self.data = data
+        self.transform = transform
+        self.crs = crs
+
+    @classmethod
+    def from_bands(cls, band4_path, band5_path):
+        """
+        Reads the red and near-infrared bands once and calculates their NDVI.
+        """
+        with rasterio.open(band4_path) as band4, rasterio.open(band5_path) as band5:
             red = band4.read(1)
             nir = band5.read(1)
+            transform, crs = band4.transform, band4.crs
+
+        return cls(calculate_ndvi(red, nir), transform, crs)
+
+    def mask(self, mask):
+        """
+        Sets the NDVI to NaN where `mask` is True, e.g. the cloud mask of the scene, which has to be on the same grid.
+        """
+        if mask.shape != self.data.shape:
+            raise ValueError(f'Mask shape {mask.shape} does not match NDVI shape {self.data.shape}')
+        self.data[mask] = np.nan
+
+    @property
+    def pixel_size(self):
+        return abs(self.transform.a * self.transform.e)  # assuming square pixels
+
+    def forest(self, threshold):
+        """
+        Returns a copy of the NDVI with the values lower than the threshold, and the 0 values, set to NaN.
+        """
+        return apply_forest_threshold(self.data.copy(), threshold)
+
+    def clip(self, shapes, data=None):
+        """
+        Crops the NDVI, or another array on the same grid, to the shapes. Pixels outside them are NaN.
+
+        Returns:
+            tuple: The clipped array and its transform.
+        """
+        return crop_array(self.data if data is None else data, self.transform, shapes, crs=self.crs)
+
+    def forest_area(self, forest_data):
+        """
+        Returns the area in hectares of the pixels greater than 0 of a forest NDVI array.
+        """
+        return np.count_nonzero(forest_data > 0) * self.pixel_size / 10000
+
+    def write(self, output_path, data=None, transform=None, product='ndvi'):
+        """
+        Writes the NDVI, or another array derived from it, with the output profile of `product` and the NDVI storage
+        policy.
+        """
+        data = self.data if data is None else data
+        profile = {
+            'transform': self.transform if transform is None else transform,
+            'crs': self.crs,
+        }
+        write_ndvi(output_path, data, profile, product)
+
+
+def ndvi_products(band4_path, band5_path, shapes, threshold, ndvi_folder, cloud_mask=None):
+    """
+    Calculates the NDVI once and writes every NDVI product of a date from it:
+
+        NDVI.TIF: raw NDVI
+        NDVI_mask_clipped.TIF: NDVI clipped to the shapes
+        forest_NDVI_mask_clipped.TIF: forest NDVI clipped to the shapes
 
-            # Calculate NDVI
-            ndvi_data = (nir - red) / (nir + red)
-
-            with rasterio.open(
-                    output_path,
-                    'w',
-                    driver='Gtiff',
-                    width=ndvi_data.shape[1],
-                    height=ndvi_data.shape[0],
-                    count=1,
-                    dtype='float64',
-                    transform=band4.transform,
-                    crs='EPSG:32618'
-            ) as dst:
-                dst.write(ndvi_data, 1)
+    Pixels flagged by `cloud_mask`, a boolean array on the grid of the bands, are NaN in every product.
+
+    Returns:
+        tuple: The clipped forest NDVI filepath and the total forest area in hectares.
+    """
+    product = NDVIProduct.from_bands(band4_path, band5_path)
+    if cloud_mask is not None:
+        product.mask(cloud_mask)
+
+    product.write(os.path.join(ndvi_folder, 'NDVI.TIF'))
+    print('NDVI file created successfully')
+
+    clipped, clipped_transform = product.clip(shapes)
+    product.write(os.path.join(ndvi_folder, 'NDVI_mask_clipped.TIF'), clipped, clipped_transform)
+    print('NDVI mask clipped to provided shapes')
+
+    # The forest NDVI reuses the clipped NDVI buffer
+    forest_data = apply_forest_threshold(clipped, threshold)
+    clipped_file = os.path.join(ndvi_folder, 'forest_NDVI_mask_clipped.TIF')
+    product.write(clipped_file, forest_data, clipped_transform, 'forest')
+    print('Forest NDVI mask clipped to provided shapes')
+
+    total_area = product.forest_area(forest_data)
+    print(f"Total area of NDVI: {total_area} hectares")
+
+    return clipped_file, total_area
+
+
+def ndvi(band4_path, band5_path, shapes, output_path):
+    product = NDVIProduct.from_bands(band4_path, band5_path)
+    product.write(output_path)
 
     print('NDVI file created successfully')
 
     # Clip NDVI to the provided shapes
     clipped_file = os.path.join(os.path.dirname(output_path), 'NDVI_mask_clipped.TIF')
-    with rasterio.open(output_path) as src:
-        out_image, out_transform = mask(src, shapes, crop=True)
-        out_meta = src.meta.copy()
-        out_meta.update({
-            "driver": "GTiff",
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform
-        })
-        with rasterio.open(clipped_file, "w", **out_meta) as dest:
-            dest.write(out_image)
+    clipped, clipped_transform = product.clip(shapes)
+    product.write(clipped_file, clipped, clipped_transform)
 
     print('NDVI mask clipped to provided shapes')
 
 
 def forest_ndvi(band4_path, band5_path, shapes, threshold, output_path):
-    with rasterio.open(band4_path) as band4:
-        with rasterio.open(band5_path) as band5:
-            red = band4.read(1)
-            nir = band5.read(1)
+    product = NDVIProduct.from_bands(band4_path, band5_path)
 
-            # Calculate NDVI
-            ndvi_data = (nir - red) / (nir + red)
-
-            # Set values less than threshold to np.nan and same 0
-            ndvi_data[ndvi_data < threshold] = np.nan
-            ndvi_data[ndvi_data == 0] = np.nan
-
-            with rasterio.open(
-                    output_path,
-                    'w',
-                    driver='Gtiff',
-                    width=ndvi_data.shape[1],
-                    height=ndvi_data.shape[0],
-                    count=1,
-                    dtype='float64',
-                    transform=band4.transform,
-                    crs='EPSG:32618'
-            ) as dst:
-                dst.write(ndvi_data, 1)
+    # Set values less than threshold to np.nan and same 0
+    forest_data = product.forest(threshold)
+    product.write(output_path, forest_data, product='forest')
 
     print('NDVI file created successfully')
 
     # Clip forest NDVI to the provided shapes
     clipped_file = os.path.join(os.path.dirname(output_path), 'forest_NDVI_mask_clipped.TIF')
-    with rasterio.open(output_path) as src:
-        out_image, out_transform = mask(src, shapes, crop=True)
-        out_meta = src.meta.copy()
-        out_meta.update({
-            "driver": "GTiff",
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform
-        })
-        with rasterio.open(clipped_file, "w", **out_meta) as dest:
-            dest.write(out_image)
+    clipped, clipped_transform = product.clip(shapes, forest_data)
+    product.write(clipped_file, clipped, clipped_transform, 'forest')
 
     print('Forest NDVI mask clipped to provided shapes')
 
-    with rasterio.open(clipped_file) as src:
-        band_forest = src.read(1)
-        pixel_size = src.res[0] * src.res[1]  # assuming square pixels
-        # Create a mask of the pixels greater than 0
-        new_mask = band_forest > 0
-        # Count the number of pixels greater than 0
-        num_pixels = np.count_nonzero(new_mask)
-        # Calculate the total area of the pixels greater than 0 in hectares
-        total_area = num_pixels * pixel_size / 10000
-        print(f"Total area of NDVI: {total_area} hectares")
+    total_area = product.forest_area(clipped)
+    print(f"Total area of NDVI: {total_area} hectares")
 
     return clipped_file, total_area
 
@@ -142,7 +368,7 @@ def forest_not_forest(ndvi_file, shapes, threshold, output_path):
     # Clip forest/not-forest classification to the provided shapes
     clipped_file = os.path.join(os.path.dirname(output_path), 'forest_mask_clipped.tif')
     with rasterio.open(output_path) as src:
-        out_image, out_transform = mask(src, shapes, crop=True)
+        out_image, out_transform = read_cropped(src, shapes)
         out_meta = src.meta.copy()
         out_meta.update({"driver": "GTiff",
                          "height": out_image.shape[1],
@@ -194,7 +420,7 @@ def replace_nan_value_rgb(ndvi_path, band_list_path):
 def replace_nan_value_multiband(ndvi_path, multi_band_tif_path):
     with rasterio.open(ndvi_path) as src1, rasterio.open(multi_band_tif_path) as src2:
         # Read the NDVI array for the first band
-        ndvi_value = src1.read(1)
+        ndvi_value = read_ndvi(src1)
 
         # Read the 4-band array for the second file
         tif_value = src2.read()
@@ -210,20 +436,17 @@ def replace_nan_value_multiband(ndvi_path, multi_band_tif_path):
 
         # Create a new raster file with the same shape and metadata as the second input band
         output_path = os.path.splitext(multi_band_tif_path)[0] + '_NDVI_masked.TIF'
-        with rasterio.open(output_path, 'w', **metadata) as dst:
-            dst.write(tif_value)
+        write_product(output_path, tif_value, metadata, 'composite')
 
     return output_path
 
 
 def replace_nan_values(forest_cover, before_band_path, current_band_path, output_path, index):
-    # Split the file path into components using the forward slash as the separator
-    before_band_path_components = before_band_path.split("/")
-    current_band_path_components = current_band_path.split("/")
-
-    # Get the date component from the path (assumes the date component is the third-last element in the path)
-    date_before_band_path_components = before_band_path_components[6]
-    date_current_band_path_components = current_band_path_components[5]
+    # The previous composite is named after its dates, '<date>__.TIF' or '<date>__<date>.TIF', and the current
+    # forest NDVI is in '<date>/<ndvi folder>/', whatever the depth of the protected area folder
+    date_before_band_path_components = os.path.basename(before_band_path)
+    date_current_band_path_components = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(
+        current_band_path))))
     forest_cover.detection_date_list.append(date_current_band_path_components)
 
     if index == 1:
@@ -240,8 +463,8 @@ def replace_nan_values(forest_cover, before_band_path, current_band_path, output
     # Open both input bands using rasterio
     with rasterio.open(before_band_path) as src1, rasterio.open(current_band_path) as src2:
         # Read the NDVI arrays for both bands
-        ndvi_values1 = src1.read(1)
-        ndvi_values2 = src2.read(1)
+        ndvi_values1 = read_ndvi(src1)
+        ndvi_values2 = read_ndvi(src2)
 
         # Create a new raster file with the same shape and metadata as the second input band
         metadata = src2.meta.copy()
@@ -249,18 +472,17 @@ def replace_nan_values(forest_cover, before_band_path, current_band_path, output
 
         # Replace NaN values in the second image's NDVI array with corresponding values in the first image
         # if the values of the first image are not NaN
-        ndvi_values2 = np.where(np.isnan(ndvi_values2) & (~np.isnan(ndvi_values1)), ndvi_values1, ndvi_values2)
+        ndvi_values2 = get_backend().fill_nan(ndvi_values2, ndvi_values1, ndvi_values2)
 
         # Create a new raster file with the same shape and metadata as the second input band
         metadata = src2.meta.copy()
-        with rasterio.open(new_output_path, 'w', **metadata) as dst:
-            dst.write(ndvi_values2, 1)
+        write_ndvi(new_output_path, ndvi_values2, metadata, 'forest')
 
-            # Calculate the area of pixels greater than 0 in hectares
-            pixel_size = metadata['transform'][0]
-            area = (ndvi_values2 > 0.6).sum() * (pixel_size ** 2) / 10000
-            print(f'Total area of NDVI: {area:.2f} hectares')
-            forest_cover.total_extension_forest_cover_list.append(area)
+        # Calculate the area of pixels greater than 0 in hectares
+        pixel_size = metadata['transform'][0]
+        area = (ndvi_values2 > 0.6).sum() * (pixel_size ** 2) / 10000
+        print(f'Total area of NDVI: {area:.2f} hectares')
+        forest_cover.total_extension_forest_cover_list.append(area)
 
         return new_output_path
 
@@ -270,7 +492,7 @@ def replace_nan_add_ndvi(before_multi_band_path, current_multi_band_path, ndvi_p
         # Read the arrays for all bands
         values1 = src1.read()
         values2 = src2.read()
-        ndvi_values = src3.read(1)
+        ndvi_values = read_ndvi(src3)
 
         # Create a new raster file with the same shape and metadata as the second input band
         metadata = src2.meta.copy()
@@ -281,15 +503,14 @@ def replace_nan_add_ndvi(before_multi_band_path, current_multi_band_path, ndvi_p
         for i in range(len(values1)):
             if index >= 2 and i == 4:
                 continue
-            values2[i] = np.where(np.isnan(values2[i]) & (~np.isnan(values1[i])), values1[i], values2[i])
+            get_backend().fill_nan(values2[i], values1[i], values2[i])
 
         # Add the NDVI values to the fifth band of the new raster
         values2 = np.concatenate((values2, np.expand_dims(ndvi_values, axis=0)), axis=0)
 
         # Write the new 5-band raster to disk
         output_path = os.path.splitext(current_multi_band_path)[0] + '_added.TIF'
-        with rasterio.open(output_path, 'w', **metadata) as dst:
-            dst.write(values2)
+        write_product(output_path, values2.astype(metadata['dtype'], copy=False), metadata, 'composite')
 
 def add_ndvi_in_multi_band(multi_band_path, ndvi_path):
 
@@ -297,16 +518,15 @@ def add_ndvi_in_multi_band(multi_band_path, ndvi_path):
     with rasterio.open(multi_band_path) as src1, rasterio.open(ndvi_path) as src2:
         # Read the arrays for all bands
         values = src1.read()
-        ndvi_values = src2.read(1)
+        ndvi_values = read_ndvi(src2)
 
         # Create a new raster file with the same shape and metadata as the second input band
         metadata = src2.meta.copy()
-        metadata.update(count=5, dtype=values.dtype)
+        metadata.update(count=5, dtype=values.dtype, nodata=np.nan)
 
         # Add the NDVI values to the fifth band of the new raster
         values = np.concatenate((values, np.expand_dims(ndvi_values, axis=0)), axis=0)
 
         # Write the new 5-band raster to disk
         output_path = os.path.splitext(multi_band_path)[0] + '_added.TIF'
-        with rasterio.open(output_path, 'w', **metadata) as dst:
-            dst.write(values)
+        write_product(output_path, values.astype(metadata['dtype'], copy=False), metadata, 'composite')
@@ -0,0 +1,269 @@
+# Standard library imports
+from concurrent.futures import as_completed
+import glob
+import os
+
+# Third-party library imports
+import rasterio
+from rasterio import windows
+from rasterio.crs import CRS
+from rasterio.warp import transform_geom
+from send2trash import send2trash
+from shapely.geometry import Polygon, box, mapping, shape
+from shapely.ops import unary_union
+
+# External library imports
+
+# Project-specific library imports
+from geometry import crop_array, crop_mask, crop_window
+from ingest import IngestError, archive_scene, extract_scene
+from metadata import load_metadata
+from pipeline import FUSED_BANDS, RED_BAND, date_pool, process_date, restore_date
+from processing import get_filelist, select_bands
+from scene_cache import link_or_copy
+import settings
+
+# Folder of the scenes shared by the protected areas, in the landsat directory
+SCENES_FOLDER = 'scenes'
+
+
+def read_window(band_path, shapes_list):
+    """
+    Reads the part of a band that covers every protected area: the union of their crop windows.
+
+    Returns:
+        tuple: The band array, its transform, the band metadata and its nodata value (0 when it has none).
+    """
+    with rasterio.open(band_path) as src:
+        window = windows.union([crop_window(shapes, src.transform, src.shape) for shapes in shapes_list])
+        data = src.read(1, window=window)
+        return data, src.window_transform(window), src.meta.copy(), src.nodata if src.nodata is not None else 0
+
+
+class DecodedScene:
+    """
+    B2-B5 and QA_PIXEL bands of a scene, decoded once for several protected areas: each band is read over the union
+    of the crop windows of the areas, and every area is then clipped from memory (see pipeline.process_scene and
+    processing.generate_cloud_mask) with the same result as reading its own crop from the files.
+
+    Attributes:
+        bands (dict): `{band: (array, transform, metadata, nodata)}`.
+        qa (tuple): (array, transform, metadata, nodata) of the QA_PIXEL band, None when the scene has none.
+        metadata (LandsatMetadata): MTL metadata of the scene.
+        crs (CRS): Coordinate reference system of the bands.
+    """
+
+    def __init__(self, bands, qa, metadata, crs):
+        self.bands = bands
+        self.qa = qa
+        self.metadata = metadata
+        self.crs = crs
+
+    @classmethod
+    def read(cls, scene_date, bands_folder, shapes_list):
+        """
+        Decodes the bands of a scene over the areas of `shapes_list`, a list of shapes in the scene CRS.
+        """
+        tif_list = get_filelist(scene_date, bands_folder, '*.TIF')
+        band_paths = select_bands(tif_list, FUSED_BANDS)
+        metadata = load_metadata(get_filelist(scene_date, bands_folder, '*MTL.txt')[0])
+
+        bands = {band: read_window(band_path, shapes_list) for band, band_path in zip(FUSED_BANDS, band_paths)}
+        qa_list = get_filelist(scene_date, bands_folder, '*QA_PIXEL.TIF')
+        qa = read_window(qa_list[0], shapes_list) if qa_list else None
+        return cls(bands, qa, metadata, bands[RED_BAND][2]['crs'])
+
+    def clipped_band(self, band, shapes):
+        """
+        Returns a band cropped to the shapes, as pipeline.read_clipped_band does: the array, its transform, the band
+        metadata and its nodata value.
+        """
+        data, transform, profile, nodata = self.bands[band]
+        clipped, clipped_transform = crop_array(data, transform, shapes, nodata, self.crs)
+        return clipped, clipped_transform, profile, nodata
+
+    def clipped_qa(self, shapes):
+        """
+        Returns the QA_PIXEL band cropped to the shapes, its transform and the mask of the pixels outside the shapes,
+        or None when the scene has no QA_PIXEL band.
+        """
+        if self.qa is None:
+            return None
+        data, transform, _, nodata = self.qa
+        clipped, clipped_transform = crop_array(data, transform, shapes, nodata, self.crs)
+        _, _, outside = crop_mask(shapes, transform, data.shape, self.crs)
+        return clipped, clipped_transform, outside
+
+
+def ingest_scenes(download_folder, scenes_dir, bands_folder_name, ndvi_folder_name):
+    """
+    Ingests every downloaded Landsat bundle once, in the INGEST_MODE setting, to a folder of its own:
+
+        <scenes folder>/<product id>/<YYYY-MM-DD-LC08>/<bands folder>/
+
+    The scenes of different path/rows of the same date do not collide, and every protected area links the files of
+    the scenes it needs (see link_scene) instead of ingesting them again.
+
+    Returns:
+        list: The date folders of the ingested scenes, sorted.
+    """
+    ingest_scene = archive_scene if settings.INGEST_MODE == 'archive' else extract_scene
+
+    for tar_file in glob.glob(os.path.join(download_folder, '*.tar')):
+        product_id = os.path.basename(tar_file).split('.')[0]
+        try:
+            ingest_scene(tar_file, os.path.join(scenes_dir, product_id), bands_folder_name, ndvi_folder_name)
+        except IngestError as e:
+            print(f'Could not ingest {tar_file}: {e}')
+            continue
+
+        # Move the downloaded file to the trash folder, unless it was archived
+        if os.path.exists(tar_file):
+            send2trash(tar_file)
+
+    return sorted(os.path.dirname(bands_folder)
+                  for bands_folder in glob.glob(os.path.join(scenes_dir, '*', '*', bands_folder_name)))
+
+
+def query_footprint(footprints):
+    """
+    Returns the polygon the scenes of several protected areas are queried with at once: the union of their footprints,
+    or its convex hull when they do not overlap, as the search takes a single polygon.
+
+    Args:
+        footprints (list): Footprints of the areas, each a list of rings of (longitude, latitude) points.
+
+    Returns:
+        list: The polygon as a list with its exterior ring, as the footprints.
+    """
+    union = unary_union([Polygon(footprint[0], footprint[1:]) for footprint in footprints])
+    if union.geom_type != 'Polygon':
+        union = union.convex_hull
+    return [[list(point) for point in union.exterior.coords]]
+
+
+def scene_footprint(scene_date, bands_folder):
+    """
+    Returns the footprint of a scene, the bounds of its red band as a shapely box, and its CRS.
+    """
+    band_path = select_bands(get_filelist(scene_date, bands_folder, '*.TIF'), [RED_BAND])[0]
+    with rasterio.open(band_path) as src:
+        return box(*src.bounds), src.crs
+
+
+def area_shapes(area, crs):
+    """
+    Returns the shapes of a protected area in `crs`, as plain GeoJSON dicts.
+    """
+    if area.get('crs') is None or CRS.from_user_input(area['crs']) == crs:
+        return [mapping(shape(geometry)) for geometry in area['shapes']]
+    return [transform_geom(area['crs'], crs, geometry) for geometry in area['shapes']]
+
+
+def link_scene(scene_date, protected_area_dir, bands_folder_name, ndvi_folder_name):
+    """
+    Gives a protected area the date folder of a scene, with its bands folder linked file by file (see
+    scene_cache.link_or_copy) and an empty NDVI folder.
+
+    Returns:
+        str: The date folder of the area, or None when the area already has a different scene on that date.
+    """
+    scene_bands_folder = os.path.join(scene_date, bands_folder_name)
+    protected_area_date = os.path.join(protected_area_dir, os.path.basename(scene_date))
+    bands_folder = os.path.join(protected_area_date, bands_folder_name)
+
+    if os.path.exists(bands_folder):
+        product_id = os.path.basename(os.path.dirname(scene_date))
+        metadata_list = get_filelist(protected_area_date, bands_folder_name, '*MTL.txt')
+        if not metadata_list or load_metadata(metadata_list[0]).product_id != product_id:
+            print(f'{protected_area_date} holds another scene, {product_id} is not used')
+            return None
+        return protected_area_date
+
+    os.makedirs(bands_folder + '.part', exist_ok=True)
+    for name in os.listdir(scene_bands_folder):
+        link_or_copy(os.path.join(scene_bands_folder, name), os.path.join(bands_folder + '.part', name))
+    os.replace(bands_folder + '.part', bands_folder)
+    os.makedirs(os.path.join(protected_area_date, ndvi_folder_name), exist_ok=True)
+    return protected_area_date
+
+
+def process_scene_areas(scene_date, bands_folder, ndvi_folder_name, tasks):
+    """
+    Decodes a scene once and processes it for every protected area of `tasks`, a list of (area date folder, shapes).
+
+    Returns:
+        list: The process_date result of every task.
+    """
+    scene = DecodedScene.read(scene_date, bands_folder, [shapes for _, shapes in tasks])
+    print(f'{os.path.basename(os.path.dirname(scene_date))}: decoded once for {len(tasks)} protected areas')
+    return [process_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, 'fused', scene)
+            for protected_area_date, shapes in tasks]
+
+
+def process_batch(areas, scene_dates, bands_folder, ndvi_folder_name, workers=None, on_date=None):
+    """
+    Processes the scenes of several protected areas with every scene decoded once: each scene is matched to the areas
+    its footprint intersects, linked into their folders, read over the union of their crops and clipped for each of
+    them. The dates of an area found in the scene cache are restored instead. The scenes are independent, so they run
+    on a process pool of at most `workers` processes (DATE_WORKERS setting by default).
+
+    Args:
+        areas (list): Protected areas, {'protected_area_dir', 'shapes', 'crs'} dicts, 'crs' being the CRS of the
+            shapes (None when they are in the CRS of the scenes).
+        scene_dates (list): Date folders of the scenes, see ingest_scenes.
+        bands_folder (str): Name of the bands folder.
+        ndvi_folder_name (str): Name of the NDVI folder.
+        on_date (function): Called as on_date(protected_area_date, result) as soon as the date of an area is done.
+
+    Returns:
+        list: For every area, the (date folder, process_date result) of its dates, sorted by date.
+    """
+    results = [{} for _ in areas]
+    scene_tasks = []
+    for scene_date in scene_dates:
+        footprint, crs = scene_footprint(scene_date, bands_folder)
+        tasks = []
+        for i, area in enumerate(areas):
+            shapes = area_shapes(area, crs)
+            if not any(footprint.intersects(shape(geometry)) for geometry in shapes):
+                continue
+
+            protected_area_date = link_scene(scene_date, area['protected_area_dir'], bands_folder, ndvi_folder_name)
+            if protected_area_date is None:
+                continue
+
+            result = restore_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, 'fused')
+            if result is not None:
+                results[i][protected_area_date] = result
+                if on_date is not None:
+                    on_date(protected_area_date, result)
+            else:
+                tasks.append((i, protected_area_date, shapes))
+
+        if tasks:
+            scene_tasks.append((scene_date, tasks))
+
+    if workers is None:
+        workers = settings.DATE_WORKERS
+    workers = max(1, min(workers, len(scene_tasks), os.cpu_count() or 1))
+
+    def store(tasks, scene_results):
+        for (i, protected_area_date, _), result in zip(tasks, scene_results):
+            results[i][protected_area_date] = result
+            if on_date is not None:
+                on_date(protected_area_date, result)
+
+    if workers == 1:
+        for scene_date, tasks in scene_tasks:
+            store(tasks, process_scene_areas(scene_date, bands_folder, ndvi_folder_name,
+                                             [task[1:] for task in tasks]))
+    else:
+        with date_pool(workers) as executor:
+            futures = {executor.submit(process_scene_areas, scene_date, bands_folder, ndvi_folder_name,
+                                       [task[1:] for task in tasks]): tasks
+                       for scene_date, tasks in scene_tasks}
+            for future in as_completed(futures):
+                store(futures[future], future.result())
+
+    return [sorted(area_results.items()) for area_results in results]
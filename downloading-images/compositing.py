@@ -0,0 +1,264 @@
+# Standard library imports
+import json
+import os
+
+# Third-party library imports
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from affine import Affine
+
+# External library imports
+
+# Project-specific library imports
+from kernels import get_backend
+from masks import ForestMasks, PackedMask, forest_change
+from NDVI import FOREST_COVER_THRESHOLD, read_ndvi, write_ndvi
+from profiles import write_product
+
+STATE_FOLDER = 'composite_state'
+STATE_NAME = 'state.json'
+
+# Lowest composite NDVI counted as forest from the second date on, as replace_nan_values does
+COMPOSITE_FOREST_THRESHOLD = FOREST_COVER_THRESHOLD
+
+# Value of the NDVI date of the pixels that were never valid
+NO_DATE = -1
+
+
+def file_signature(path):
+    """
+    Returns the size and modification time of a file, to detect products that changed since they were composited.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class CompositeState:
+    """
+    Running forest cover composite of a protected area, saved in `<deforestation folder>/composite_state/` so a new
+    date costs a single scene-sized update instead of a rebuild of the whole chain:
+
+        state.json: the composited dates, in order, with their forest area and the signature of their products.
+        checkpoint_<date>.npz: the composite after each date:
+            ndvi: last valid forest NDVI of every pixel, NaN where it was never valid.
+            ndvi_date: date of that NDVI, in days since 1970-01-01, -1 where it was never valid.
+            multiband: last valid B2-B5 values of every pixel.
+            forest_bits, valid_bits: last observed forest state of every pixel, and whether it was ever observed, as
+                packed masks (see masks.py).
+            loss_bits, gain_bits: pixels that stopped or started being forest on the date, as packed masks.
+
+    Any checkpoint can be the starting point of a rebuild, see rollback.
+    """
+
+    def __init__(self, deforestation_dir):
+        self.deforestation_dir = deforestation_dir
+        self.folder = os.path.join(deforestation_dir, STATE_FOLDER)
+        self.steps = []
+
+        state_path = os.path.join(self.folder, STATE_NAME)
+        if os.path.exists(state_path):
+            with open(state_path) as state_file:
+                self.steps = json.load(state_file)['steps']
+
+    @property
+    def dates(self):
+        return [step['date'] for step in self.steps]
+
+    def checkpoint_path(self, date_name):
+        return os.path.join(self.folder, f'checkpoint_{date_name}.npz')
+
+    def load_checkpoint(self, date_name):
+        """
+        Returns the composite saved after a date: {'ndvi', 'ndvi_date', 'multiband', 'forest_state', 'loss', 'gain',
+        'transform', 'crs'}.
+        """
+        with np.load(self.checkpoint_path(date_name)) as checkpoint:
+            shape = checkpoint['ndvi'].shape
+            return {
+                'ndvi': checkpoint['ndvi'],
+                'ndvi_date': checkpoint['ndvi_date'],
+                'multiband': checkpoint['multiband'],
+                'forest_state': ForestMasks(PackedMask(checkpoint['forest_bits'], shape),
+                                            PackedMask(checkpoint['valid_bits'], shape)),
+                'loss': PackedMask(checkpoint['loss_bits'], shape),
+                'gain': PackedMask(checkpoint['gain_bits'], shape),
+                'transform': Affine(*checkpoint['transform']),
+                'crs': CRS.from_wkt(str(checkpoint['crs'])),
+            }
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        state_path = os.path.join(self.folder, STATE_NAME)
+        with open(state_path + '.part', 'w') as state_file:
+            json.dump({'steps': self.steps}, state_file, indent=2)
+        os.replace(state_path + '.part', state_path)
+
+    def rollback(self, count):
+        """
+        Keeps the first `count` composited dates and deletes the checkpoints of the others, which are composited again
+        by the next update.
+        """
+        for step in self.steps[count:]:
+            try:
+                os.remove(self.checkpoint_path(step['date']))
+            except FileNotFoundError:
+                pass
+        self.steps = self.steps[:count]
+        self.save()
+
+    def apply(self, protected_area_date, ndvi_folder_name, datacube=None):
+        """
+        Adds a date to the composite: the pixels where its forest NDVI is NaN keep the composite values, the others
+        take the values of the date. Writes the composite of the date, as the chain of replace_nan_values and
+        replace_nan_add_ndvi did:
+
+            <deforestation folder>/<previous date>__<date>.TIF (<date>__.TIF for the first date): forest NDVI
+            <date>/<date>_B2_B3_B4_B5_multiband_NDVI_masked_added.TIF: B2-B5 and forest NDVI
+
+        The forest NDVI and observations of the date are read from `datacube` (a datacube.DataCube the date was
+        appended to) on its grid, or from the NDVI products of the date without it. The forest loss and gain of the
+        date are counted on packed masks against the last observed forest state of every pixel, see
+        masks.forest_change.
+
+        Returns:
+            dict: The step of the date: {'date', 'area', 'loss_area', 'gain_area', 'products'}.
+        """
+        date_name = os.path.basename(os.path.normpath(protected_area_date))
+        forest_path = os.path.join(protected_area_date, ndvi_folder_name, 'forest_NDVI_mask_clipped.TIF')
+        ndvi_path = os.path.join(protected_area_date, ndvi_folder_name, 'NDVI_mask_clipped.TIF')
+        multiband_path = os.path.join(protected_area_date, date_name + '_B2_B3_B4_B5_multiband.TIF')
+
+        if datacube is not None:
+            # One time step of the cube: the forest NDVI of the date is its composite alone
+            current = datacube.composite(scene=date_name)
+            observed = datacube.read('ndvi', scene=date_name)[1][0]
+            profile = {'driver': 'GTiff', 'height': current.shape[0], 'width': current.shape[1], 'count': 1,
+                       'dtype': 'float32', 'nodata': np.nan, 'crs': datacube.crs, 'transform': datacube.transform}
+            pixel_size = datacube.pixel_size
+            with rasterio.open(multiband_path) as src:
+                multiband = np.stack([datacube.place(band, src.transform, np.nan)
+                                      for band in src.read().astype('float32', copy=False)])
+        else:
+            with rasterio.open(forest_path) as src:
+                current = read_ndvi(src)
+                profile = src.meta.copy()
+                pixel_size = src.res[0] * src.res[1]  # assuming square pixels
+            with rasterio.open(multiband_path) as src:
+                multiband = src.read().astype('float32', copy=False)
+
+            # Observed pixels of the date, from its NDVI, which is only NaN outside the area and under clouds
+            observed = None
+            if os.path.exists(ndvi_path):
+                with rasterio.open(ndvi_path) as src:
+                    observed = read_ndvi(src)
+        masks = ForestMasks.from_ndvi(current, observed if observed is not None and observed.shape == current.shape
+                                      else None)
+
+        # The multiband values are only kept where the forest NDVI is valid
+        valid = ~np.isnan(current)
+        multiband[:, ~valid] = np.nan
+        day = (np.datetime64(date_name[:10], 'D') - np.datetime64('1970-01-01', 'D')).astype(int)
+
+        if not self.steps:
+            ndvi = current
+            ndvi_date = np.where(valid, day, NO_DATE).astype('int32')
+            area = (datacube.forest_areas(scene=date_name)[0][1] if datacube is not None
+                    else masks.forest.area(pixel_size))
+            loss, gain, forest_state = PackedMask.zeros(current.shape), PackedMask.zeros(current.shape), masks
+            composite_name = f'{date_name}__.TIF'
+        else:
+            previous_name = self.steps[-1]['date']
+            previous = self.load_checkpoint(previous_name)
+            if previous['ndvi'].shape != current.shape:
+                raise ValueError(f'{date_name} grid {current.shape} does not match the composite grid '
+                                 f'{previous["ndvi"].shape}, rebuild the composite')
+
+            backend = get_backend()
+            ndvi = backend.fill_nan(current, previous['ndvi'], np.empty_like(current))
+            ndvi_date = np.where(valid, day, previous['ndvi_date']).astype('int32')
+            for i in range(len(multiband)):
+                backend.fill_nan(multiband[i], previous['multiband'][i], multiband[i])
+            area = PackedMask.from_array(ndvi > COMPOSITE_FOREST_THRESHOLD).area(pixel_size)
+            loss, gain, forest_state = forest_change(previous['forest_state'], masks)
+            composite_name = f'{previous_name}__{date_name}.TIF'
+
+        loss_area, gain_area = loss.area(pixel_size), gain.area(pixel_size)
+        print(f'Total area of NDVI: {area:.2f} hectares')
+        print(f'Forest loss: {loss_area:.2f} hectares, forest gain: {gain_area:.2f} hectares')
+
+        write_ndvi(os.path.join(self.deforestation_dir, composite_name), ndvi, profile, 'forest')
+        added_path = os.path.splitext(multiband_path)[0] + '_NDVI_masked_added.TIF'
+        write_product(added_path, np.concatenate((multiband, ndvi[np.newaxis])),
+                      dict(profile, nodata=np.nan), 'composite')
+
+        os.makedirs(self.folder, exist_ok=True)
+        np.savez_compressed(self.checkpoint_path(date_name), ndvi=ndvi, ndvi_date=ndvi_date, multiband=multiband,
+                            forest_bits=forest_state.forest.bits, valid_bits=forest_state.valid.bits,
+                            loss_bits=loss.bits, gain_bits=gain.bits,
+                            transform=np.array(list(profile['transform'])[:6]), crs=profile['crs'].to_wkt())
+
+        step = {
+            'date': date_name,
+            'area': float(area),
+            'loss_area': float(loss_area),
+            'gain_area': float(gain_area),
+            'products': {'forest': file_signature(forest_path), 'multiband': file_signature(multiband_path)},
+        }
+        self.steps.append(step)
+        self.save()
+        return step
+
+    def is_current(self, step, protected_area_date, ndvi_folder_name):
+        """
+        Returns whether the products of a composited date are the ones it was composited with.
+        """
+        date_name = step['date']
+        try:
+            return step['products'] == {
+                'forest': file_signature(os.path.join(protected_area_date, ndvi_folder_name,
+                                                      'forest_NDVI_mask_clipped.TIF')),
+                'multiband': file_signature(os.path.join(protected_area_date,
+                                                         date_name + '_B2_B3_B4_B5_multiband.TIF')),
+            }
+        except FileNotFoundError:
+            return False
+
+
+def update_composite(deforestation_dir, protected_area_dates, ndvi_folder_name, rebuild_from=None, datacube=None):
+    """
+    Brings the forest cover composite of a protected area up to date. The saved state is kept as long as its dates are
+    the first dates of `protected_area_dates` with unchanged products; the composite is then only updated with the
+    remaining dates. A date that is new before the last composited one, or whose products changed, rolls the state
+    back to the checkpoint before it.
+
+    Args:
+        deforestation_dir (str): Deforestation folder of the protected area.
+        protected_area_dates (list): Date folders, sorted.
+        ndvi_folder_name (str): Name of the NDVI folder.
+        rebuild_from (str): Date folder name ('YYYY-MM-DD-LC08') the composite is rebuilt from, once: the dates from
+            it on are composited again from the checkpoint before it. None to only add the new dates.
+        datacube (DataCube): Datacube of the protected area, with every date appended; the dates are then read from
+            it, see CompositeState.apply.
+
+    Returns:
+        list: The step of every date, {'date', 'area', 'loss_area', 'gain_area', 'products'}, in order.
+    """
+    state = CompositeState(deforestation_dir)
+
+    # Number of composited dates that can be kept
+    kept = 0
+    while (kept < len(state.steps) and kept < len(protected_area_dates)
+           and state.steps[kept]['date'] == os.path.basename(os.path.normpath(protected_area_dates[kept]))
+           and state.steps[kept]['date'] != rebuild_from
+           and state.is_current(state.steps[kept], protected_area_dates[kept], ndvi_folder_name)):
+        kept += 1
+
+    if kept < len(state.steps):
+        print(f'Composite rebuilt from {state.steps[kept]["date"]}')
+        state.rollback(kept)
+
+    for protected_area_date in protected_area_dates[kept:]:
+        state.apply(protected_area_date, ndvi_folder_name, datacube)
+
+    return state.steps
@@ -0,0 +1,325 @@
+# Standard library imports
+import os
+
+# Third-party library imports
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.crs import CRS
+from affine import Affine
+import zarr
+from numcodecs import Blosc, VLenUTF8
+
+# External library imports
+
+# Project-specific library imports
+from compositing import file_signature
+from NDVI import decode_ndvi, encode_ndvi, ndvi_storage_profile, read_ndvi
+from processing import get_filelist
+import settings
+
+DATACUBE_NAME = 'datacube.zarr'
+DATACUBE_EXTENSION = '.zarr'
+
+# Values of the forest variable
+FOREST = 1
+NOT_FOREST = 0
+FOREST_NODATA = 255
+
+# QA_PIXEL fill value, bit 0 (Fill) set
+QA_FILL = 1
+
+COMPRESSOR = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+def scene_of(protected_area_date):
+    """
+    Returns the name of a date folder, the key of its time step, e.g. '.../2023-02-18-LC08' -> '2023-02-18-LC08'.
+    """
+    return os.path.basename(os.path.normpath(protected_area_date))
+
+
+def date_of(protected_area_date):
+    """
+    Returns the acquisition date of a date folder, e.g. '.../2023-02-18-LC08' -> numpy.datetime64('2023-02-18').
+    """
+    return np.datetime64(scene_of(protected_area_date)[:10], 'D')
+
+
+class DataCube:
+    """
+    Time series of a protected area in a chunked, compressed Zarr store, one (1, block, block) chunk per date and
+    block so a date, or a window of every date, is read without touching the rest:
+
+        time (time): acquisition dates, in the order they were appended.
+        scene (time): date folder names, the keys of the time steps: two scenes of the same day (LC08 and LC09, or
+            two path/rows) are two time steps.
+        ndvi (time, y, x): clipped NDVI, stored with the NDVI storage policy of the cube (see NDVI.ndvi_storage_profile).
+        forest (time, y, x): 1 forest, 0 not forest, 255 no data (outside the area, clouds).
+        qa (time, y, x): QA_PIXEL band, 1 (fill) where it is not available.
+
+    The grid (transform, crs, shape) is the one of the first appended date; later dates are placed on it by their
+    transform and cropped to it. The forest cover composite reads its dates from the cube, see
+    compositing.CompositeState.apply.
+
+        cube = DataCube.open_or_create(protected_area_dir)
+        cube.append_date(protected_area_date, 'bands_folder', 'ndvi_folder')
+        dates, ndvi = cube.read('ndvi', '2023-01-01', '2023-06-30')
+    """
+
+    def __init__(self, group):
+        self.group = group
+
+    @classmethod
+    def open(cls, protected_area_dir):
+        """
+        Opens the datacube of a protected area, or returns None when it has none.
+        """
+        path = os.path.join(protected_area_dir, DATACUBE_NAME)
+        if not os.path.exists(path):
+            return None
+        return cls(zarr.open_group(path, mode='a'))
+
+    @classmethod
+    def open_or_create(cls, protected_area_dir):
+        """
+        Opens the datacube of a protected area, creating an empty one when it has none. The grid is set by the first
+        appended date.
+        """
+        return cls(zarr.open_group(os.path.join(protected_area_dir, DATACUBE_NAME), mode='a'))
+
+    @property
+    def transform(self):
+        return Affine(*self.group.attrs['transform'])
+
+    @property
+    def crs(self):
+        return CRS.from_wkt(self.group.attrs['crs'])
+
+    @property
+    def shape(self):
+        return tuple(self.group['ndvi'].shape[1:])
+
+    @property
+    def pixel_size(self):
+        transform = self.transform
+        return abs(transform.a * transform.e)  # assuming square pixels
+
+    @property
+    def dates(self):
+        """
+        The acquisition dates of the cube, sorted.
+        """
+        if 'time' not in self.group:
+            return []
+        return sorted(self.group['time'][:])
+
+    @property
+    def scenes(self):
+        """
+        The date folder names of the cube, in the order of their dates.
+        """
+        if 'scene' not in self.group:
+            return []
+        return [str(scene) for scene in self.group['scene'].get_orthogonal_selection(self._indices()[1])]
+
+    def _create(self, shape, transform, crs):
+        chunks = (1, settings.DATACUBE_CHUNKSIZE, settings.DATACUBE_CHUNKSIZE)
+        storage = ndvi_storage_profile()
+        ndvi_fill = storage['nodata']
+
+        self.group.attrs.update({
+            'transform': list(transform)[:6],
+            'crs': crs.to_wkt(),
+            'ndvi_scale': storage.get('scales', [1.0])[0],
+            'ndvi_nodata': None if np.isnan(ndvi_fill) else ndvi_fill,
+        })
+        self.group.create_dataset('time', shape=(0,), chunks=(1024,), dtype='M8[D]')
+        self.group.create_dataset('scene', shape=(0,), chunks=(1024,), dtype=object, object_codec=VLenUTF8())
+        self.group.create_dataset('ndvi', shape=(0,) + shape, chunks=chunks, dtype=storage['dtype'],
+                                  fill_value=ndvi_fill, compressor=COMPRESSOR)
+        self.group.create_dataset('forest', shape=(0,) + shape, chunks=chunks, dtype='uint8',
+                                  fill_value=FOREST_NODATA, compressor=COMPRESSOR)
+        self.group.create_dataset('qa', shape=(0,) + shape, chunks=chunks, dtype='uint16', fill_value=QA_FILL,
+                                  compressor=COMPRESSOR)
+
+    def place(self, data, transform, fill):
+        """
+        Puts an array with its own transform on the grid of the cube, filling the rest with `fill`.
+        """
+        placed = np.full(self.shape, fill, dtype=data.dtype)
+        cube_transform = self.transform
+        row_off = int(round((transform.f - cube_transform.f) / cube_transform.e))
+        col_off = int(round((transform.c - cube_transform.c) / cube_transform.a))
+
+        rows = slice(max(row_off, 0), min(row_off + data.shape[0], placed.shape[0]))
+        cols = slice(max(col_off, 0), min(col_off + data.shape[1], placed.shape[1]))
+        if rows.start < rows.stop and cols.start < cols.stop:
+            placed[rows, cols] = data[rows.start - row_off:rows.stop - row_off,
+                                      cols.start - col_off:cols.stop - col_off]
+        return placed
+
+    def _time_index(self, scene):
+        """
+        Returns the index of a date folder name in the cube, appending an empty time step when it is new.
+        """
+        scenes = self.group['scene']
+        existing = np.nonzero(scenes[:] == scene)[0]
+        if existing.size:
+            return int(existing[0])
+
+        index = scenes.shape[0]
+        self.group['time'].append(np.array([date_of(scene)], dtype='M8[D]'))
+        scenes.append(np.array([scene], dtype=object))
+        for name in ('ndvi', 'forest', 'qa'):
+            array = self.group[name]
+            array.resize((index + 1,) + array.shape[1:])
+        return index
+
+    def _read_qa(self, protected_area_date, bands_folder, ndvi_folder_name):
+        """
+        Reads the QA_PIXEL band of a date on the grid of the cube: the clipped QA band of the NDVI folder (see
+        processing.clip_qa_band) or, for the dates processed without it, the QA_PIXEL band of the bands folder. Returns
+        None when neither is available.
+        """
+        qa_path = os.path.join(protected_area_date, ndvi_folder_name, 'QA_PIXEL_clipped.TIF')
+        if os.path.exists(qa_path):
+            with rasterio.open(qa_path) as src:
+                return self.place(src.read(1), src.transform, QA_FILL)
+
+        qa_list = get_filelist(protected_area_date, bands_folder, '*QA_PIXEL.TIF')
+        if not qa_list:
+            return None
+
+        height, width = self.shape
+        bounds = windows.bounds(windows.Window(0, 0, width, height), self.transform)
+        with rasterio.open(qa_list[0]) as src:
+            window = windows.from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+            return src.read(1, window=window, out_shape=(height, width), boundless=True, fill_value=QA_FILL)
+
+    def date_products(self, protected_area_date, ndvi_folder_name):
+        """
+        Returns the signature of the NDVI products of a date, see compositing.file_signature.
+        """
+        ndvi_folder = os.path.join(protected_area_date, ndvi_folder_name)
+        signatures = {}
+        for name in ('NDVI_mask_clipped.TIF', 'forest_NDVI_mask_clipped.TIF', 'QA_PIXEL_clipped.TIF'):
+            path = os.path.join(ndvi_folder, name)
+            signatures[name] = file_signature(path) if os.path.exists(path) else None
+        return signatures
+
+    def is_current(self, protected_area_date, ndvi_folder_name):
+        """
+        Returns whether a date is in the cube with the products it has now.
+        """
+        date_name = scene_of(protected_area_date)
+        products = self.group.attrs.get('products', {})
+        return date_name in products and products[date_name] == self.date_products(protected_area_date,
+                                                                                    ndvi_folder_name)
+
+    def append_date(self, protected_area_date, bands_folder, ndvi_folder_name):
+        """
+        Appends the NDVI, forest mask and QA band of a processed date to the cube. A date already in the cube is
+        overwritten, so a date can be processed again.
+
+        Args:
+            protected_area_date (str): Folder of the date.
+            bands_folder (str): Name of the bands folder.
+            ndvi_folder_name (str): Name of the NDVI folder.
+
+        Returns:
+            int: The time index of the date.
+        """
+        ndvi_folder = os.path.join(protected_area_date, ndvi_folder_name)
+        with rasterio.open(os.path.join(ndvi_folder, 'NDVI_mask_clipped.TIF')) as src:
+            ndvi_data = read_ndvi(src)
+            transform, crs = src.transform, src.crs
+        with rasterio.open(os.path.join(ndvi_folder, 'forest_NDVI_mask_clipped.TIF')) as src:
+            forest_data = read_ndvi(src)
+
+        if 'ndvi' not in self.group:
+            self._create(ndvi_data.shape, transform, crs)
+
+        forest = np.full(ndvi_data.shape, FOREST_NODATA, dtype='uint8')
+        forest[~np.isnan(ndvi_data)] = NOT_FOREST
+        forest[~np.isnan(forest_data)] = FOREST
+
+        ndvi_data = self.place(ndvi_data, transform, np.nan)
+        forest = self.place(forest, transform, FOREST_NODATA)
+        qa_data = self._read_qa(protected_area_date, bands_folder, ndvi_folder_name)
+
+        index = self._time_index(scene_of(protected_area_date))
+        self.group['ndvi'][index] = encode_ndvi(ndvi_data, self.group['ndvi'].dtype)
+        self.group['forest'][index] = forest
+        self.group['qa'][index] = QA_FILL if qa_data is None else qa_data
+
+        # Products of the date, so it is only appended again when they change
+        products = self.group.attrs.get('products', {})
+        products[scene_of(protected_area_date)] = self.date_products(protected_area_date, ndvi_folder_name)
+        self.group.attrs['products'] = products
+
+        print(f'{os.path.basename(protected_area_date)} appended to the datacube')
+        return index
+
+    def _indices(self, start=None, end=None, scene=None):
+        """
+        Returns the dates between `start` and `end` (inclusive), or the date of the folder name `scene`, and their time
+        indices, sorted by date and folder name.
+        """
+        times = self.group['time'][:] if 'time' in self.group else np.array([], dtype='M8[D]')
+        scenes = self.group['scene'][:] if 'scene' in self.group else np.array([], dtype=object)
+        selected = np.ones(times.shape, dtype=bool)
+        if start is not None:
+            selected &= times >= np.datetime64(start, 'D')
+        if end is not None:
+            selected &= times <= np.datetime64(end, 'D')
+        if scene is not None:
+            selected &= scenes == scene
+
+        indices = np.nonzero(selected)[0]
+        indices = indices[np.lexsort((scenes[indices].astype(str), times[indices]))]
+        return times[indices], indices
+
+    def read(self, variable, start=None, end=None, window=None, scene=None):
+        """
+        Reads a variable for the dates between `start` and `end`, or for the date folder name `scene`, only the chunks
+        of those dates and of `window` (a rasterio Window of the cube grid) are read. The NDVI is decoded to float32
+        with NaN where there is no data.
+
+        Returns:
+            tuple: The dates, sorted, and the (time, y, x) array.
+        """
+        dates, indices = self._indices(start, end, scene)
+        rows, cols = window.toslices() if window is not None else (slice(None), slice(None))
+        data = self.group[variable].get_orthogonal_selection((indices, rows, cols))
+
+        if variable == 'ndvi':
+            data = decode_ndvi(data, self.group.attrs['ndvi_nodata'], self.group.attrs['ndvi_scale'])
+        return dates, data
+
+    def composite(self, start=None, end=None, window=None, scene=None):
+        """
+        Returns the forest NDVI composite of the dates between `start` and `end`, or of the date folder name `scene`
+        alone: for each pixel, the NDVI of the latest date where it was forest. Pixels that were never forest are NaN.
+        The dates are read one at a time.
+        """
+        dates, indices = self._indices(start, end, scene)
+        rows, cols = window.toslices() if window is not None else (slice(None), slice(None))
+        height, width = self.shape if window is None else (int(window.height), int(window.width))
+
+        composite = np.full((height, width), np.nan, dtype='float32')
+        for index in indices:
+            forest = self.group['forest'][index, rows, cols] == FOREST
+            ndvi_data = decode_ndvi(self.group['ndvi'][index, rows, cols], self.group.attrs['ndvi_nodata'],
+                                    self.group.attrs['ndvi_scale'])
+            composite[forest] = ndvi_data[forest]
+        return composite
+
+    def forest_areas(self, start=None, end=None, scene=None):
+        """
+        Returns the forest area in hectares of every date between `start` and `end`, or of the date folder name
+        `scene`, as (date, area) tuples.
+        """
+        dates, indices = self._indices(start, end, scene)
+        return [(date, np.count_nonzero(self.group['forest'][index] == FOREST) * self.pixel_size / 10000)
+                for date, index in zip(dates, indices)]
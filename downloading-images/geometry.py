@@ -0,0 +1,169 @@
+# Standard library imports
+from collections import OrderedDict
+import hashlib
+import math
+import threading
+
+# Third-party library imports
+import numpy as np
+from rasterio import windows
+from rasterio.errors import WindowError
+from rasterio.features import bounds, geometry_mask
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+# External library imports
+
+# Project-specific library imports
+
+# Number of rasterized crop masks kept in memory, a few protected areas on a few band grids
+CROP_MASK_CACHE_SIZE = 64
+
+# Classes of the raster blocks, see classify_blocks
+BLOCK_OUTSIDE = 'outside'
+BLOCK_INSIDE = 'inside'
+BLOCK_EDGE = 'edge'
+
+_crop_mask_cache = OrderedDict()
+_crop_mask_cache_lock = threading.Lock()
+
+
+def crop_window(shapes, transform, shape):
+    """
+    Returns the window of a raster that contains the shapes, the outermost pixel indices that contain the geometry,
+    as rasterio.mask.mask(crop=True) does.
+
+    Args:
+        shapes (list): Geometries in the raster CRS.
+        transform (Affine): Transform of the raster.
+        shape (tuple): (height, width) of the raster.
+
+    Returns:
+        Window: The crop window, within the raster.
+    """
+    all_bounds = [bounds(geometry, transform=~transform) for geometry in shapes]
+    cols = [x for (left, bottom, right, top) in all_bounds for x in (left, right)]
+    rows = [y for (left, bottom, right, top) in all_bounds for y in (top, bottom)]
+
+    row_start, row_stop = int(math.floor(min(rows))), int(math.ceil(max(rows)))
+    col_start, col_stop = int(math.floor(min(cols))), int(math.ceil(max(cols)))
+    window = windows.Window(col_off=col_start, row_off=row_start, width=max(col_stop - col_start, 0),
+                            height=max(row_stop - row_start, 0))
+
+    try:
+        return window.intersection(windows.Window(0, 0, shape[1], shape[0]))
+    except WindowError:
+        raise ValueError('Input shapes do not overlap raster.')
+
+
+def crop_mask(shapes, transform, shape, crs=None):
+    """
+    Returns the crop window of the shapes, its transform and a boolean mask of the window that is True outside the
+    shapes.
+
+    The result is cached by geometry hash, CRS, transform and shape: the dates of a protected area share the grid of
+    their WRS-2 path/row, so the shapes are rasterized once and reused for every band, date and product. The mask is
+    read-only.
+    """
+    key = (geometry_hash(shapes), crs.to_wkt() if crs is not None else None, tuple(transform)[:6], tuple(shape))
+    with _crop_mask_cache_lock:
+        cached = _crop_mask_cache.get(key)
+        if cached is not None:
+            _crop_mask_cache.move_to_end(key)
+            return cached
+
+    window = crop_window(shapes, transform, shape)
+    window_transform = windows.transform(window, transform)
+    outside = geometry_mask(shapes, out_shape=(int(window.height), int(window.width)), transform=window_transform)
+    outside.flags.writeable = False
+
+    with _crop_mask_cache_lock:
+        _crop_mask_cache[key] = (window, window_transform, outside)
+        while len(_crop_mask_cache) > CROP_MASK_CACHE_SIZE:
+            _crop_mask_cache.popitem(last=False)
+
+    return window, window_transform, outside
+
+
+def crop_array(arr, transform, shapes, nodata=np.nan, crs=None):
+    """
+    In-memory equivalent of rasterio.mask.mask(crop=True) for a 2D array: crops it to the shapes and sets the pixels
+    outside them to `nodata`.
+
+    Returns:
+        tuple: The cropped array and its transform.
+    """
+    window, window_transform, outside = crop_mask(shapes, transform, arr.shape, crs)
+    clipped = arr[window.toslices()].copy()
+    clipped[outside] = nodata
+    return clipped, window_transform
+
+
+def read_cropped(src, shapes, indexes=None):
+    """
+    Equivalent of rasterio.mask.mask(src, shapes, crop=True) with the cached crop mask: reads the crop window of a
+    dataset and sets the pixels outside the shapes to the dataset nodata value (0 when it has none).
+
+    Args:
+        src (DatasetReader): Open dataset.
+        shapes (list): Geometries in the dataset CRS.
+        indexes (int | list): Bands to read, all by default.
+
+    Returns:
+        tuple: The cropped array, (bands, rows, cols) or (rows, cols) for a single index, and its transform.
+    """
+    window, window_transform, outside = crop_mask(shapes, src.transform, src.shape, src.crs)
+    data = src.read(indexes, window=window)
+    data[..., outside] = src.nodata if src.nodata is not None else 0
+    return data, window_transform
+
+
+def classify_blocks(shapes, transform, block_windows):
+    """
+    Classifies raster blocks against the shapes by their bounds: BLOCK_OUTSIDE blocks have no pixel inside the shapes
+    and can be skipped, BLOCK_INSIDE blocks have every pixel inside them and need no masking, and only BLOCK_EDGE
+    blocks need a per-pixel mask.
+
+    Args:
+        shapes (list): Geometries in the raster CRS.
+        transform (Affine): Transform of the raster, north-up.
+        block_windows (iterable): Windows of the blocks.
+
+    Yields:
+        tuple: The window and its class.
+    """
+    area = prep(unary_union([shape(geometry) for geometry in shapes]))
+    for window in block_windows:
+        block = box(*windows.bounds(window, transform))
+        if not area.intersects(block):
+            yield window, BLOCK_OUTSIDE
+        elif area.contains(block):
+            yield window, BLOCK_INSIDE
+        else:
+            yield window, BLOCK_EDGE
+
+
+def dataset_blocks(dst, shapes):
+    """
+    Classifies the blocks of the first band of an open dataset against the shapes, see classify_blocks. Without shapes
+    every block is BLOCK_INSIDE.
+
+    Yields:
+        tuple: The window and its class.
+    """
+    block_windows = (window for _, window in dst.block_windows(1))
+    if shapes is None:
+        return ((window, BLOCK_INSIDE) for window in block_windows)
+    return classify_blocks(shapes, dst.transform, block_windows)
+
+
+def geometry_hash(shapes):
+    """
+    Returns a SHA-256 hex digest identifying the shapes (GeoJSON-like geometries), computed from their WKB so the same
+    geometries hash the same whatever their coordinate container types.
+    """
+    digest = hashlib.sha256()
+    for geometry in shapes:
+        digest.update(shape(geometry).wkb)
+    return digest.hexdigest()
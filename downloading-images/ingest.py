@@ -0,0 +1,341 @@
+# Standard library imports
+import datetime
+import fnmatch
+import json
+import os
+import re
+import shutil
+import tarfile
+import threading
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+import settings
+
+MANIFEST_NAME = 'ingest_manifest.json'
+
+# Members of a Landsat bundle used by the pipeline, besides the selected bands
+QA_PIXEL_MEMBER = re.compile(r'_QA_PIXEL\.TIF$', re.IGNORECASE)
+MTL_MEMBER = re.compile(r'_MTL\.txt$', re.IGNORECASE)
+BAND_MEMBER = re.compile(r'_B(\d+)\.TIF$', re.IGNORECASE)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# GDAL virtual filesystem of the members of an uncompressed tar: /vsitar/<path of the tar>/<member>
+VSITAR_PREFIX = '/vsitar/'
+ARCHIVE_EXTENSION = '.tar'
+
+_archive_index_cache = {}
+_archive_index_cache_lock = threading.Lock()
+
+
+class IngestError(Exception):
+    """
+    Raised when a Landsat bundle is truncated or one of its members does not have its declared size.
+    """
+
+
+def scene_folder_name(product_id):
+    """
+    Returns the date folder of a Landsat product, e.g. 'LC08_L2SP_009056_20230218_20230223_02_T1' -> '2023-02-18-LC08'.
+    """
+    split_name = product_id.split('_')
+    acquired = split_name[3]
+    return f'{acquired[:4]}-{acquired[4:6]}-{acquired[6:]}-{split_name[0]}'
+
+
+def wanted_member(name, bands):
+    """
+    Returns whether a member of a Landsat bundle is used by the pipeline: the selected bands, QA_PIXEL and MTL.
+    """
+    match = BAND_MEMBER.search(name)
+    if match:
+        return int(match.group(1)) in bands
+    return bool(QA_PIXEL_MEMBER.search(name) or MTL_MEMBER.search(name))
+
+
+def read_manifest(bands_folder):
+    """
+    Returns the ingest manifest of a bands folder, or None when the folder was not ingested by extract_scene.
+    """
+    manifest_path = os.path.join(bands_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def extract_member(tar, member, output_path):
+    """
+    Copies a member of an open tar stream to `output_path` and checks the written size against the member header.
+    """
+    source = tar.extractfile(member)
+    if source is None:
+        raise IngestError(f'{member.name} is not a regular file')
+
+    with source, open(output_path, 'wb') as output_file:
+        shutil.copyfileobj(source, output_file, COPY_BUFFER_SIZE)
+        written = output_file.tell()
+
+    if written != member.size:
+        raise IngestError(f'{member.name}: {written} bytes written, {member.size} expected')
+
+
+def extract_scene(tar_path, protected_area_dir, bands_folder_name, ndvi_folder_name, bands=None):
+    """
+    Reads a Landsat bundle once, as a stream, and writes only the members the pipeline uses to their final layout:
+
+        <protected area>/<YYYY-MM-DD-LC08>/<bands folder>/<selected bands, QA_PIXEL, MTL>
+        <protected area>/<YYYY-MM-DD-LC08>/<bands folder>/ingest_manifest.json
+        <protected area>/<YYYY-MM-DD-LC08>/<ndvi folder>/
+
+    The members are written to a temporary folder that is renamed to the bands folder once every member is checked,
+    so an interrupted ingest never leaves a partial bands folder. A date whose bands folder already exists is skipped.
+
+    Args:
+        tar_path (str): Path of the downloaded bundle.
+        protected_area_dir (str): Folder of the protected area.
+        bands_folder_name (str): Name of the bands folder.
+        ndvi_folder_name (str): Name of the NDVI folder.
+        bands (list): Band numbers to extract, by default the INGEST_BANDS setting.
+
+    Returns:
+        str: The date folder, or None when the date was already ingested.
+
+    Raises:
+        IngestError: When the bundle is truncated or a member does not have its declared size.
+    """
+    if bands is None:
+        bands = settings.INGEST_BANDS
+
+    product_id = os.path.basename(tar_path).split('.')[0]
+    scene_folder = os.path.join(protected_area_dir, scene_folder_name(product_id))
+    bands_folder = os.path.join(scene_folder, bands_folder_name)
+    if os.path.exists(bands_folder):
+        print(f'{scene_folder} already ingested, skipping {os.path.basename(tar_path)}')
+        return None
+
+    partial_folder = bands_folder + '.part'
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    os.makedirs(partial_folder)
+
+    members = []
+    skipped = 0
+    try:
+        # 'r|' reads the bundle sequentially, the members that are not needed are skipped without being written
+        with tarfile.open(tar_path, 'r|*') as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if not member.isfile() or not wanted_member(name, bands):
+                    skipped += 1
+                    continue
+
+                extract_member(tar, member, os.path.join(partial_folder, name))
+                members.append({'name': name, 'size': member.size})
+    except (tarfile.TarError, EOFError, OSError, IngestError) as e:
+        # Leave no trace of the date, so it is not processed and the bundle can be ingested again
+        shutil.rmtree(partial_folder, ignore_errors=True)
+        if not os.listdir(scene_folder):
+            os.rmdir(scene_folder)
+        if isinstance(e, IngestError):
+            raise
+        raise IngestError(f'{tar_path}: {e}') from e
+
+    extracted = {member['name'] for member in members}
+    missing = [f'B{band}' for band in bands
+               if not any(name.upper().endswith(f'_B{band}.TIF') for name in extracted)]
+    if not any(QA_PIXEL_MEMBER.search(name) for name in extracted):
+        missing.append('QA_PIXEL')
+    if not any(MTL_MEMBER.search(name) for name in extracted):
+        missing.append('MTL')
+    if missing:
+        print(f'{product_id}: not in the bundle: {", ".join(missing)}')
+
+    manifest = {
+        'product_id': product_id,
+        'source': os.path.basename(tar_path),
+        'source_size': os.path.getsize(tar_path),
+        'extracted_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'bands': list(bands),
+        'members': members,
+        'skipped_members': skipped,
+        'missing': missing,
+    }
+    with open(os.path.join(partial_folder, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.rename(partial_folder, bands_folder)
+    os.makedirs(os.path.join(scene_folder, ndvi_folder_name), exist_ok=True)
+
+    print(f'{scene_folder}: {len(members)} members extracted, {skipped} skipped')
+    return scene_folder
+
+
+def virtual_path(tar_path, member_name):
+    """
+    Returns the GDAL path of a member of a tar, e.g. '/vsitar//data/scene.tar/scene_SR_B4.TIF'.
+    """
+    return f'{VSITAR_PREFIX}{os.path.abspath(tar_path)}/{member_name}'
+
+
+def split_virtual_path(path):
+    """
+    Splits a '/vsitar/' path into the path of the tar and the member name, or returns None for any other path.
+    """
+    if not path.startswith(VSITAR_PREFIX):
+        return None
+
+    archive_path = path[len(VSITAR_PREFIX):]
+    end = archive_path.lower().find(ARCHIVE_EXTENSION + '/')
+    if end < 0:
+        return None
+    end += len(ARCHIVE_EXTENSION)
+    return archive_path[:end], archive_path[end + 1:]
+
+
+def scan_archive(tar_path):
+    """
+    Reads the member headers of an uncompressed tar and returns its regular members as
+    `[{'name': ..., 'size': ..., 'offset': ...}]`, `offset` being the position of the member data in the file.
+
+    Raises:
+        IngestError: When the tar is compressed or truncated, or a member does not fit in the file.
+    """
+    archive_size = os.path.getsize(tar_path)
+    members = []
+    try:
+        # Only uncompressed tars can be read in place, by GDAL or by offset
+        with tarfile.open(tar_path, 'r:') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if member.offset_data + member.size > archive_size:
+                    raise IngestError(f'{member.name}: {member.size} bytes declared, the archive is truncated')
+                members.append({'name': os.path.basename(member.name), 'size': member.size,
+                                'offset': member.offset_data})
+    except (tarfile.TarError, EOFError) as e:
+        raise IngestError(f'{tar_path}: {e}') from e
+
+    return members
+
+
+def archive_index(tar_path):
+    """
+    Returns the `{member name: {'name', 'size', 'offset'}}` index of an archived scene. The index is read from the
+    manifest written by archive_scene when it matches the archive, otherwise the member headers are scanned, and it is
+    kept in memory until the archive changes.
+    """
+    real_path = os.path.realpath(tar_path)
+    stat = os.stat(real_path)
+    key = (real_path, stat.st_mtime_ns, stat.st_size)
+
+    with _archive_index_cache_lock:
+        index = _archive_index_cache.get(key)
+    if index is not None:
+        return index
+
+    manifest = read_manifest(os.path.dirname(real_path))
+    if (manifest is not None and manifest.get('archive') == os.path.basename(real_path)
+            and manifest.get('source_size') == stat.st_size):
+        members = manifest['members']
+    else:
+        members = scan_archive(real_path)
+    index = {member['name']: member for member in members}
+
+    with _archive_index_cache_lock:
+        for stale_key in [cached for cached in _archive_index_cache if cached[0] == real_path]:
+            del _archive_index_cache[stale_key]
+        _archive_index_cache[key] = index
+
+    return index
+
+
+def archive_members(tar_path, pattern):
+    """
+    Returns the virtual paths of the members of an archived scene whose name matches a glob pattern, e.g. '*.TIF'.
+    """
+    return [virtual_path(tar_path, name) for name in sorted(archive_index(tar_path))
+            if fnmatch.fnmatchcase(name, pattern)]
+
+
+def read_member(path):
+    """
+    Returns the content of a '/vsitar/' member, read at its indexed offset, e.g. the MTL file of an archived scene.
+    """
+    tar_path, member_name = split_virtual_path(path)
+    member = archive_index(tar_path).get(member_name)
+    if member is None:
+        raise FileNotFoundError(path)
+
+    with open(tar_path, 'rb') as archive:
+        archive.seek(member['offset'])
+        return archive.read(member['size'])
+
+
+def archive_scene(tar_path, protected_area_dir, bands_folder_name, ndvi_folder_name, bands=None):
+    """
+    Zero-extraction alternative to extract_scene: the bundle is checked and moved, as it is, to the bands folder of its
+    date, and the pipeline reads its members through GDAL '/vsitar/' paths (see get_filelist):
+
+        <protected area>/<YYYY-MM-DD-LC08>/<bands folder>/<product id>.tar
+        <protected area>/<YYYY-MM-DD-LC08>/<bands folder>/ingest_manifest.json
+        <protected area>/<YYYY-MM-DD-LC08>/<ndvi folder>/
+
+    The manifest holds the member index (name, size and data offset) of the archive. A date whose bands folder already
+    exists is skipped and the bundle is left where it is.
+
+    Returns:
+        str: The date folder, or None when the date was already ingested.
+
+    Raises:
+        IngestError: When the bundle is compressed or truncated.
+    """
+    if bands is None:
+        bands = settings.INGEST_BANDS
+
+    product_id = os.path.basename(tar_path).split('.')[0]
+    scene_folder = os.path.join(protected_area_dir, scene_folder_name(product_id))
+    bands_folder = os.path.join(scene_folder, bands_folder_name)
+    if os.path.exists(bands_folder):
+        print(f'{scene_folder} already ingested, skipping {os.path.basename(tar_path)}')
+        return None
+
+    members = scan_archive(tar_path)
+    names = [member['name'] for member in members]
+    missing = [f'B{band}' for band in bands if not any(name.upper().endswith(f'_B{band}.TIF') for name in names)]
+    if not any(QA_PIXEL_MEMBER.search(name) for name in names):
+        missing.append('QA_PIXEL')
+    if not any(MTL_MEMBER.search(name) for name in names):
+        missing.append('MTL')
+    if missing:
+        print(f'{product_id}: not in the bundle: {", ".join(missing)}')
+
+    archive_name = product_id + ARCHIVE_EXTENSION
+    manifest = {
+        'product_id': product_id,
+        'source': os.path.basename(tar_path),
+        'source_size': os.path.getsize(tar_path),
+        'extracted_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'archive': archive_name,
+        'bands': list(bands),
+        'members': members,
+        'skipped_members': 0,
+        'missing': missing,
+    }
+
+    partial_folder = bands_folder + '.part'
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    os.makedirs(partial_folder)
+    with open(os.path.join(partial_folder, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    shutil.move(tar_path, os.path.join(partial_folder, archive_name))
+
+    os.rename(partial_folder, bands_folder)
+    os.makedirs(os.path.join(scene_folder, ndvi_folder_name), exist_ok=True)
+
+    print(f'{scene_folder}: archived, {len(members)} members indexed')
+    return scene_folder
@@ -0,0 +1,108 @@
+# Standard library imports
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+# Third-party library imports
+from rasterio.shutil import delete
+from send2trash import send2trash
+
+# External library imports
+
+# Project-specific library imports
+from ingest import split_virtual_path
+import settings
+
+STORAGE_MODES = ('memory', 'scratch', 'disk')
+
+
+class IntermediateStore:
+    """
+    Storage of the intermediate rasters of one scene (clipped, affined and reflectance bands), released when the scene
+    finishes so only the deliverable products reach persistent disk.
+
+    Modes:
+        memory: GDAL in-memory files (/vsimem/, the storage behind rasterio.MemoryFile).
+        scratch: a temporary folder under SCRATCH_DIR, removed on close.
+        disk: files next to their input, each input trashed once it is consumed, as the pipeline always did. Inputs
+            read from an archive ('/vsitar/' paths) are never trashed and their intermediates go next to the archive.
+
+    Use it as a context manager:
+
+        with IntermediateStore() as store:
+            clipped_list = clip_raster_on_mask(shapes, tif_list, store)
+    """
+
+    def __init__(self, mode=None, scratch_dir=None):
+        if mode is None:
+            mode = settings.INTERMEDIATE_STORAGE
+        if mode not in STORAGE_MODES:
+            raise ValueError(f'Unknown intermediate storage {mode!r}, choose one of {STORAGE_MODES}')
+
+        self.mode = mode
+        self._owned = set()
+        self._lock = threading.Lock()
+
+        if mode == 'memory':
+            self.root = f'/vsimem/{uuid.uuid4().hex}'
+        elif mode == 'scratch':
+            self.root = tempfile.mkdtemp(prefix='scene-', dir=scratch_dir or settings.SCRATCH_DIR or None)
+        else:
+            self.root = None
+
+    def path(self, source_path, suffix):
+        """
+        Returns the path of the intermediate derived from `source_path`, named like it with `suffix` before the
+        extension, e.g. 'B4.TIF' -> 'B4_mask.TIF'.
+        """
+        name = suffix.join(os.path.splitext(os.path.basename(source_path)))
+        if self.root is None:
+            archive = split_virtual_path(source_path)
+            folder = os.path.dirname(archive[0] if archive is not None else source_path)
+            path = os.path.join(folder, name)
+        else:
+            path = f'{self.root}/{name}'
+
+        with self._lock:
+            self._owned.add(path)
+        return path
+
+    def release(self, path):
+        """
+        Frees an input once it is consumed. Intermediates of the store are deleted; in 'disk' mode any input is
+        trashed, including the downloaded bands, while the other modes leave inputs they do not own untouched.
+        """
+        with self._lock:
+            owned = path in self._owned
+            self._owned.discard(path)
+
+        if self.mode == 'disk':
+            if split_virtual_path(path) is None:
+                send2trash(path)
+        elif owned:
+            delete(path)
+
+    def close(self):
+        """
+        Deletes every intermediate still held by the store.
+        """
+        with self._lock:
+            owned, self._owned = self._owned, set()
+
+        if self.mode == 'memory':
+            for path in owned:
+                try:
+                    delete(path)
+                except Exception:
+                    # Never written, or already deleted
+                    continue
+        elif self.mode == 'scratch':
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
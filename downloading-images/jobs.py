@@ -0,0 +1,415 @@
+# Standard library imports
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+
+# Status of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# Seconds an idle worker waits before looking for jobs queued by another process
+POLL_INTERVAL = 5
+
+# Seconds between the heartbeats of a worker process, and seconds without one after which its jobs are lost
+HEARTBEAT_INTERVAL = 10
+WORKER_LEASE = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    progress REAL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+);
+"""
+
+# Columns added to the jobs table after its first version, with their definition
+MIGRATIONS = {
+    'coalesce_key': 'TEXT',
+    'submissions': 'INTEGER NOT NULL DEFAULT 1',
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_coalesce_key ON jobs (coalesce_key, status);
+"""
+
+# Events of the jobs, in the order they happened: 'stage', the records emitted by the runners ('date'...), and a last
+# 'succeeded' or 'failed' event. A job queued again after its worker died gets a 'restarted' event
+EVENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, seq);
+"""
+
+# Worker processes, by their token, see process_token. A job is owned by the token of the process running it, so a
+# process restarted with the same PID, as PID 1 of a container is, does not own the jobs of the previous one
+WORKERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    token TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    heartbeat_at REAL NOT NULL
+);
+"""
+
+_process_token = None
+_process_token_pid = None
+
+
+def now():
+    return datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+
+
+def process_alive(pid):
+    """
+    Returns whether a process of this host is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_token():
+    """
+    Returns the token of this process, unique across restarts and forks: '<host>:<pid>:<random hex>'.
+    """
+    global _process_token, _process_token_pid
+
+    # A forked process inherits the token of its parent
+    if _process_token is None or _process_token_pid != os.getpid():
+        _process_token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        _process_token_pid = os.getpid()
+    return _process_token
+
+
+class JobQueue:
+    """
+    Persistent job queue in a local SQLite database. A job goes from 'queued' to 'running' when a worker claims it,
+    then to 'succeeded' with its result or 'failed' with its error, and keeps its current stage and progress while it
+    runs. The queue survives restarts: the jobs of a worker process that died, or stopped sending heartbeats, are queued
+    again, see recover.
+
+    Every call opens its own connection, so the queue can be shared by threads and by the processes of a server.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+            columns = [row['name'] for row in connection.execute('PRAGMA table_info(jobs)')]
+            for column, definition in MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+            connection.executescript(INDEXES)
+            connection.executescript(EVENTS_SCHEMA)
+            connection.executescript(WORKERS_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Autocommit connection, transactions are explicit
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, kind, payload, coalesce_key=None):
+        """
+        Adds a job and returns its ID. A job submitted with the `coalesce_key` of a queued or running job is not
+        added: the submission attaches to that job, which gives its result to every submitter. A running job whose
+        worker is not live is queued again first, see recover, so no submission waits on a job nobody runs.
+
+        Args:
+            kind (str): Name of the runner of the job, see JobWorkers.
+            payload (dict): JSON serializable arguments of the job.
+            coalesce_key (str): Identity of the work of the job, None to never coalesce it.
+
+        Returns:
+            tuple: The job ID and whether the submission was attached to an in-flight job.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = None
+                if coalesce_key is not None:
+                    # A running job of a dead worker is queued again before the submission attaches to it
+                    running = connection.execute('SELECT id, owner FROM jobs WHERE coalesce_key = ? AND status = ?',
+                                                 (coalesce_key, RUNNING)).fetchall()
+                    self._requeue_lost(connection, running)
+                    row = connection.execute('SELECT id FROM jobs WHERE coalesce_key = ? AND status IN (?, ?) '
+                                             'ORDER BY created_at LIMIT 1', (coalesce_key, QUEUED, RUNNING)).fetchone()
+
+                if row is not None:
+                    job_id = row['id']
+                    connection.execute('UPDATE jobs SET submissions = submissions + 1 WHERE id = ?', (job_id,))
+                else:
+                    job_id = uuid.uuid4().hex
+                    connection.execute('INSERT INTO jobs (id, kind, status, payload, coalesce_key, created_at) '
+                                       'VALUES (?, ?, ?, ?, ?, ?)',
+                                       (job_id, kind, QUEUED, json.dumps(payload), coalesce_key, now()))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return job_id, row is not None
+
+    def claim(self):
+        """
+        Marks the oldest queued job as running by this process and returns it, or returns None when none is queued.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1',
+                                         (QUEUED,)).fetchone()
+                if row is not None:
+                    self._beat(connection)
+                    connection.execute('UPDATE jobs SET status = ?, owner = ?, started_at = ? WHERE id = ?',
+                                       (RUNNING, process_token(), now(), row['id']))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return self.get(row['id']) if row is not None else None
+
+    def _add_event(self, connection, job_id, event, data):
+        connection.execute('INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)',
+                           (job_id, event, json.dumps(data), now()))
+
+    def report(self, job_id, stage, progress=None):
+        """
+        Records the current stage of a running job and, optionally, its progress from 0 to 1. A new stage is also
+        added to the events of the job.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            previous = connection.execute('SELECT stage FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            connection.execute('UPDATE jobs SET stage = ?, progress = ? WHERE id = ?', (stage, progress, job_id))
+            if previous is None or previous['stage'] != stage:
+                self._add_event(connection, job_id, 'stage', {'stage': stage})
+            connection.execute('COMMIT')
+
+    def emit(self, job_id, event, data):
+        """
+        Adds a JSON serializable record to the events of a job, e.g. the result of a date as soon as it is processed.
+        """
+        with self._connect() as connection:
+            self._add_event(connection, job_id, event, data)
+
+    def events(self, job_id, after=0):
+        """
+        Returns the events of a job with a sequence number greater than `after`, as {'seq', 'event', 'data',
+        'created_at'} dicts in order.
+        """
+        with self._connect() as connection:
+            rows = connection.execute('SELECT seq, event, data, created_at FROM job_events '
+                                      'WHERE job_id = ? AND seq > ? ORDER BY seq', (job_id, after)).fetchall()
+        return [dict(row, data=json.loads(row['data'])) for row in rows]
+
+    def finish(self, job_id, result=None, error=None):
+        """
+        Marks a job as succeeded with its JSON serializable result, or as failed with an error message.
+        """
+        status = FAILED if error is not None else SUCCEEDED
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('UPDATE jobs SET status = ?, progress = ?, result = ?, error = ?, finished_at = ? '
+                               'WHERE id = ?',
+                               (status, 1.0 if error is None else None, json.dumps(result), error, now(), job_id))
+            self._add_event(connection, job_id, status, {'result': result} if error is None else {'error': error})
+            connection.execute('COMMIT')
+
+    def _beat(self, connection):
+        connection.execute('INSERT OR REPLACE INTO workers (token, host, pid, heartbeat_at) VALUES (?, ?, ?, ?)',
+                           (process_token(), socket.gethostname(), os.getpid(), time.time()))
+
+    def heartbeat(self):
+        """
+        Records that this process is alive, which keeps the jobs it runs owned by it. The workers without a heartbeat
+        for a while are forgotten.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            self._beat(connection)
+            connection.execute('DELETE FROM workers WHERE heartbeat_at < ?', (time.time() - 10 * WORKER_LEASE,))
+            connection.execute('COMMIT')
+
+    def _live_tokens(self, connection):
+        # The tokens with a recent heartbeat, except those of dead processes of this host: a process of this host
+        # with the PID of this one, but another token, is a previous run of it
+        host, pid = socket.gethostname(), os.getpid()
+        rows = connection.execute('SELECT token, host, pid FROM workers WHERE heartbeat_at >= ?',
+                                  (time.time() - WORKER_LEASE,)).fetchall()
+        live = {process_token()}
+        for row in rows:
+            if row['host'] != host or (row['pid'] != pid and process_alive(row['pid'])):
+                live.add(row['token'])
+        return live
+
+    def _requeue_lost(self, connection, rows):
+        # Queues again the running jobs of `rows` not owned by a live worker, returns their IDs
+        live = self._live_tokens(connection)
+        lost = [row['id'] for row in rows if row['owner'] not in live]
+        for job_id in lost:
+            connection.execute('UPDATE jobs SET status = ?, owner = NULL, started_at = NULL WHERE id = ? '
+                               'AND status = ?', (QUEUED, job_id, RUNNING))
+            self._add_event(connection, job_id, 'restarted', {})
+        return lost
+
+    def recover(self):
+        """
+        Queues again the running jobs whose worker process is gone: not owned by the token of a process with a recent
+        heartbeat, see process_token.
+
+        Returns:
+            int: The number of jobs queued again.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute('SELECT id, owner FROM jobs WHERE status = ?', (RUNNING,)).fetchall()
+            lost = self._requeue_lost(connection, rows)
+            connection.execute('COMMIT')
+        return len(lost)
+
+    def get(self, job_id):
+        """
+        Returns a job as a dict: {'id', 'kind', 'status', 'stage', 'progress', 'payload', 'result', 'error',
+        'coalesce_key', 'submissions', 'created_at', 'started_at', 'finished_at'}, or None when there is no such job.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        del job['owner']
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+
+class JobWorkers:
+    """
+    Fixed number of background threads running the jobs of a JobQueue. A job of kind `kind` is run as
+    `runners[kind](payload, report, emit)`, where `report(stage, progress=None)` records its progress and
+    `emit(event, data)` adds a record to its events; its return value is the job result and an exception fails the
+    job. Another thread sends the heartbeats of the process and queues again the jobs of the workers that died.
+
+        workers = JobWorkers(queue, {'processing': run_processing_job}, 2)
+        workers.start()
+        job_id, coalesced = queue.enqueue('processing', payload)
+        workers.notify()
+    """
+
+    def __init__(self, queue, runners, count):
+        self.queue = queue
+        self.runners = runners
+        self.count = max(count, 1)
+        self.threads = []
+        self._wakeup = threading.Condition()
+        self._pending = 0
+
+    def start(self):
+        self.queue.heartbeat()
+        self.recover()
+
+        for i in range(self.count):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        thread = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def recover(self):
+        recovered = self.queue.recover()
+        if recovered:
+            print(f'{recovered} interrupted jobs queued again')
+            self.notify()
+
+    def _beat(self):
+        # Keeps the jobs of this process owned by it, and takes over those of the processes that died
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.queue.heartbeat()
+                self.recover()
+            except sqlite3.Error as error:
+                print(f'Job heartbeat failed: {error!r}')
+
+    def notify(self):
+        """
+        Wakes an idle worker up after a job was queued.
+        """
+        with self._wakeup:
+            self._pending += 1
+            self._wakeup.notify()
+
+    def _work(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                with self._wakeup:
+                    if not self._pending:
+                        self._wakeup.wait(POLL_INTERVAL)
+                    self._pending = max(self._pending - 1, 0)
+                continue
+            self.run(job)
+
+    def run(self, job):
+        job_id = job['id']
+        print(f'Job {job_id} ({job["kind"]}) started')
+
+        def report(stage, progress=None):
+            self.queue.report(job_id, stage, progress)
+
+        def emit(event, data):
+            self.queue.emit(job_id, event, data)
+
+        try:
+            runner = self.runners[job['kind']]
+            result = runner(job['payload'], report, emit)
+        except Exception as error:
+            traceback.print_exc()
+            self.queue.finish(job_id, error=f'{type(error).__name__}: {error}')
+            print(f'Job {job_id} failed: {error!r}')
+        else:
+            self.queue.finish(job_id, result=result)
+            print(f'Job {job_id} succeeded')
@@ -0,0 +1,208 @@
+# Standard library imports
+
+# Third-party library imports
+import numpy as np
+
+# External library imports
+
+# Project-specific library imports
+import settings
+
+
+class KernelBackend:
+    """
+    Set of raster arithmetic kernels. Every kernel writes into a preallocated floating `out` array and returns it.
+
+    Kernels:
+        ndvi(red, nir, out): (nir - red) / (nir + red), NaN where nir + red is 0.
+        rescale(arr, gain, offset, divisor, invalid, out): (gain * arr + offset) / divisor, NaN where `invalid`.
+        forest_threshold(ndvi, threshold): sets the values lower than the threshold, and the 0 values, to NaN in place.
+        fill_nan(current, previous, out): `previous` where `current` is NaN, otherwise `current`.
+    """
+
+    def __init__(self, name, ndvi, rescale, forest_threshold, fill_nan):
+        self.name = name
+        self.ndvi = ndvi
+        self.rescale = rescale
+        self.forest_threshold = forest_threshold
+        self.fill_nan = fill_nan
+
+
+# NumPy reference kernels
+
+def _numpy_ndvi(red, nir, out):
+    # Integer bands would wrap around in the subtraction
+    red, nir = red.astype(out.dtype, copy=False), nir.astype(out.dtype, copy=False)
+    total = np.add(nir, red)
+    np.subtract(nir, red, out=out)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(out, total, out=out)
+    out[total == 0] = np.nan
+    return out
+
+
+def _numpy_rescale(arr, gain, offset, divisor, invalid, out):
+    np.multiply(arr, gain, out=out, casting='same_kind')
+    np.add(out, offset, out=out, casting='same_kind')
+    if divisor != 1:
+        np.divide(out, divisor, out=out, casting='same_kind')
+    out[invalid] = np.nan
+    return out
+
+
+def _numpy_forest_threshold(ndvi, threshold):
+    ndvi[(ndvi < threshold) | (ndvi == 0)] = np.nan
+    return ndvi
+
+
+def _numpy_fill_nan(current, previous, out):
+    np.copyto(out, current, casting='same_kind')
+    nan_mask = np.isnan(current)
+    out[nan_mask] = previous[nan_mask]
+    return out
+
+
+def _numpy_backend():
+    return KernelBackend('numpy', _numpy_ndvi, _numpy_rescale, _numpy_forest_threshold, _numpy_fill_nan)
+
+
+# numexpr kernels, every expression is evaluated in one pass without full-size temporaries
+
+def _numexpr_backend():
+    import numexpr as ne
+
+    # numexpr has no small integer types
+    def as_float(arr, dtype):
+        return arr if arr.dtype.kind == 'f' else arr.astype(dtype)
+
+    def ndvi(red, nir, out):
+        nan = out.dtype.type(np.nan)
+        red, nir = as_float(red, out.dtype), as_float(nir, out.dtype)
+        ne.evaluate('where(nir + red == 0, nan, (nir - red) / (nir + red))', out=out, casting='same_kind')
+        return out
+
+    def rescale(arr, gain, offset, divisor, invalid, out):
+        nan = out.dtype.type(np.nan)
+        arr = as_float(arr, out.dtype)
+        ne.evaluate('where(invalid, nan, (arr * gain + offset) / divisor)', out=out, casting='same_kind')
+        return out
+
+    def forest_threshold(ndvi, threshold):
+        nan = ndvi.dtype.type(np.nan)
+        ne.evaluate('where((ndvi < threshold) | (ndvi == 0), nan, ndvi)', out=ndvi, casting='same_kind')
+        return ndvi
+
+    def fill_nan(current, previous, out):
+        ne.evaluate('where(current != current, previous, current)', out=out, casting='same_kind')
+        return out
+
+    return KernelBackend('numexpr', ndvi, rescale, forest_threshold, fill_nan)
+
+
+# Numba kernels, compiled on first use and run over the flattened arrays
+
+def _numba_backend():
+    import numba
+
+    @numba.njit(cache=True)
+    def _ndvi(red, nir, out):
+        for i in range(out.size):
+            total = nir[i] + red[i]
+            out[i] = np.nan if total == 0 else (nir[i] - red[i]) / total
+
+    @numba.njit(cache=True)
+    def _rescale(arr, gain, offset, divisor, invalid, out):
+        for i in range(out.size):
+            out[i] = np.nan if invalid[i] else (arr[i] * gain + offset) / divisor
+
+    @numba.njit(cache=True)
+    def _forest_threshold(ndvi, threshold):
+        for i in range(ndvi.size):
+            if ndvi[i] < threshold or ndvi[i] == 0:
+                ndvi[i] = np.nan
+
+    @numba.njit(cache=True)
+    def _fill_nan(current, previous, out):
+        for i in range(out.size):
+            out[i] = previous[i] if np.isnan(current[i]) else current[i]
+
+    def flat(arr):
+        return np.ascontiguousarray(arr).reshape(-1)
+
+    def writable(out):
+        if not out.flags.c_contiguous:
+            raise ValueError('The numba kernels need a C-contiguous out array')
+        return out.reshape(-1)
+
+    def ndvi(red, nir, out):
+        red, nir = red.astype(out.dtype, copy=False), nir.astype(out.dtype, copy=False)
+        _ndvi(flat(red), flat(nir), writable(out))
+        return out
+
+    def rescale(arr, gain, offset, divisor, invalid, out):
+        _rescale(flat(arr), gain, offset, divisor, flat(invalid), writable(out))
+        return out
+
+    def forest_threshold(ndvi, threshold):
+        _forest_threshold(writable(ndvi), threshold)
+        return ndvi
+
+    def fill_nan(current, previous, out):
+        _fill_nan(flat(current), flat(previous), writable(out))
+        return out
+
+    return KernelBackend('numba', ndvi, rescale, forest_threshold, fill_nan)
+
+
+_backend_factories = {
+    'numpy': _numpy_backend,
+    'numexpr': _numexpr_backend,
+    'numba': _numba_backend,
+}
+_backends = {}
+
+
+def register_backend(name, factory):
+    """
+    Registers a backend factory, a function returning a KernelBackend. It is called on first use and may raise
+    ImportError when its library is not installed.
+    """
+    _backend_factories[name] = factory
+    _backends.pop(name, None)
+
+
+def available_backends():
+    """
+    Returns the names of the backends whose libraries are installed.
+    """
+    names = []
+    for name in _backend_factories:
+        try:
+            get_backend(name, fallback=False)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_backend(name=None, fallback=True):
+    """
+    Returns a kernel backend, by default the one selected by the KERNEL_BACKEND setting. When its library is not
+    installed the NumPy reference backend is returned, unless `fallback` is False.
+    """
+    if name is None:
+        name = settings.KERNEL_BACKEND
+
+    if name not in _backends:
+        if name not in _backend_factories:
+            raise ValueError(f'Unknown kernel backend {name!r}, choose one of {list(_backend_factories)}')
+        try:
+            _backends[name] = _backend_factories[name]()
+        except ImportError:
+            if not fallback:
+                raise
+            print(f'Kernel backend {name!r} is not installed, using numpy')
+            return get_backend('numpy')
+
+    return _backends[name]
+
@@ -1,22 +1,33 @@
 # Standard library imports
 from datetime import date
+import hashlib
 import json
 import os
+import threading
+import time
 
 # Third-party library imports
 from decouple import config
+import fiona
 import geopandas as gpd
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context, url_for
 import folium
 import shapefile
 from pyproj import Proj, transform
+from shapely.errors import ShapelyError
 from shapely.geometry import Polygon
 from pyproj import Transformer
 
 # External library imports
 
 # Project-specific library imports
-from satelliteAPI import LandsatAPI
+from batch import SCENES_FOLDER, ingest_scenes, process_batch, query_footprint
+from geometry import geometry_hash
+from jobs import FAILED, SUCCEEDED, JobQueue, JobWorkers
+from pipeline import date_record
+from result_cache import ResultCache
+from satelliteAPI import LandsatAPI, get_sorted_tif_list, update_area_products
+import settings
 
 
 def replace_spaces_with_underscore(string):
@@ -137,16 +148,125 @@ def custom_encoder(obj):
 
 app = Flask(__name__)
 
+# Seconds between two reads of the events of a running job by /jobs/<id>/events
+EVENTS_POLL_INTERVAL = 0.5
 
-@app.route('/processing', methods=['POST'])
-def handle_post_request():
-    # retrieve data from the request body
-    data = request.get_json()
+# Job queue of the processing requests and its workers, created on first use
+_job_queue = None
+_job_workers = None
+_jobs_lock = threading.Lock()
 
-    # process the data
-    result = process_data(data)
 
-    print(data)
+def get_job_queue():
+    """
+    Returns the job queue, in the JOBS_DB setting or 'jobs.sqlite3' in the landsat directory.
+    """
+    global _job_queue
+    with _jobs_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(settings.JOBS_DB or os.path.join(config('LANDSAT_DIR'), 'jobs.sqlite3'))
+        return _job_queue
+
+
+def get_job_workers():
+    """
+    Returns the job workers, starting them on first use. The jobs interrupted by a previous run are queued again.
+    """
+    global _job_workers
+    queue = get_job_queue()
+    with _jobs_lock:
+        if _job_workers is None:
+            _job_workers = JobWorkers(queue, {'processing': run_processing_job, 'batch': run_batch_job},
+                                      settings.JOB_WORKERS)
+            _job_workers.start()
+        return _job_workers
+
+
+# Serialized results of the protected areas, see result_key
+result_cache = ResultCache(settings.RESULT_CACHE_SIZE * 1024 * 1024, settings.RESULT_CACHE_MAX_AGE)
+
+# Last requested area of every protected area ID, the fields of its result key
+result_areas = {}
+
+
+def latest_scene_date(protected_area_name):
+    """
+    Returns the name of the latest date folder ingested for a protected area, or '' when it has none.
+    """
+    protected_area_dir = os.path.join(config('LANDSAT_DIR'), protected_area_name)
+    if not os.path.isdir(protected_area_dir):
+        return ''
+    protected_area_dates = get_sorted_tif_list(protected_area_dir, config('DEFORESTATION_FOLDER'))
+    return os.path.basename(protected_area_dates[-1]) if protected_area_dates else ''
+
+
+def result_key(area):
+    """
+    Returns the result cache key of a protected area of a request: its ID, the hash of its footprint and its latest
+    ingested scene date, so a new scene or a new footprint gives a new key.
+    """
+    return f"{processing_key(area)}:{latest_scene_date(area['name'])}"
+
+
+def cache_result(area, result):
+    """
+    Stores the result of a protected area in the result cache, with the RESULT_CACHE setting.
+    """
+    if settings.RESULT_CACHE:
+        result_areas.setdefault(str(area['idInteger']), area)
+        result_cache.put(result_key(area), result, str(area['idInteger']))
+
+
+def cached_result(area):
+    """
+    Returns the cached result of a protected area for its current key, see result_key, or None when there is none: a
+    newly ingested scene or another footprint is a cache miss.
+    """
+    if not settings.RESULT_CACHE:
+        return None
+    return result_cache.get(result_key(area))
+
+
+def cached_response(entry):
+    """
+    Returns the response of a cached result: 304 Not Modified when the request already has its ETag
+    (If-None-Match), the result otherwise.
+    """
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def processing_key(area):
+    """
+    Returns the identity of the work of a protected area of a request, its ID, the hash of its footprint and the date
+    its composite is rebuilt from, if any, so the concurrent requests for the same area share one job.
+    """
+    footprint = json.loads(area['geoJson'])
+    key = f"{area['idInteger']}:{geometry_hash([{'type': 'Polygon', 'coordinates': footprint}])}"
+    if area.get('rebuildFrom'):
+        key += f":rebuild:{area['rebuildFrom']}"
+    return key
+
+
+def run_processing_job(data, report, emit):
+    """
+    Processes the protected area of a /processing request: creates its folders and shapefile, downloads its scenes and
+    computes its forest cover. Runs in a job worker, see jobs.JobWorkers; every date is emitted as a 'date' event as
+    soon as it is processed.
+
+    Args:
+        data (dict): Body of the request.
+        report (function): Records the stage of the job, report(stage, progress=None).
+        emit (function): Adds a record to the events of the job, emit(event, data).
+
+    Returns:
+        dict: The forest cover of the protected area, with the same fields as an area of run_batch_job.
+    """
     protected_area_id = data['data']['idInteger']
     protected_area_name = data['data']['name']
     protected_area_photo = data['data']['photo']
@@ -181,6 +301,7 @@ def handle_post_request():
     ndvi_folder = config('NDVI_FOLDER')
     deforestation_folder = config('DEFORESTATION_FOLDER')
 
+    report('preparing')
     protected_area_dir = create_folder(protected_area_name, landsat_dir)
     protected_area_deforestation_dir = create_folder(deforestation_folder, protected_area_dir)
     protected_area_shape_dir, protected_area_total_extension = create_shapefile(footprint, protected_area_name,
@@ -189,39 +310,271 @@ def handle_post_request():
     # geojson_path = save_geojson_to_folder(geojson_path, protected_area_dir, protected_area_name)
     #footprint = get_footprint(geojson_path)
 
+    report('downloading')
     api = LandsatAPI(username, password, chromedriver_path, downloads_dir, protected_area_dir,
                      protected_area_deforestation_dir)
     api.query(chromedriver_path, downloads_dir, footprint, 10)
-    '''forest_cover = api.processing(protected_area_name, protected_area_total_extension, protected_area_dir,
-                                  footprint, protected_area_shape_dir, bands_folder, ndvi_folder, deforestation_folder)
-
-    forest_cover.protected_area_name = config('PROTECTED_AREA')
-    forest_cover.photo = 'photo'
-    forest_cover.description = 'description'
-    forest_cover.footprint = footprint
-
-    # Custom encoder function for date objects
-
-    # Create a dictionary with the attributes and their values
-    forest_cover_dict = {
-        "protected_area_name": forest_cover.protected_area_name,
-        "photo": forest_cover.photo,
-        "description": forest_cover.description,
-        "footprint": forest_cover.footprint,
-        "last_detection_date": forest_cover.last_detection_date,
-        "total_extension_protected_area": forest_cover.total_extension_protected_area,
-        "detection_date_list": forest_cover.detection_date_list,
-        "total_extension_forest_cover_list": forest_cover.total_extension_forest_cover_list
+
+    def on_date(protected_area_date, date_result):
+        emit('date', date_record(protected_area_date, ndvi_folder + '_folder', date_result))
+
+    report('processing')
+    forest_cover = api.processing(protected_area_name, protected_area_total_extension, footprint, protected_area_dir,
+                                  protected_area_shape_dir, bands_folder, ndvi_folder, deforestation_folder,
+                                  on_date=on_date, rebuild_from=data['data'].get('rebuildFrom'))
+
+    result = {
+        'id': protected_area_id,
+        'name': protected_area_name,
+        'photo': protected_area_photo,
+        'description': protected_area_description,
+        'country': protected_area_country,
+        'footprint': footprint,
+        'protected_area_dir': protected_area_dir,
+        'last_detection_date': custom_encoder(forest_cover.last_detection_date),
+        'total_extension_protected_area': forest_cover.total_extension_protected_area,
+        'scene_dates': forest_cover.scene_dates,
+        'cloud_fraction_list': forest_cover.cloud_fraction_list,
+        'detection_date_list': forest_cover.detection_date_list,
+        'total_extension_forest_cover_list': forest_cover.total_extension_forest_cover_list,
+        'forest_loss_list': forest_cover.forest_loss_list,
+        'forest_gain_list': forest_cover.forest_gain_list,
     }
+    cache_result(data['data'], result)
+    return result
 
-    # Convert dictionary to a JSON string using the custom encoder
-    forest_cover_json = json.dumps(forest_cover_dict, default=custom_encoder)
 
-    # Print the JSON string
-    print(forest_cover_json)'''
+def run_batch_job(data, report, emit):
+    """
+    Processes the protected areas of a /processing/batch request together. The scenes of every area are queried at
+    once and downloaded to the shared downloads directory, skipping the scenes already downloaded or ingested, then
+    ingested once and decoded once for all the areas they cover, see batch.process_batch. Runs in a job worker; every
+    date is emitted as a 'date' event, with the ID of its area, as soon as it is processed.
 
-    # return the result as JSON
-    return jsonify(result)
+    Returns:
+        dict: {'areas': [...]}, the forest cover of every area, in the order of the request.
+    """
+    # USGS website
+    username = config('USERNAME')
+    password = config('PASSWORD')
+
+    # chromedriver path
+    chromedriver_path = config('CHROMEDRIVER_PATH')
+
+    # download and landsat directories
+    downloads_dir = config('DOWNLOADS_DIR')
+    landsat_dir = config('LANDSAT_DIR')
+
+    # folders name
+    bands_folder = config('BANDS_FOLDER')
+    ndvi_folder = config('NDVI_FOLDER')
+    deforestation_folder = config('DEFORESTATION_FOLDER')
+
+    # the scenes of every area are queried at once, skipping those already ingested for another request
+    report('downloading')
+    scenes_dir = os.path.join(landsat_dir, SCENES_FOLDER)
+    footprints = [json.loads(area['geoJson']) for area in data['areas']]
+    api = LandsatAPI(username, password, chromedriver_path, downloads_dir, landsat_dir, None)
+    api.query(chromedriver_path, downloads_dir, query_footprint(footprints), 10, scenes_dir)
+
+    areas = []
+    for area, footprint in zip(data['areas'], footprints):
+        protected_area_dir = create_folder(area['name'], landsat_dir)
+        protected_area_deforestation_dir = create_folder(deforestation_folder, protected_area_dir)
+        protected_area_shape_dir, protected_area_total_extension = create_shapefile(footprint, area['name'],
+                                                                                    protected_area_dir)
+
+        with fiona.open(protected_area_shape_dir, 'r') as protected_area_src:
+            shapes = [feature['geometry'] for feature in protected_area_src]
+            crs = protected_area_src.crs_wkt
+
+        areas.append({
+            'protected_area_dir': protected_area_dir,
+            'protected_area_deforestation_dir': protected_area_deforestation_dir,
+            'total_extension_protected_area': protected_area_total_extension,
+            'shapes': shapes,
+            'crs': crs,
+        })
+
+    # every scene is ingested and decoded once
+    report('processing')
+    scene_dates = ingest_scenes(downloads_dir, scenes_dir, bands_folder, ndvi_folder + '_folder')
+    area_ids = {os.path.normpath(area['protected_area_dir']): request_area['idInteger']
+                for request_area, area in zip(data['areas'], areas)}
+
+    def on_date(protected_area_date, result):
+        record = date_record(protected_area_date, ndvi_folder + '_folder', result)
+        emit('date', dict(record, id=area_ids[os.path.dirname(os.path.normpath(protected_area_date))]))
+
+    area_results = process_batch(areas, scene_dates, bands_folder, ndvi_folder + '_folder', on_date=on_date)
+
+    results = []
+    for i, (request_area, area, date_results) in enumerate(zip(data['areas'], areas, area_results)):
+        report('compositing', i / len(areas))
+        protected_area_dates = get_sorted_tif_list(area['protected_area_dir'], deforestation_folder)
+        steps = update_area_products(area['protected_area_dir'], area['protected_area_deforestation_dir'],
+                                     protected_area_dates, bands_folder, ndvi_folder + '_folder',
+                                     request_area.get('rebuildFrom'))
+        results.append({
+            'id': request_area['idInteger'],
+            'name': request_area['name'],
+            'protected_area_dir': area['protected_area_dir'],
+            'total_extension_protected_area': area['total_extension_protected_area'],
+            'scene_dates': [os.path.basename(protected_area_date) for protected_area_date, _ in date_results],
+            'cloud_fraction_list': [cloud_fraction for _, (_, _, cloud_fraction) in date_results],
+            'detection_date_list': [step['date'] for step in steps],
+            'total_extension_forest_cover_list': [step['area'] for step in steps],
+            'forest_loss_list': [step['loss_area'] for step in steps],
+            'forest_gain_list': [step['gain_area'] for step in steps],
+        })
+
+    for request_area, result in zip(data['areas'], results):
+        cache_result(request_area, result)
+    return {'areas': results}
+
+
+def invalid_area(area, prefix):
+    """
+    Returns the error message of an invalid area of a request, or None when it is valid.
+    """
+    missing = [key for key in ('idInteger', 'name', 'geoJson') if not isinstance(area, dict) or key not in area]
+    if missing:
+        return f'Missing fields: {", ".join(prefix + key for key in missing)}'
+    if not isinstance(area.get('rebuildFrom', ''), str):
+        return f'Invalid {prefix}rebuildFrom: a date folder name, e.g. 2023-02-18-LC08'
+    try:
+        # The footprint is the coordinates of a polygon, a list of rings
+        if not isinstance(json.loads(area['geoJson']), list):
+            return f'Invalid {prefix}geoJson: the coordinates of a polygon, a list of rings'
+        processing_key(area)
+    except (IndexError, KeyError, TypeError, ValueError, ShapelyError) as error:
+        return f'Invalid {prefix}geoJson: {error}'
+    return None
+
+
+def submit_job(kind, data, key):
+    """
+    Queues a job, or attaches the request to the in-flight job with the same key, and returns the 202 response.
+    """
+    job_id, coalesced = get_job_queue().enqueue(kind, data, key)
+    # A coalesced job may have been queued again after its worker died
+    get_job_workers().notify()
+
+    job = get_job_queue().get(job_id)
+    status_url = url_for('get_job', job_id=job_id)
+    return (jsonify({'job_id': job_id, 'status': job['status'], 'coalesced': coalesced, 'status_url': status_url}),
+            202, {'Location': status_url})
+
+
+@app.route('/processing', methods=['POST'])
+def handle_post_request():
+    # retrieve data from the request body
+    data = request.get_json(silent=True)
+    print(data)
+
+    error = invalid_area((data or {}).get('data'), 'data.')
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    # An area whose result is cached with its current footprint and scenes is not processed again
+    entry = cached_result(data['data'])
+    if entry is not None:
+        return cached_response(entry)
+
+    # The area is processed in the background, the job is followed at /jobs/<id>. A request for an area that is
+    # already queued or processing attaches to its job. Its forest cover is the job result, also served with its ETag
+    # by /forest-cover/<id> once the job succeeded
+    result_areas[str(data['data']['idInteger'])] = data['data']
+    return submit_job('processing', data, processing_key(data['data']))
+
+
+@app.route('/processing/batch', methods=['POST'])
+def handle_batch_request():
+    """
+    Queues the processing of several protected areas, {'areas': [<area>, ...]} with the fields of the 'data' of a
+    /processing request. The scenes shared by the areas are downloaded and decoded once. An area with a 'rebuildFrom'
+    date folder name has its forest cover composite rebuilt from that date.
+    """
+    data = request.get_json(silent=True)
+    areas = (data or {}).get('areas')
+    if not isinstance(areas, list) or not areas:
+        return jsonify({'error': 'Missing fields: areas'}), 400
+
+    for i, area in enumerate(areas):
+        error = invalid_area(area, f'areas[{i}].')
+        if error is not None:
+            return jsonify({'error': error}), 400
+
+    for area in areas:
+        result_areas[str(area['idInteger'])] = area
+
+    key = 'batch:' + hashlib.sha256(' '.join(sorted(processing_key(area) for area in areas)).encode()).hexdigest()
+    return submit_job('batch', data, key)
+
+
+@app.route('/forest-cover/<area_id>', methods=['GET'])
+def get_forest_cover(area_id):
+    """
+    Returns the result of a protected area from the result cache, with its ETag; 304 when the request already has it
+    (If-None-Match), 404 when it is not cached for the footprint last requested and the scenes ingested since.
+    """
+    area = result_areas.get(area_id)
+    entry = cached_result(area) if area is not None else None
+    if entry is None:
+        return jsonify({'error': f'No cached result for protected area {area_id}, POST it to /processing'}), 404
+    return cached_response(entry)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Returns the status, stage, progress and result of a job.
+    """
+    # Starts the workers of a fresh process, to resume the queued jobs
+    get_job_workers()
+
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    del job['payload']
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """
+    Streams the events of a job as they happen, until it succeeds or fails: its stages, a 'date' record for every
+    processed date ({'date', 'forest_area', 'cloud_fraction', 'products'}) and its result. The stream is NDJSON, one
+    {'seq', 'event', 'data', 'created_at'} object per line, or Server-Sent Events when the client accepts
+    text/event-stream. A client resumes after the last event it got with ?after=<seq> or the Last-Event-ID header.
+    """
+    queue = get_job_queue()
+    if queue.get(job_id) is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    get_job_workers()
+
+    server_sent = 'text/event-stream' in request.headers.get('Accept', '')
+    try:
+        after = int(request.args.get('after', request.headers.get('Last-Event-ID', 0)))
+    except ValueError:
+        return jsonify({'error': 'after must be an event sequence number'}), 400
+
+    def generate(after):
+        while True:
+            finished = queue.get(job_id)['status'] in (SUCCEEDED, FAILED)
+            for event in queue.events(job_id, after):
+                after = event['seq']
+                if server_sent:
+                    yield f"id: {event['seq']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+                else:
+                    yield json.dumps(event) + '\n'
+            if finished:
+                return
+            time.sleep(EVENTS_POLL_INTERVAL)
+
+    mimetype = 'text/event-stream' if server_sent else 'application/x-ndjson'
+    return Response(stream_with_context(generate(after)), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 def process_data(data):
@@ -0,0 +1,142 @@
+# Standard library imports
+
+# Third-party library imports
+import numpy as np
+
+# External library imports
+
+# Project-specific library imports
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype='uint8')
+
+
+class PackedMask:
+    """
+    Boolean raster packed 8 pixels per byte along the rows (np.packbits), 1/8 of a bool array and 1/64 of a float64
+    raster. The bits past the last column of each row are always 0, so counts and bitwise operations work on whole
+    bytes.
+
+    Attributes:
+        bits (ndarray): uint8 array of shape (rows, ceil(cols / 8)).
+        shape (tuple): (rows, cols) of the raster.
+    """
+
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_array(cls, mask):
+        """
+        Packs a 2D boolean array.
+        """
+        return cls(np.packbits(mask, axis=-1), mask.shape)
+
+    @classmethod
+    def zeros(cls, shape):
+        return cls(np.zeros((shape[0], (shape[1] + 7) // 8), dtype='uint8'), shape)
+
+    def to_array(self):
+        """
+        Unpacks the mask to a 2D boolean array.
+        """
+        return np.unpackbits(self.bits, axis=-1, count=self.shape[1]).astype(bool)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f'Mask shape {other.shape} does not match {self.shape}')
+
+    def _row_mask(self):
+        # Bits of the columns inside the raster, the padding bits of the last byte are 0
+        return np.packbits(np.ones(self.shape[1], dtype=bool))
+
+    def __and__(self, other):
+        self._check(other)
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        self._check(other)
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def __xor__(self, other):
+        self._check(other)
+        return PackedMask(self.bits ^ other.bits, self.shape)
+
+    def __invert__(self):
+        return PackedMask(~self.bits & self._row_mask(), self.shape)
+
+    def and_not(self, other):
+        """
+        Returns `self & ~other` without building the complement.
+        """
+        self._check(other)
+        return PackedMask(self.bits & ~other.bits, self.shape)
+
+    def count(self):
+        """
+        Returns the number of set pixels, from a popcount of the packed bytes.
+        """
+        return int(POPCOUNT_TABLE[self.bits].sum(dtype='int64'))
+
+    def area(self, pixel_size):
+        """
+        Returns the area in hectares of the set pixels, `pixel_size` being the area of a pixel in square meters.
+        """
+        return self.count() * pixel_size / 10000
+
+
+class ForestMasks:
+    """
+    Forest state of a date as two packed planes:
+
+        forest: pixels classified as forest.
+        valid: pixels with a clear observation; the others (outside the area, clouds, fill) are nodata and never
+            counted as forest, loss or gain.
+    """
+
+    def __init__(self, forest, valid):
+        self.forest = forest
+        self.valid = valid
+
+    @classmethod
+    def from_ndvi(cls, forest_ndvi, ndvi=None):
+        """
+        Builds the planes of a date from its forest NDVI (NaN where not forest) and its NDVI (NaN where there is no
+        observation). Without the NDVI, only the pixels with a forest value are valid.
+        """
+        forest = PackedMask.from_array(forest_ndvi > 0)
+        valid = PackedMask.from_array(~np.isnan(ndvi if ndvi is not None else forest_ndvi))
+        return cls(forest & valid, valid)
+
+    @classmethod
+    def empty(cls, shape):
+        return cls(PackedMask.zeros(shape), PackedMask.zeros(shape))
+
+    @property
+    def nodata(self):
+        return ~self.valid
+
+
+def forest_change(state, current):
+    """
+    Compares the forest state carried over the previous dates with the masks of a new date. Only the pixels observed
+    in both are compared, the others keep their previous state.
+
+    Args:
+        state (ForestMasks): Last observed forest state of every pixel, `valid` where it was ever observed.
+        current (ForestMasks): Masks of the new date.
+
+    Returns:
+        tuple: The loss and gain PackedMasks of the date and the updated ForestMasks state.
+    """
+    observed = state.valid & current.valid
+    loss = (state.forest & observed).and_not(current.forest)
+    gain = (current.forest & observed).and_not(state.forest)
+
+    forest = (current.forest & current.valid) | state.forest.and_not(current.valid)
+    return loss, gain, ForestMasks(forest, state.valid | current.valid)
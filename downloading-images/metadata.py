@@ -0,0 +1,180 @@
+# Standard library imports
+import os
+import re
+import threading
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+from ingest import read_member, split_virtual_path
+
+
+BAND_COEFFICIENT = re.compile(r'^(RADIANCE|REFLECTANCE)_(MULT|ADD)_BAND_(\d+)$')
+
+# Groups holding the reflectance rescaling of each processing level
+SURFACE_REFLECTANCE_GROUP = 'LEVEL2_SURFACE_REFLECTANCE_PARAMETERS'
+
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+
+class LandsatMetadata:
+    """
+    Landsat scene metadata parsed from a `*_MTL.txt` file.
+
+    Attributes:
+        path (str): Path of the MTL file.
+        groups (dict): Raw `{group: {key: value}}` content of the file.
+        product_id (str): Landsat product identifier, e.g. 'LC08_L2SP_009056_20230218_20230223_02_T1'.
+        spacecraft_id (str): Spacecraft, e.g. 'LANDSAT_8'.
+        sensor_id (str): Sensor, e.g. 'OLI_TIRS'.
+        date_acquired (str): Acquisition date as 'YYYY-MM-DD'.
+        sun_elevation (float): Scene center sun elevation angle in degrees.
+        sun_azimuth (float): Scene center sun azimuth angle in degrees.
+        radiance (dict): `{band: (multiplicative, additive)}` radiance rescaling coefficients.
+        reflectance (dict): `{'surface' | 'toa': {band: (multiplicative, additive)}}` reflectance rescaling
+            coefficients of the Level-2 surface reflectance and the Level-1 TOA products.
+    """
+
+    def __init__(self, path, groups):
+        self.path = path
+        self.groups = groups
+
+        self.product_id = self._find('LANDSAT_PRODUCT_ID')
+        self.spacecraft_id = self._find('SPACECRAFT_ID')
+        self.sensor_id = self._find('SENSOR_ID')
+        self.date_acquired = self._find('DATE_ACQUIRED')
+        self.sun_elevation = self._find('SUN_ELEVATION')
+        self.sun_azimuth = self._find('SUN_AZIMUTH')
+
+        radiance = {}
+        reflectance = {'surface': {}, 'toa': {}}
+        for group_name, group in groups.items():
+            level = 'surface' if group_name == SURFACE_REFLECTANCE_GROUP else 'toa'
+            for key, value in group.items():
+                match = BAND_COEFFICIENT.match(key)
+                if match is None:
+                    continue
+                quantity, factor, band = match.group(1), match.group(2), int(match.group(3))
+                coefficients = radiance if quantity == 'RADIANCE' else reflectance[level]
+                multiplicative, additive = coefficients.get(band, (None, None))
+                if factor == 'MULT':
+                    multiplicative = value
+                else:
+                    additive = value
+                coefficients[band] = (multiplicative, additive)
+
+        self.radiance = radiance
+        self.reflectance = reflectance
+
+    def _find(self, key):
+        # Return the first value of `key` in any group
+        for group in self.groups.values():
+            if key in group:
+                return group[key]
+        return None
+
+    def radiance_coefficients(self, band):
+        """
+        Returns the (multiplicative, additive) radiance rescaling coefficients of a band.
+        """
+        return self.radiance[band]
+
+    def reflectance_coefficients(self, band, level=None):
+        """
+        Returns the (multiplicative, additive) reflectance rescaling coefficients of a band.
+
+        Args:
+            band (int): Band number.
+            level (str): 'surface' for the Level-2 surface reflectance scaling or 'toa' for the Level-1 TOA
+                rescaling. By default LC08 scenes use 'surface' and other sensors 'toa', as the processing always did.
+
+        Returns:
+            tuple: The (multiplicative, additive) coefficients.
+        """
+        if level is None:
+            level = 'surface' if self.spacecraft_id == 'LANDSAT_8' else 'toa'
+
+        coefficients = self.reflectance[level]
+        if band not in coefficients:
+            # Level-1 only metadata has no surface reflectance group and the other way around
+            coefficients = self.reflectance['toa' if level == 'surface' else 'surface']
+        return coefficients[band]
+
+
+def parse_value(value):
+    """
+    Converts an MTL value to float when it is numeric, otherwise returns it without quotes.
+    """
+    if value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_mtl(text):
+    """
+    Parses the content of a Landsat MTL file into a `{group: {key: value}}` dictionary.
+    """
+    groups = {}
+    stack = []
+    for line in text.splitlines():
+        line = line.strip()
+        if '=' not in line:
+            continue
+
+        key, value = (part.strip() for part in line.split('=', 1))
+        if key == 'GROUP':
+            stack.append(value)
+            groups.setdefault(value, {})
+        elif key == 'END_GROUP':
+            if stack:
+                stack.pop()
+        else:
+            groups.setdefault(stack[-1] if stack else '', {})[key] = parse_value(value)
+
+    return groups
+
+
+def read_mtl(path):
+    """
+    Reads and parses an MTL file, without caching. '/vsitar/' paths are read from their archive.
+    """
+    if split_virtual_path(path) is not None:
+        return LandsatMetadata(path, parse_mtl(read_member(path).decode()))
+
+    with open(path, 'r') as open_metaLandsat:
+        return LandsatMetadata(path, parse_mtl(open_metaLandsat.read()))
+
+
+def load_metadata(path):
+    """
+    Returns the parsed metadata of an MTL file. The file is parsed once and reused until its modification time
+    changes, the modification time of its archive for '/vsitar/' paths.
+    """
+    archive = split_virtual_path(path)
+    if archive is not None:
+        real_path = path
+        key = (real_path, os.stat(archive[0]).st_mtime_ns)
+    else:
+        real_path = os.path.realpath(path)
+        key = (real_path, os.stat(real_path).st_mtime_ns)
+
+    with _metadata_cache_lock:
+        metadata = _metadata_cache.get(key)
+    if metadata is not None:
+        return metadata
+
+    metadata = read_mtl(path)
+
+    with _metadata_cache_lock:
+        # Drop the entries of previous versions of the same file
+        for stale_key in [cached for cached in _metadata_cache if cached[0] == real_path]:
+            del _metadata_cache[stale_key]
+        _metadata_cache[key] = metadata
+
+    return metadata
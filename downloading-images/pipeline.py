@@ -0,0 +1,367 @@
+# Standard library imports
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import multiprocessing
+import os
+import threading
+
+# Third-party library imports
+import numpy as np
+import rasterio
+from shapely.geometry import mapping, shape
+
+# External library imports
+
+# Project-specific library imports
+import AtmosphericCorrection as ac
+from geometry import geometry_hash, read_cropped
+from intermediates import IntermediateStore
+from metadata import load_metadata
+from NDVI import NDVIProduct, calculate_ndvi, apply_forest_threshold
+from profiles import open_product
+from processing import (get_filelist, select_bands, clip_raster_on_mask, affine_tif, generate_atmospheric_correction,
+                        generate_cloud_mask, clip_qa_band, generate_ndvi)
+from scene_cache import SceneCache, scene_key
+import settings
+
+# Version of the per-scene products, part of the scene cache keys: bump it when a change of the pipeline changes them
+PIPELINE_VERSION = '4'
+
+FUSED_BANDS = [2, 3, 4, 5]  # band list: blue, green, red, NIR
+RED_BAND = 4
+NIR_BAND = 5
+
+
+def read_clipped_band(band_path, shapes):
+    """
+    Reads a band cropped to the shapes. Pixels outside the shapes are filled with the band nodata value (0 when the
+    band has none, the Landsat fill DN).
+
+    Returns:
+        tuple: The band array, its transform, its metadata and its nodata value.
+    """
+    with rasterio.open(band_path) as src:
+        out_image, out_transform = read_cropped(src, shapes, 1)
+        profile = src.meta.copy()
+        nodata = src.nodata if src.nodata is not None else 0
+
+    return out_image, out_transform, profile, nodata
+
+
+def align_to(arr, shape, fill):
+    """
+    Puts a band on the grid of the reference band, as affine_tif does, padding with `fill` or trimming the extra
+    rows and columns.
+    """
+    if arr.shape == shape:
+        return arr
+
+    aligned = np.full(shape, fill, dtype=arr.dtype)
+    height, width = min(shape[0], arr.shape[0]), min(shape[1], arr.shape[1])
+    aligned[:height, :width] = arr[:height, :width]
+    return aligned
+
+
+def process_scene(protected_area_date, bands_folder, ndvi_folder_name, shapes, threshold=0.3, cloud_mask=None,
+                  scene=None):
+    """
+    Fused version of clip_raster_on_mask -> affine_tif -> create_multiband_color_tiff ->
+    generate_atmospheric_correction -> generate_ndvi for one date. The B2-B5 bands are read once, every step runs in
+    memory and only the final products are written:
+
+        <date>/<date>_B2_B3_B4_B5_multiband.TIF
+        <date>/<ndvi folder>/NDVI_mask_clipped.TIF
+        <date>/<ndvi folder>/forest_NDVI_mask_clipped.TIF
+
+    The downloaded bands are left untouched.
+
+    Args:
+        protected_area_date (str): Folder of the date.
+        bands_folder (str): Name of the bands folder.
+        ndvi_folder_name (str): Name of the NDVI folder.
+        shapes (list): Geometries of the protected area.
+        threshold (float): Lowest NDVI value considered forest.
+        cloud_mask (ndarray): Boolean mask of the clipped grid, True where the NDVI is discarded.
+        scene (DecodedScene): Bands of the scene already in memory, clipped instead of the band files, see batch.py.
+
+    Returns:
+        tuple: The forest NDVI filepath and the total forest area in hectares.
+    """
+    if scene is not None:
+        metadata = scene.metadata
+    else:
+        metadata_list = get_filelist(protected_area_date, bands_folder, '*MTL.txt')
+        metadata = load_metadata(metadata_list[0])
+
+    # Clip every band, the red band is the reference grid
+    bands = {}
+    if scene is not None:
+        for band in FUSED_BANDS:
+            bands[band] = scene.clipped_band(band, shapes)
+    else:
+        tif_list = get_filelist(protected_area_date, bands_folder, '*.TIF')
+        band_paths = select_bands(tif_list, FUSED_BANDS)
+        for band, band_path in zip(FUSED_BANDS, band_paths):
+            bands[band] = read_clipped_band(band_path, shapes)
+
+    _, transform, profile, _ = bands[RED_BAND]
+    shape = bands[RED_BAND][0].shape
+    for band, (arr, band_transform, band_profile, nodata) in bands.items():
+        bands[band] = (align_to(arr, shape, nodata), transform, band_profile, nodata)
+
+    profile.update(driver='GTiff', height=shape[0], width=shape[1], transform=transform, count=1,
+                   dtype='float32', nodata=None)
+
+    # Multiband color tiff of the clipped bands
+    name = os.path.basename(protected_area_date) + '_B2_B3_B4_B5_multiband.TIF'
+    multiband_path = os.path.join(protected_area_date, name)
+    multiband_profile = profile.copy()
+    multiband_profile.update(count=len(FUSED_BANDS))
+    with open_product(multiband_path, multiband_profile, 'composite') as dst:
+        for i, band in enumerate(FUSED_BANDS):
+            dst.write(bands[band][0].astype('float32'), i + 1)
+
+    # Reflectance of the bands used by the NDVI
+    reflectance = {}
+    for band in (RED_BAND, NIR_BAND):
+        arr, _, _, nodata = bands[band]
+        mp_reflectance, ap_reflectance = metadata.reflectance_coefficients(band)
+        reflectance[band] = ac.radiance_to_reflectance(band, arr, mp_reflectance, ap_reflectance,
+                                                       metadata.sun_elevation, nodata=nodata, dtype='float32')
+    del bands
+
+    # NDVI and forest NDVI
+    ndvi_folder = os.path.join(protected_area_date, ndvi_folder_name)
+    os.makedirs(ndvi_folder, exist_ok=True)
+
+    product = NDVIProduct(calculate_ndvi(reflectance[RED_BAND], reflectance[NIR_BAND]), transform, profile['crs'])
+    if cloud_mask is not None:
+        product.mask(cloud_mask)
+    product.write(os.path.join(ndvi_folder, 'NDVI_mask_clipped.TIF'))
+
+    # The forest NDVI reuses the NDVI buffer, which is already written
+    forest_data = apply_forest_threshold(product.data, threshold)
+    forest_file = os.path.join(ndvi_folder, 'forest_NDVI_mask_clipped.TIF')
+    product.write(forest_file, forest_data, product='forest')
+
+    total_area = product.forest_area(forest_data)
+    print(f"Total area of NDVI: {total_area} hectares")
+
+    return forest_file, total_area
+
+
+def pipeline_mode(mode=None, scene=None):
+    """
+    Returns the mode a date is processed in: 'fused' with a decoded scene, otherwise `mode`, by default the
+    PIPELINE_MODE setting.
+    """
+    if scene is not None:
+        return 'fused'
+    return mode if mode is not None else settings.PIPELINE_MODE
+
+
+def date_cache_key(protected_area_date, bands_folder, shapes, mode=None):
+    """
+    Returns the scene cache key of a date, from the product ID in its MTL file, the geometry of the area and the
+    pipeline mode, or None when the MTL file is not available.
+    """
+    metadata_list = get_filelist(protected_area_date, bands_folder, '*MTL.txt')
+    if not metadata_list:
+        return None
+    return scene_key(load_metadata(metadata_list[0]).product_id, geometry_hash(shapes), PIPELINE_VERSION,
+                     pipeline_mode(mode))
+
+
+def date_products(protected_area_date, ndvi_folder_name):
+    """
+    Returns the product filepaths of a processed date: the multiband tiff and the files of the NDVI folder.
+    """
+    name = os.path.basename(protected_area_date) + '_B2_B3_B4_B5_multiband.TIF'
+    return [os.path.join(protected_area_date, name)] + \
+        sorted(glob.glob(os.path.join(protected_area_date, ndvi_folder_name, '*.TIF')))
+
+
+def date_record(protected_area_date, ndvi_folder_name, result):
+    """
+    Returns the JSON serializable record of a processed date: {'date', 'forest_area', 'cloud_fraction', 'products'},
+    from its process_date result.
+    """
+    _, total_area, cloud_fraction = result
+    return {
+        'date': os.path.basename(os.path.normpath(protected_area_date)),
+        'forest_area': float(total_area),
+        'cloud_fraction': cloud_fraction,
+        'products': date_products(protected_area_date, ndvi_folder_name),
+    }
+
+
+def restore_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, mode=None):
+    """
+    Restores the products of a date from the scene cache when they were computed for the same product, geometry,
+    pipeline version, pipeline mode (`mode`, by default the PIPELINE_MODE setting) and output settings.
+
+    Returns:
+        tuple: The process_date result, or None on a cache miss or without the SCENE_CACHE setting.
+    """
+    if not settings.SCENE_CACHE:
+        return None
+
+    key = date_cache_key(protected_area_date, bands_folder, shapes, mode)
+    record = SceneCache.for_date(protected_area_date).restore(key, protected_area_date) if key else None
+    if record is None:
+        return None
+
+    statistics = record['statistics']
+    print(f'{os.path.basename(protected_area_date)}: products restored from the scene cache')
+    return (os.path.join(protected_area_date, statistics['forest_file']), statistics['total_area'],
+            statistics['cloud_fraction'])
+
+
+def process_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, mode=None, scene=None):
+    """
+    Returns the products of one date from the scene cache or, on a miss, computes them with compute_date and adds them
+    to the cache.
+    """
+    mode = pipeline_mode(mode, scene)
+    result = restore_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, mode)
+    if result is not None:
+        return result
+
+    result = compute_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, mode, scene)
+
+    key = date_cache_key(protected_area_date, bands_folder, shapes, mode) if settings.SCENE_CACHE else None
+    if key is not None:
+        forest_file, total_area, cloud_fraction = result
+        statistics = {
+            'forest_file': os.path.relpath(forest_file, protected_area_date),
+            'total_area': float(total_area),
+            'cloud_fraction': cloud_fraction,
+        }
+        SceneCache.for_date(protected_area_date).store(key, protected_area_date,
+                                                       date_products(protected_area_date, ndvi_folder_name),
+                                                       statistics)
+    return result
+
+
+def compute_date(protected_area_date, bands_folder, ndvi_folder_name, shapes, mode=None, scene=None):
+    """
+    Runs the per-scene stages of one date: clip, affine, multiband, atmospheric correction and NDVI.
+
+    Args:
+        mode (str): 'staged' or 'fused', by default the PIPELINE_MODE setting.
+        scene (DecodedScene): Bands of the scene already in memory, see batch.py; the date is then processed in the
+            fused mode from them.
+
+    Returns:
+        tuple: The forest NDVI filepath, the total forest area in hectares and the fraction of the area masked as
+        cloud, cloud shadow or fill (None without QA band).
+    """
+    mode = pipeline_mode(mode, scene)
+
+    # cloud, cloud shadow and fill mask, before the QA band can be trashed by the clip
+    cloud_mask, cloud_fraction = None, None
+    if settings.CLOUD_MASKING:
+        cloud_mask, cloud_fraction = generate_cloud_mask(protected_area_date, bands_folder, ndvi_folder_name, shapes,
+                                                         scene)
+
+    # QA band of the datacube, kept as a product since the bands may be trashed
+    if settings.DATACUBE:
+        clip_qa_band(protected_area_date, bands_folder, ndvi_folder_name, shapes, scene)
+
+    if mode == 'fused':
+        # clip, affine, multiband, atmospheric correction and NDVI in a single pass
+        return process_scene(protected_area_date, bands_folder, ndvi_folder_name, shapes, cloud_mask=cloud_mask,
+                             scene=scene) + (cloud_fraction,)
+
+    # The clipped, affined and reflectance bands are intermediates, released when the date finishes
+    with IntermediateStore() as store:
+
+        # clip to panel
+        tif_list = get_filelist(protected_area_date, bands_folder, "*.TIF")
+        tif_list = clip_raster_on_mask(shapes, tif_list, store)
+
+        # affine shapes
+        tif_list = affine_tif(tif_list, store, shapes)
+
+        name = os.path.basename(protected_area_date) + '_B2_B3_B4_B5_multiband.TIF'
+        output_path = os.path.join(protected_area_date, name)
+        ac.create_multiband_color_tiff(tif_list, output_path)
+
+        # convert DN to Radiance
+        metadata_list = get_filelist(protected_area_date, bands_folder, '*MTL.txt')
+        tif_list = generate_atmospheric_correction(protected_area_date, tif_list, load_metadata(metadata_list[0]),
+                                                   store, shapes)
+
+        # NDVI
+        return generate_ndvi(tif_list, protected_area_date, ndvi_folder_name, shapes,
+                             cloud_mask=cloud_mask) + (cloud_fraction,)
+
+
+def date_pool(workers):
+    """
+    Returns a process pool of `workers` processes for the dates or scenes. From a thread other than the main one, e.g.
+    a job worker of the server, the processes are spawned instead of forked: a fork copies the locks held by the other
+    threads (SQLite, GDAL, logging...) and the child may deadlock on them.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return ProcessPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def process_dates(protected_area_dates, bands_folder, ndvi_folder_name, shapes, workers=None, on_date=None):
+    """
+    Runs process_date for every date. The dates found in the scene cache are restored first; the others are
+    independent, so they run on a process pool of at most `workers` processes (DATE_WORKERS setting by default); with
+    one worker they run one after another.
+
+    Args:
+        on_date (function): Called as on_date(protected_area_date, result) as soon as each date is done, in the order
+            they finish.
+
+    Returns:
+        list: The process_date result of every date, in the order of `protected_area_dates`.
+    """
+    results = {}
+    for protected_area_date in protected_area_dates:
+        results[protected_area_date] = restore_date(protected_area_date, bands_folder, ndvi_folder_name, shapes)
+        if results[protected_area_date] is not None and on_date is not None:
+            on_date(protected_area_date, results[protected_area_date])
+    pending_dates = [protected_area_date for protected_area_date, result in results.items() if result is None]
+
+    for protected_area_date, result in zip(pending_dates, compute_dates(pending_dates, bands_folder, ndvi_folder_name,
+                                                                        shapes, workers, on_date)):
+        results[protected_area_date] = result
+    return [results[protected_area_date] for protected_area_date in protected_area_dates]
+
+
+def compute_dates(protected_area_dates, bands_folder, ndvi_folder_name, shapes, workers=None, on_date=None):
+    """
+    Runs process_date for every date, on a process pool of at most `workers` processes, see process_dates.
+    """
+    if not protected_area_dates:
+        return []
+
+    if workers is None:
+        workers = settings.DATE_WORKERS
+    workers = max(1, min(workers, len(protected_area_dates), os.cpu_count() or 1))
+
+    if workers == 1:
+        results = []
+        for protected_area_date in protected_area_dates:
+            results.append(process_date(protected_area_date, bands_folder, ndvi_folder_name, shapes))
+            if on_date is not None:
+                on_date(protected_area_date, results[-1])
+        return results
+
+    # Plain GeoJSON dicts pickle on every platform, and the workers must run the same pipeline mode
+    shapes = [mapping(shape(geometry)) for geometry in shapes]
+    mode = settings.PIPELINE_MODE
+
+    with date_pool(workers) as executor:
+        futures = {executor.submit(process_date, protected_area_date, bands_folder, ndvi_folder_name, shapes, mode):
+                   protected_area_date for protected_area_date in protected_area_dates}
+        if on_date is not None:
+            for future in as_completed(futures):
+                on_date(futures[future], future.result())
+        results = {protected_area_date: future.result() for future, protected_area_date in futures.items()}
+        return [results[protected_area_date] for protected_area_date in protected_area_dates]
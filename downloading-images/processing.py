@@ -1,6 +1,9 @@
 # Standard library imports
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import os
+import re
+import threading
 
 # Third-party library imports
 import geopandas as gpd
@@ -8,8 +11,7 @@ import fiona
 import folium
 import numpy as np
 import rasterio
-from rasterio import features
-import rasterio.mask
+from rasterio import windows
 import pyproj
 from pyproj import Proj
 from shapely.ops import transform
@@ -21,7 +23,13 @@ from osgeo import gdal
 
 # Project-specific library imports
 import AtmosphericCorrection as ac
-from NDVI import ndvi, forest_not_forest, forest_ndvi
+from geometry import BLOCK_EDGE, BLOCK_OUTSIDE, crop_mask, dataset_blocks, geometry_hash, read_cropped
+from ingest import ARCHIVE_EXTENSION, archive_members
+from intermediates import IntermediateStore
+from metadata import load_metadata
+from profiles import open_product
+from NDVI import ndvi, forest_not_forest, forest_ndvi, ndvi_products, stream_ndvi
+import settings
 
 def get_folder(protected_area_dir, bands_folder):
     # Get a list of all the directories in the protected_area_dir
@@ -49,9 +57,27 @@ def get_filelist(protected_area_date, bands_folder, format_name):
 
     last_folder_bands = os.path.join(last_dir)
 
-    file_list = sorted(glob.glob(os.path.join(last_folder_bands, format_name)))
+    file_list = glob.glob(os.path.join(last_folder_bands, format_name))
+
+    # Members of the archived scenes (INGEST_MODE 'archive'), as GDAL '/vsitar/' paths
+    for tar_path in glob.glob(os.path.join(last_folder_bands, '*' + ARCHIVE_EXTENSION)):
+        file_list.extend(archive_members(tar_path, format_name))
+
+    return sorted(file_list)
+
+def select_bands(tif_list, bands):
+    """
+    Returns the paths of the given band numbers, in the order of `bands`, from a list of band files named like
+    'LC08_..._SR_B4.TIF'.
+    """
+    band_paths = []
+    for band in bands:
+        matches = [tif for tif in tif_list if os.path.basename(tif).upper().endswith(f'_B{band}.TIF')]
+        if not matches:
+            raise FileNotFoundError(f'Band {band} not found in {tif_list}')
+        band_paths.append(matches[0])
+    return band_paths
 
-    return file_list
 
 def change_crs(latitude, longitude,pnnsfl_panel_path, geojson_path):
     # Load GeoJSON boundary and display it on a folium map
@@ -120,58 +146,167 @@ def transform_shapefile_coords(shapefile_path, in_crs='EPSG:4326', out_crs='EPSG
     print('Done!')
 
 
-def clip_raster_on_mask(shapes, tiflist):
-    for tif in tiflist:
+class BandProcessingError(Exception):
+    """
+    Raised when one or more bands of a scene fail. `errors` maps each failed band path to its exception.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        details = '; '.join(f'{os.path.basename(tif)}: {error!r}' for tif, error in errors.items())
+        super().__init__(f'{len(errors)} band(s) failed: {details}')
+
+
+_band_executor = None
+_band_executor_pid = None
+_band_executor_lock = threading.Lock()
+
+
+def get_band_executor():
+    """
+    Returns the thread pool shared by the band-level operations, sized by the BAND_WORKERS setting. GDAL releases the
+    GIL while decoding and encoding, so the bands of a scene are read and written concurrently.
+    """
+    global _band_executor, _band_executor_pid
+
+    with _band_executor_lock:
+        # A forked date worker inherits the executor object but not its threads
+        if _band_executor is None or _band_executor_pid != os.getpid():
+            _band_executor = ThreadPoolExecutor(max_workers=settings.BAND_WORKERS, thread_name_prefix='band')
+            _band_executor_pid = os.getpid()
+        return _band_executor
+
+
+def map_bands(func, tif_list, *args):
+    """
+    Runs `func(tif, *args)` for every band on the shared band thread pool and waits for all of them.
+
+    Returns:
+        list: The result of every band, in the order of `tif_list`.
+
+    Raises:
+        BandProcessingError: If any band failed, after every band has finished.
+    """
+    executor = get_band_executor()
+    futures = [(tif, executor.submit(func, tif, *args)) for tif in tif_list]
+
+    results, errors = [], {}
+    for tif, future in futures:
         try:
+            results.append(future.result())
+        except Exception as error:
+            print(f'Band {tif} failed: {error!r}')
+            errors[tif] = error
+
+    if errors:
+        raise BandProcessingError(errors)
+    return results
+
+
+def intermediate_profile(profile):
+    """
+    Returns a copy of `profile` for an intermediate band written block by block: tiled on the COG_BLOCKSIZE grid and
+    sparse, so the blocks outside the shapes are never written and read back as the nodata value (0 without one).
+    """
+    profile = profile.copy()
+    profile.update(driver='GTiff', tiled=True, blockxsize=settings.COG_BLOCKSIZE, blockysize=settings.COG_BLOCKSIZE,
+                   sparse_ok=True)
+    return profile
+
+
+def clip_band(tif, shapes, store):
+    # Clip a band to the shapes block by block, reading only the blocks that overlap them, and release the original
+    with rasterio.open(tif) as src:
+        window, out_transform, outside = crop_mask(shapes, src.transform, src.shape, src.crs)
+        nodata = src.nodata if src.nodata is not None else 0
+        out_meta = intermediate_profile(src.meta)
+        out_meta.update({"height": int(window.height),
+                         "width": int(window.width),
+                         "transform": out_transform})
+        out_tif = store.path(tif, '_mask')
+        with rasterio.open(out_tif, "w", **out_meta) as dest:
+            for block, block_class in dataset_blocks(dest, shapes):
+                if block_class == BLOCK_OUTSIDE:
+                    continue
+                source_window = windows.Window(window.col_off + block.col_off, window.row_off + block.row_off,
+                                               block.width, block.height)
+                out_image = src.read(window=source_window)
+                if block_class == BLOCK_EDGE:
+                    out_image[..., outside[block.toslices()]] = nodata
+                dest.write(out_image, window=block)
+
+    store.release(tif)
+    return out_tif
+
+
+def clip_raster_on_mask(shapes, tiflist, store=None):
+    """
+    Clips the bands 2, 3, 4, 5 and 8 to the shapes; the other bands are released.
 
-            if os.path.splitext(tif)[1].upper() not in ['.TIF', '.TIFF']:
-                continue
-
-            basename = os.path.basename(tif)
-            if not any(basename.endswith(f'B{i}.TIF') for i in [2, 3, 4, 5, 8]):
-                send2trash(tif)
-                continue
-
-            with rasterio.open(tif) as src:
-                out_image, out_transform = rasterio.mask.mask(src, shapes, crop=True)
-                out_meta = src.meta.copy()
-                out_meta.update({"driver": "GTiff",
-                                 "height": out_image.shape[1],
-                                 "width": out_image.shape[2],
-                                 "transform": out_transform})
-                out_tif = os.path.join(os.path.dirname(tif), '_mask'.join(os.path.splitext(basename)))
-                with rasterio.open(out_tif, "w", **out_meta) as dest:
-                    dest.write(out_image)
-
-            send2trash(tif)
-        except:
+    :param store: IntermediateStore of the scene, by default files next to the bands, trashing the originals
+    :return: list of the clipped band paths
+    """
+    if store is None:
+        store = IntermediateStore('disk')
+
+    band_list = []
+    for tif in tiflist:
+        if os.path.splitext(tif)[1].upper() not in ['.TIF', '.TIFF']:
             continue
 
+        basename = os.path.basename(tif)
+        if not any(basename.endswith(f'B{i}.TIF') for i in [2, 3, 4, 5, 8]):
+            store.release(tif)
+            continue
+
+        band_list.append(tif)
+
+    clipped_list = map_bands(clip_band, band_list, shapes, store)
+
     print('\n')
     print('==============')
     print('Bands clipped!')
 
+    return clipped_list
 
-def affine_tif(tiflist):
+
+def affine_band(tif, red_band_path, store, shapes=None):
+    # Write a band on the grid of the red band block by block, skipping the blocks outside the shapes, and release the
+    # original
+    affine_path = store.path(tif, '_affine')
+    with rasterio.open(red_band_path) as red_band, rasterio.open(tif) as band:
+        profile = intermediate_profile({'count': 1,
+                                        'height': red_band.height,
+                                        'width': red_band.width,
+                                        'dtype': 'float32',
+                                        'transform': red_band.transform,
+                                        'crs': 'EPSG:32618'})
+        with rasterio.open(affine_path, 'w', **profile) as raster:
+            for window, block_class in dataset_blocks(raster, shapes):
+                if block_class != BLOCK_OUTSIDE:
+                    raster.write(band.read(1, window=window), 1, window=window)
+
+    store.release(tif)
+    return affine_path
+
+
+def affine_tif(tiflist, store=None, shapes=None):
+    """
+    Writes every band on the grid of the red band, the third of the list.
+
+    :param store: IntermediateStore of the scene, by default files next to the bands, trashing the originals
+    :param shapes: geometries the bands are clipped to, the blocks outside them are skipped
+    :return: list of the affined band paths
+    """
+    if store is None:
+        store = IntermediateStore('disk')
 
     red_band_path = tiflist[2]
-    red_band = rasterio.open(red_band_path)
 
-    for tif in tiflist:
-        if tif.endswith('.TIF'):
-            band = rasterio.open(tif)
-            with rasterio.open('_affine'.join(os.path.splitext(tif)),
-                               'w',
-                               driver='GTiff',
-                               count=1,
-                               height=red_band.height,
-                               width=red_band.width,
-                               dtype='float64',
-                               transform=red_band.transform,
-                               crs='EPSG:32618') as raster:
-                raster.write(band.read(1), 1)
-                raster.close()
-                send2trash(tif)
+    # The red band is the reference grid, it is trashed only once every band is affined
+    band_list = [tif for tif in tiflist if tif.endswith('.TIF') and tif != red_band_path]
+    affine_list = map_bands(affine_band, band_list, red_band_path, store, shapes)
+    affine_list.insert(2, affine_band(red_band_path, red_band_path, store, shapes))
 
     print("---")
     print("---")
@@ -179,35 +314,153 @@ def affine_tif(tiflist):
     print("---")
     print("---")
 
+    return affine_list
+
 
-def generate_atmospheric_correction(protected_area_date, tiflist, metadata):
+def band_number(tif):
+    """
+    Returns the band number of a band file named like 'LC08_..._SR_B4_mask_affine.TIF'.
+    """
+    return int(re.search(r'_B(\d+)', os.path.basename(tif)).group(1))
+
+
+def correct_band(tif_path, metadata, store, shapes=None):
+    # Convert a band to TOA reflectance block by block, skipping the blocks outside the shapes, and release the original
+    band = band_number(tif_path)
+    print(f"Processing band {band} for {tif_path}")
+    with rasterio.open(tif_path) as tif:
+        mp_reflactance, ap_reflectance = metadata.reflectance_coefficients(band)
+        # The clipped and affined bands lose their nodata tag, Landsat fill DN is 0
+        nodata = tif.nodata if tif.nodata is not None else 0
+        profile = intermediate_profile(tif.profile)
+        profile.update(count=1, dtype='float32', nodata=np.nan)
+        reflectance_path = store.path(tif_path, '_reflectance')
+        with rasterio.open(reflectance_path, 'w', **profile) as dst:
+            for window, block_class in dataset_blocks(dst, shapes):
+                if block_class == BLOCK_OUTSIDE:
+                    continue
+                reflectance = ac.radiance_to_reflectance(band, tif.read(1, window=window), mp_reflactance,
+                                                         ap_reflectance, metadata.sun_elevation, nodata=nodata,
+                                                         dtype='float32', verbose=False)
+                dst.write(reflectance, 1, window=window)
+    print(f'Reflectance calculated for band {band}')
+
+    store.release(tif_path)
+    return reflectance_path
+
+
+def generate_atmospheric_correction(protected_area_date, tiflist, metadata, store=None, shapes=None):
     """
     Generates atmospheric correction for each TIFF file in the input list, and saves the reflectance data as a new TIFF
     file with '_reflectance' appended to the original filename. The original TIFF file is deleted after processing.
 
-    :param tiflist: list of input TIFF filenames
-    :param metadata: list of metadata for the input TIFF files
-    """
-    bandlist = [2, 3, 4, 5]  # band list: blue, green, red, NIR
-
-    for i, tif_path in enumerate(tiflist):
-        print(f"Processing band {bandlist[i]} for {tif_path}")
-        with rasterio.open(tif_path) as tif:
-            arr = tif.read(1)
-            mp_reflactance, ap_reflectance = ac.reflectance_rescaling_coefficients(protected_area_date, metadata[0], bandlist[i])
-            sume = ac.sun_elevation(metadata[0])
-            reflectance = ac.radiance_to_reflectance(bandlist[i], arr, mp_reflactance, ap_reflectance, sume)
-            profile = tif.profile.copy()
-            profile.update(count=1, dtype='float64')
-            reflectance_path = os.path.splitext(tif_path)[0] + '_reflectance.TIF'
-            with rasterio.open(reflectance_path, 'w', **profile) as dst:
-                dst.write(reflectance, 1)
-            send2trash(tif_path)
+    :param tiflist: list of input TIFF filenames of bands 2, 3, 4 and 5 (blue, green, red, NIR)
+    :param metadata: LandsatMetadata of the scene, see metadata.load_metadata
+    :param store: IntermediateStore of the scene, by default files next to the bands, trashing the originals
+    :param shapes: geometries the bands are clipped to, the blocks outside them are skipped
+    :return: list of the reflectance TIFF filenames
+    """
+    if store is None:
+        store = IntermediateStore('disk')
+
+    reflectance_list = map_bands(correct_band, tiflist, metadata, store, shapes)
 
     print("Atmospheric correction was successful.")
+    return reflectance_list
+
 
+def generate_cloud_mask(protected_area_date, bands_folder, folder_name, shapes, scene=None):
+    """
+    Decodes the QA_PIXEL band of a date into one boolean mask of the cloud, cloud shadow and fill pixels (the
+    CLOUD_MASK_FLAGS setting), cropped to the shapes like the bands. The mask is cached as a 1-bit GeoTIFF in the NDVI
+    folder, so each scene is decoded once for a given geometry and flags; it has to run before clip_raster_on_mask,
+    which may trash the QA band. With `scene` (a batch.DecodedScene) the QA band is clipped from memory.
+
+    Returns:
+        tuple: The mask and the fraction of the protected area pixels it masks, or (None, None) when the scene has no
+        QA_PIXEL band.
+    """
+    cache_path = os.path.join(protected_area_date, folder_name, 'cloud_mask.TIF')
+    cache_key = geometry_hash(shapes) + ':' + ','.join(settings.CLOUD_MASK_FLAGS)
+
+    if os.path.exists(cache_path):
+        with rasterio.open(cache_path) as src:
+            tags = src.tags()
+            if tags.get('CLOUD_MASK_KEY') == cache_key:
+                cloud_mask = src.read(1).astype(bool)
+                cloud_fraction = float(tags['CLOUD_FRACTION'])
+                print(f'Cloud mask loaded, {cloud_fraction:.2%} of the area masked')
+                return cloud_mask, cloud_fraction
+
+    if scene is not None:
+        qa = scene.clipped_qa(shapes)
+        if qa is None:
+            print(f'No QA_PIXEL band for {protected_area_date}, clouds are not masked')
+            return None, None
+        qa_data, qa_transform, outside = qa
+        crs = scene.crs
+    else:
+        qa_list = get_filelist(protected_area_date, bands_folder, '*QA_PIXEL.TIF')
+        if not qa_list:
+            print(f'No QA_PIXEL band for {protected_area_date}, clouds are not masked')
+            return None, None
+
+        with rasterio.open(qa_list[0]) as src:
+            qa_data, qa_transform = read_cropped(src, shapes, 1)
+            _, _, outside = crop_mask(shapes, src.transform, src.shape, src.crs)
+            crs = src.crs
+
+    cloud_mask = ac.qa_pixel_mask(qa_data, settings.CLOUD_MASK_FLAGS)
+
+    # Fraction of the pixels inside the protected area that are masked
+    inside = ~outside
+    cloud_fraction = float(np.count_nonzero(cloud_mask & inside) / max(np.count_nonzero(inside), 1))
+    print(f'Cloud mask created, {cloud_fraction:.2%} of the area masked')
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    profile = dict(height=cloud_mask.shape[0], width=cloud_mask.shape[1], count=1, dtype='uint8', nbits=1, crs=crs,
+                   transform=qa_transform)
+    with open_product(cache_path, profile, 'mask') as dst:
+        dst.write(cloud_mask.astype('uint8'), 1)
+        dst.update_tags(CLOUD_FRACTION=cloud_fraction, CLOUD_MASK_KEY=cache_key)
+
+    return cloud_mask, cloud_fraction
+
+
+def clip_qa_band(protected_area_date, bands_folder, folder_name, shapes, scene=None):
+    """
+    Writes the QA_PIXEL band cropped to the shapes to 'QA_PIXEL_clipped.TIF' in the NDVI folder, for the datacube.
+    Like generate_cloud_mask, it has to run before clip_raster_on_mask, which may trash the QA band. With `scene` (a
+    batch.DecodedScene) the QA band is clipped from memory.
 
-def generate_ndvi(tif_list, protected_area_date, folder_name, shapes):
+    Returns:
+        str: The filepath of the clipped QA band, or None when the scene has no QA_PIXEL band.
+    """
+    if scene is not None:
+        qa = scene.clipped_qa(shapes)
+        if qa is None:
+            return None
+        qa_data, qa_transform, _ = qa
+        crs = scene.crs
+    else:
+        qa_list = get_filelist(protected_area_date, bands_folder, '*QA_PIXEL.TIF')
+        if not qa_list:
+            return None
+
+        with rasterio.open(qa_list[0]) as src:
+            qa_data, qa_transform = read_cropped(src, shapes, 1)
+            crs = src.crs
+
+    qa_path = os.path.join(protected_area_date, folder_name, 'QA_PIXEL_clipped.TIF')
+    os.makedirs(os.path.dirname(qa_path), exist_ok=True)
+    profile = dict(height=qa_data.shape[0], width=qa_data.shape[1], count=1, dtype=qa_data.dtype.name, crs=crs,
+                   transform=qa_transform)
+    with open_product(qa_path, profile, 'mask') as dst:
+        dst.write(qa_data, 1)
+    return qa_path
+
+
+def generate_ndvi(tif_list, protected_area_date, folder_name, shapes, streaming=None, cloud_mask=None):
 
     # Extract red and near-infrared bands
     red_band = tif_list[2]
@@ -216,16 +469,19 @@ def generate_ndvi(tif_list, protected_area_date, folder_name, shapes):
     # Create NDVI folder
     ndvi_folder = os.path.join(protected_area_date, folder_name)
 
-    # Calculate NDVI and save it to a file
-    ndvi_file = os.path.join(ndvi_folder, 'NDVI.TIF')
-    ndvi(red_band, nir_band, shapes, ndvi_file)
+    if streaming is None:
+        streaming = settings.NDVI_STREAMING
 
-    # Convert forest NDVI and save it to a file
-    clipped_file, total_area = forest_ndvi(red_band, nir_band, shapes, 0.3, ndvi_file)
+    if streaming:
+        # Calculate NDVI and forest NDVI block by block, straight into the clipped files
+        ndvi_file = os.path.join(ndvi_folder, 'NDVI_mask_clipped.TIF')
+        forest_file = os.path.join(ndvi_folder, 'forest_NDVI_mask_clipped.TIF')
+        return stream_ndvi(red_band, nir_band, shapes, 0.3, ndvi_file, forest_file, cloud_mask)
+
+    # Calculate NDVI once and save the NDVI, clipped NDVI and clipped forest NDVI files
+    clipped_file, total_area = ndvi_products(red_band, nir_band, shapes, 0.3, ndvi_folder, cloud_mask)
 
     # Convert NDVI to forest/not-forest classification and save it to a file
     #forest_not_forest(ndvi_file, shapes, 0.7, ndvi_file)
 
     return clipped_file, total_area
-
-
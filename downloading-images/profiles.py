@@ -0,0 +1,146 @@
+# Standard library imports
+from contextlib import contextmanager
+import os
+import uuid
+
+# Third-party library imports
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy, delete
+
+# External library imports
+
+# Project-specific library imports
+import settings
+
+# Output options of every product type. 'compress' defaults to the COG_COMPRESSION setting, the predictor is picked
+# from the data type when it is None (3 for floating point, 2 for integers) and 'resampling' is used for the overviews.
+PRODUCT_PROFILES = {
+    'ndvi': {'compress': None, 'predictor': None, 'resampling': 'average'},
+    'forest': {'compress': None, 'predictor': None, 'resampling': 'nearest'},
+    'composite': {'compress': None, 'predictor': None, 'resampling': 'average'},
+    'mask': {'compress': 'DEFLATE', 'predictor': 1, 'resampling': 'nearest'},
+}
+
+# Layout options of the input profile that the product profile replaces
+LAYOUT_KEYS = ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor', 'interleave', 'photometric')
+
+
+def product_options(product, dtype):
+    """
+    Returns the GeoTIFF creation options of a product type: tiled, compressed with a predictor matching `dtype`.
+    """
+    options = PRODUCT_PROFILES[product]
+
+    predictor = options['predictor']
+    if predictor is None:
+        predictor = 3 if np.dtype(dtype).kind == 'f' else 2
+
+    return {
+        'tiled': True,
+        'blockxsize': settings.COG_BLOCKSIZE,
+        'blockysize': settings.COG_BLOCKSIZE,
+        'compress': options['compress'] or settings.COG_COMPRESSION,
+        'predictor': predictor,
+        'interleave': 'pixel',
+        'bigtiff': 'IF_SAFER',
+    }
+
+
+def overview_factors(width, height, blocksize):
+    """
+    Returns the overview decimation factors (2, 4, 8...) until the overview fits in one block.
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+@contextmanager
+def open_product(output_path, profile, product, in_memory=True):
+    """
+    Opens a deliverable raster for writing. With the COG_OUTPUT setting the file is written as a Cloud-Optimized
+    GeoTIFF: tiled, compressed and with internal overviews stored before the data, so window reads and thumbnails only
+    touch the bytes they need. Otherwise it is a plain GeoTIFF, as before.
+
+    The data is first written to a temporary tiled GeoTIFF, in memory or, for rasters written window by window, next to
+    the output with `in_memory=False`, and copied to `output_path` with its overviews when the block exits.
+
+    The product replaces an existing `output_path` with a new file, renamed over it once complete, instead of rewriting
+    it in place: readers never see a partial product and files linked from the scene cache are left untouched.
+
+    Args:
+        output_path (str): Filepath of the product.
+        profile (dict): Raster profile (dtype, count, width, height, crs, transform, nodata, scales, offsets...).
+        product (str): Product type, a key of PRODUCT_PROFILES.
+        in_memory (bool): Whether the temporary GeoTIFF is kept in memory.
+
+    Yields:
+        DatasetWriter: The dataset to write to.
+    """
+    profile = {key: value for key, value in profile.items() if key not in LAYOUT_KEYS}
+    profile['driver'] = 'GTiff'
+
+    # Band scales and offsets are not creation options, they are set on the dataset
+    scales, offsets = profile.pop('scales', None), profile.pop('offsets', None)
+
+    def scaled(dst):
+        if scales is not None:
+            dst.scales = scales
+        if offsets is not None:
+            dst.offsets = offsets
+        return dst
+
+    staging_path = output_path + '.new'
+
+    if not settings.COG_OUTPUT:
+        try:
+            with rasterio.open(staging_path, 'w', **profile) as dst:
+                yield scaled(dst)
+            os.replace(staging_path, output_path)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+        return
+
+    options = product_options(product, profile['dtype'])
+    temp_path = f'/vsimem/{uuid.uuid4().hex}.TIF' if in_memory else output_path + '.part'
+    temp_profile = dict(profile, tiled=True, blockxsize=options['blockxsize'], blockysize=options['blockysize'])
+
+    try:
+        with rasterio.open(temp_path, 'w', **temp_profile) as dst:
+            yield scaled(dst)
+
+            factors = overview_factors(dst.width, dst.height, options['blockxsize'])
+            if factors:
+                resampling = PRODUCT_PROFILES[product]['resampling']
+                dst.build_overviews(factors, Resampling[resampling])
+                dst.update_tags(ns='rio_overview', resampling=resampling)
+
+        if 'nbits' in profile:
+            options['nbits'] = profile['nbits']
+        copy(temp_path, staging_path, driver='GTiff', copy_src_overviews=True, **options)
+        os.replace(staging_path, output_path)
+    finally:
+        try:
+            delete(temp_path)
+        except Exception:
+            # Nothing was written
+            pass
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+
+def write_product(output_path, data, profile, product):
+    """
+    Writes a 2D (one band) or 3D (bands, rows, cols) array as a product, see open_product.
+    """
+    data = data if data.ndim == 3 else data[np.newaxis]
+    profile = dict(profile, count=data.shape[0], height=data.shape[1], width=data.shape[2], dtype=data.dtype.name)
+
+    with open_product(output_path, profile, product) as dst:
+        dst.write(data)
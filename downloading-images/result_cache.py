@@ -0,0 +1,95 @@
+# Standard library imports
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import threading
+import time
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+
+# A serialized result: its key, JSON body (bytes), ETag (unquoted) and creation time (time.monotonic)
+CachedResult = namedtuple('CachedResult', ['key', 'group', 'body', 'etag', 'created_at'])
+
+
+class ResultCache:
+    """
+    In-memory LRU cache of serialized results, so a result that did not change is served without any processing.
+    Each entry holds the JSON body and its ETag, a hash of the body. Entries expire `max_age` seconds after they were
+    stored, and the least recently used ones are evicted while the bodies take more than `max_bytes`.
+
+    Entries can belong to a group, e.g. a protected area: storing a new result for a group drops its previous one,
+    and latest returns the current result of a group.
+    """
+
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+        if entry.group is not None and self._groups.get(entry.group) == key:
+            del self._groups[entry.group]
+
+    def _live(self, key):
+        # Returns the entry of a key, or None when it is missing or expired
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.max_age:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        """
+        Returns the CachedResult of a key, or None when it is not cached or expired.
+        """
+        with self._lock:
+            return self._live(key)
+
+    def latest(self, group):
+        """
+        Returns the CachedResult last stored for a group, or None.
+        """
+        with self._lock:
+            key = self._groups.get(group)
+            return self._live(key) if key is not None else None
+
+    def put(self, key, payload, group=None):
+        """
+        Serializes a JSON serializable payload and stores it under `key`, replacing the previous result of `group`.
+
+        Returns:
+            CachedResult: The stored entry.
+        """
+        body = json.dumps(payload, sort_keys=True, default=str).encode()
+        entry = CachedResult(key, group, body, hashlib.sha256(body).hexdigest()[:32], time.monotonic())
+
+        with self._lock:
+            for stale_key in (key, self._groups.get(group)):
+                if stale_key is not None and stale_key in self._entries:
+                    self._remove(stale_key)
+
+            if len(body) > self.max_bytes:
+                return entry
+
+            self._entries[key] = entry
+            self.size += len(body)
+            if group is not None:
+                self._groups[group] = key
+
+            # Least recently used first
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+        return entry
@@ -3,8 +3,6 @@ import datetime
 import glob
 import os.path
 from datetime import timedelta
-import shutil
-import tarfile
 import time
 
 # Third-party library imports
@@ -18,6 +16,11 @@ from send2trash import send2trash
 # Project-specific library imports
 from processing import *
 from NDVI import *
+from compositing import update_composite
+from datacube import DATACUBE_EXTENSION, DataCube
+from ingest import IngestError, archive_scene, extract_scene
+from pipeline import process_dates
+import settings
 
 
 class LandsatAPI:
@@ -31,7 +34,12 @@ class LandsatAPI:
         self.protected_area_dir = protected_area_dir
         self.protected_area_deforestation_dir = protected_area_deforestation_dir
 
-    def query(self, chromedriver_path, downloads_dir, coordinates, date_range):
+    def query(self, chromedriver_path, downloads_dir, coordinates, date_range, scenes_dir=None):
+        """
+        Downloads the scenes of the last `date_range` days covering the polygon `coordinates`, a list of rings of
+        (longitude, latitude) points. The scenes downloaded to the downloads directory are skipped, as well as those
+        already ingested to `scenes_dir`, named by product ID (see batch.ingest_scenes).
+        """
         class SatelliteImage:
             def __int__(self, code, data_acquired, path, row):
                 self.code = code
@@ -124,6 +132,10 @@ class LandsatAPI:
                     satellite_image_downloaded_date = split_satellite_image_downloaded_name[3]
                     satellite_image_downloaded_date_list.append(satellite_image_downloaded_date)
 
+                # Scenes ingested once the download finished, their bundle is in the trash
+                if scenes_dir is not None:
+                    tar_list += glob.glob(os.path.join(scenes_dir, '*'))
+
                 html = self.driver.page_source
                 soup = BeautifulSoup(html, "html.parser")
                 time.sleep(3)
@@ -292,7 +304,13 @@ class LandsatAPI:
                 continue
 
     def processing(self, protected_area_name, protected_area_total_extension, footprint, protected_area_dir,
-                   protected_area_shape_path, bands_folder, ndvi_folder, deforestation_folder):
+                   protected_area_shape_path, bands_folder, ndvi_folder, deforestation_folder, on_date=None,
+                   rebuild_from=None):
+        """
+        Processes the downloaded scenes of the protected area. `on_date(protected_area_date, result)` is called as soon
+        as each date is processed, see pipeline.process_dates. The forest cover composite is rebuilt from the date
+        folder name `rebuild_from`, see compositing.update_composite.
+        """
 
         class ForestCover:
             def __int__(self, protected_area_name, photo, description, footprint, last_detection_date,
@@ -311,6 +329,9 @@ class LandsatAPI:
         forest_cover.total_extension_protected_area = protected_area_total_extension
         forest_cover.detection_date_list = []
         forest_cover.total_extension_forest_cover_list = []
+        forest_cover.cloud_fraction_list = []
+        forest_cover.forest_loss_list = []
+        forest_cover.forest_gain_list = []
 
         extract_and_move_file(self.download_folder, self.protected_area_dir, 'bands_folder', 'ndvi_folder')
 
@@ -322,132 +343,76 @@ class LandsatAPI:
 
         protected_area_dates = get_sorted_tif_list(self.protected_area_dir, deforestation_folder)
 
-        for protected_area_date in protected_area_dates:
-
-            # clip to panel
-            tif_list = get_filelist(protected_area_date, bands_folder, "*.TIF")
-            clip_raster_on_mask(protected_area_shape, tif_list)
-
-            # affine shapes
-            tif_list = get_filelist(protected_area_date, bands_folder, '*.TIF')
-            affine_tif(tif_list)
-
-            tif_list = get_filelist(protected_area_date, bands_folder, '*.TIF')
-            name = os.path.basename(protected_area_date) + '_B2_B3_B4_B5_multiband.TIF'
-            output_path = os.path.join(protected_area_date, name)
-            create_multiband_color_tiff(tif_list, output_path)
-
-            # convert DN to Radiance
-            tif_list = get_filelist(protected_area_date, bands_folder, '*.TIF')
-            metadata_list = get_filelist(protected_area_date, bands_folder, '*MTL.txt')
-            generate_atmospheric_correction(protected_area_date, tif_list, metadata_list)
-
-            # NDVI
-            tif_list = get_filelist(protected_area_date, bands_folder, '*.TIF')
-            protected_area_ndvi_dir, protected_area_ndvi_total_extension = generate_ndvi(tif_list, protected_area_date,
-                                                                                         ndvi_folder + '_folder',
-                                                                                         protected_area_shape)
-
-        filename_1 = 'ndvi_folder/forest_NDVI_mask_clipped.TIF'
-        filename_2 = 'forest_NDVI_mask_clipped.TIF'
-
-        for i, protected_area_date in enumerate(protected_area_dates):
-
-            if i == 0:
-
-                ndvi_date = os.path.join(protected_area_date, filename_1)
-                multi_band_tiff = glob.glob(protected_area_date + '/*.TIF')
-                multi_band_tiff = multi_band_tiff[0]
-
-                multi_band_masked_tiff_path = replace_nan_value_multiband(ndvi_date, multi_band_tiff)
-
-                with rasterio.open(ndvi_date) as src:
-                    band_forest = src.read(1)
-                    pixel_size = src.res[0] * src.res[1]  # assuming square pixels
-                    # Create a mask of the pixels greater than 0
-                    new_mask = band_forest > 0
-                    # Count the number of pixels greater than 0
-                    num_pixels = np.count_nonzero(new_mask)
-                    # Calculate the total area of the pixels greater than 0 in hectares
-                    total_area = num_pixels * pixel_size / 10000
-                    print(f"Total area of NDVI: {total_area} hectares")
-                    forest_cover.total_extension_forest_cover_list.append(total_area)
-
-                # construct the new filename using ndvi_date
-                split_name = protected_area_date.split('/')
-                output_file = os.path.join(self.protected_area_deforestation_dir, split_name[-1] + '__.TIF')
-                forest_cover.detection_date_list.append(split_name[-1])
-
-                add_ndvi_in_multi_band(multi_band_masked_tiff_path, ndvi_date)
+        # clip, affine, multiband, atmospheric correction and NDVI of every date, in parallel
+        protected_area_results = process_dates(protected_area_dates, bands_folder, ndvi_folder + '_folder',
+                                               protected_area_shape, on_date=on_date)
 
-                shutil.copy(ndvi_date, output_file)
-                continue
-
-
-            ndvi_date = os.path.join(protected_area_date, filename_1)
-            multi_band_tiff = glob.glob(protected_area_date + '/*.TIF')
-            multi_band_tiff = multi_band_tiff[0]
-
-            current_multi_band_masked_tiff_path = replace_nan_value_multiband(ndvi_date, multi_band_tiff)
+        forest_cover.scene_dates = [os.path.basename(protected_area_date)
+                                    for protected_area_date in protected_area_dates]
 
-            deforestation_tiff_list = sorted(glob.glob(os.path.join(self.protected_area_deforestation_dir, '*.TIF')))
+        # fraction of the protected area masked as cloud, cloud shadow or fill, per date
+        for protected_area_date, (_, _, cloud_fraction) in zip(protected_area_dates, protected_area_results):
+            forest_cover.cloud_fraction_list.append(cloud_fraction)
+            if cloud_fraction is not None:
+                print(f'{os.path.basename(protected_area_date)}: {cloud_fraction:.2%} masked by clouds')
 
-            if i == 1:
+        # datacube and forest cover composite of the protected area
+        for step in update_area_products(self.protected_area_dir, self.protected_area_deforestation_dir,
+                                         protected_area_dates, bands_folder, ndvi_folder + '_folder', rebuild_from):
+            forest_cover.detection_date_list.append(step['date'])
+            forest_cover.total_extension_forest_cover_list.append(step['area'])
+            forest_cover.forest_loss_list.append(step['loss_area'])
+            forest_cover.forest_gain_list.append(step['gain_area'])
 
-                before_multi_band_masked_data = glob.glob(protected_area_dates[i-1] + '/*_masked.TIF')
-                before_multi_band_masked_data = before_multi_band_masked_data[0]
+        return forest_cover
 
-            else:
-                before_multi_band_masked_data = glob.glob(protected_area_dates[i - 1] + '/*_added.TIF')
-                before_multi_band_masked_data = before_multi_band_masked_data[0]
 
-            ndvi_before_date = os.path.join(deforestation_tiff_list[i-1])
-            ndvi_current_date_dir = get_folder(protected_area_dates[i], ndvi_folder)
-            ndvi_current_date = os.path.join(ndvi_current_date_dir, filename_2)
+def update_area_products(protected_area_dir, protected_area_deforestation_dir, protected_area_dates, bands_folder,
+                         ndvi_folder_name, rebuild_from=None):
+    """
+    Adds the processed dates of a protected area to its datacube (with the DATACUBE setting) and to its forest cover
+    composite, which is only updated with the dates that are not in its saved state, or rebuilt from the date folder
+    name `rebuild_from`, and reads them from the datacube.
 
-            protected_area_deforestation_path = replace_nan_values(forest_cover, ndvi_before_date, ndvi_current_date, self.protected_area_deforestation_dir, i)
-            replace_nan_add_ndvi(before_multi_band_masked_data, current_multi_band_masked_tiff_path, protected_area_deforestation_path, i)
+    Returns:
+        list: The composite step of every date, see compositing.update_composite.
+    """
+    # NDVI, forest mask and QA of every new or reprocessed date in the datacube of the protected area
+    datacube = None
+    if settings.DATACUBE:
+        datacube = DataCube.open_or_create(protected_area_dir)
+        for protected_area_date in protected_area_dates:
+            if not datacube.is_current(protected_area_date, ndvi_folder_name):
+                datacube.append_date(protected_area_date, bands_folder, ndvi_folder_name)
 
-        return forest_cover
+    # forest cover composite, read from the datacube
+    return update_composite(protected_area_deforestation_dir, protected_area_dates, ndvi_folder_name, rebuild_from,
+                            datacube)
 
 
 def extract_and_move_file(download_folder, protected_area_dir, bands_folder_name, ndvi_folder_name):
-    # Get the latest downloaded file
+    """
+    Ingests every downloaded Landsat bundle into its date folder. With the INGEST_MODE setting 'extract' only the
+    members the pipeline uses are extracted (see ingest.extract_scene) and the bundle is moved to the trash; with
+    'archive' the bundle itself is moved to the bands folder and read in place (see ingest.archive_scene). A bundle
+    that fails its checks is kept so it can be downloaded again.
+    """
     tar_list = glob.glob(os.path.join(download_folder, '*.tar'))
+    ingest_scene = archive_scene if settings.INGEST_MODE == 'archive' else extract_scene
 
     for tar_file in tar_list:
-        # Extract the downloaded file to a folder
-        extract_dir = os.path.splitext(tar_file)[0]
-        tar = tarfile.open(tar_file)
-        tar.extractall(extract_dir)
-        tar.close()
-
-        # Move the downloaded file to the trash folder
-        send2trash(tar_file)
-
-        # Move the extracted folder to the Landsat8 folder
-        dir_name = os.path.basename(os.path.normpath(extract_dir))
-        split_folder = dir_name.split('_')
-        name = split_folder[3]
-        name = name[:4] + '-' + name[4:]
-        name = name[:7] + '-' + name[7:] + '-' + split_folder[0]
-        new_folder = os.path.join(protected_area_dir, name)
-        os.makedirs(new_folder, exist_ok=True)
-        move_dir = os.path.join(download_folder, dir_name)
-        shutil.move(move_dir, new_folder)
-        on_new_folder = os.path.join(new_folder, dir_name)
-        print(new_folder)
-
         try:
-            os.rename(on_new_folder, os.path.join(new_folder, bands_folder_name))
-
-        except:
-            send2trash(on_new_folder)
+            new_folder = ingest_scene(tar_file, protected_area_dir, bands_folder_name, ndvi_folder_name)
+        except IngestError as e:
+            print(f'Could not ingest {tar_file}: {e}')
             continue
 
-        # Create NDVI directory
-        ndvi_folder_path = os.path.join(new_folder, ndvi_folder_name)
-        os.makedirs(ndvi_folder_path, exist_ok=True)
+        if new_folder is not None:
+            print(new_folder)
+
+        # Move the downloaded file to the trash folder, unless it was archived
+        if os.path.exists(tar_file):
+            send2trash(tar_file)
 
 
 def get_date_range_for_download(landsat_folder):
@@ -569,6 +534,6 @@ def get_sorted_tif_list(path, ignore_folder_name):
     tif_list = []
     for item in os.listdir(path):
         item_path = os.path.join(path, item)
-        if os.path.isdir(item_path) and item != ignore_folder_name:
+        if os.path.isdir(item_path) and item != ignore_folder_name and not item.endswith(DATACUBE_EXTENSION):
             tif_list.append(item_path)
     return sorted(tif_list)
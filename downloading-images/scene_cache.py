@@ -0,0 +1,156 @@
+# Standard library imports
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+import settings
+
+RECORD_NAME = 'record.json'
+
+# Settings that change the products of a scene, part of every key. The pipeline mode is part of the key on its own,
+# a batch runs in the fused mode whatever the PIPELINE_MODE setting
+OUTPUT_SETTINGS = ('CLOUD_MASKING', 'CLOUD_MASK_FLAGS', 'NDVI_STORAGE', 'NDVI_STREAMING', 'DATACUBE', 'COG_OUTPUT',
+                   'COG_COMPRESSION', 'COG_BLOCKSIZE')
+
+
+def scene_key(product_id, geometry_hash, pipeline_version, mode):
+    """
+    Returns the cache key of the products of a scene: a SHA-256 hex digest of the Landsat product ID, the hash of the
+    area geometry, the pipeline version, the pipeline mode ('staged' or 'fused') that computes the products and the
+    settings that change them.
+    """
+    identity = {
+        'product_id': product_id,
+        'geometry': geometry_hash,
+        'pipeline_version': pipeline_version,
+        'mode': mode,
+        'settings': {name: getattr(settings, name) for name in OUTPUT_SETTINGS},
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=list).encode()).hexdigest()
+
+
+def link_or_copy(source, destination):
+    """
+    Hard links `source` to `destination`, copying it when they are on different filesystems. An existing destination
+    is replaced atomically.
+    """
+    temp_path = f'{destination}.{uuid.uuid4().hex}.part'
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copy2(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+class SceneCache:
+    """
+    Persistent, content-addressed cache of the per-scene products (multiband tiff, NDVI folder) and statistics.
+    Entries live in `<root>/<key[:2]>/<key>/`, with the product files and a record.json holding the statistics, and
+    are never modified once written: a change of geometry, pipeline version, mode or output settings gives a new
+    key.
+
+    The default root is the SCENE_CACHE_DIR setting, or a 'scene_cache' folder next to the protected area folders.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def for_date(cls, protected_area_date):
+        """
+        Returns the cache used for the dates of a protected area.
+        """
+        root = settings.SCENE_CACHE_DIR
+        if not root:
+            protected_area_dir = os.path.dirname(os.path.abspath(protected_area_date))
+            root = os.path.join(os.path.dirname(protected_area_dir), 'scene_cache')
+        return cls(root)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, key):
+        """
+        Returns the record of an entry, or None when the key is not cached or the entry lost a product file.
+        """
+        record_path = os.path.join(self.entry_path(key), RECORD_NAME)
+        try:
+            with open(record_path) as record_file:
+                record = json.load(record_file)
+        except (OSError, ValueError):
+            return None
+
+        for product in record['products']:
+            try:
+                if os.path.getsize(os.path.join(self.entry_path(key), product['cache_name'])) != product['size']:
+                    return None
+            except OSError:
+                return None
+        return record
+
+    def restore(self, key, protected_area_date):
+        """
+        Puts the cached products of an entry back in the date folder, as links when possible.
+
+        Returns:
+            dict: The record of the entry, or None on a cache miss.
+        """
+        record = self.lookup(key)
+        if record is None:
+            return None
+
+        entry_path = self.entry_path(key)
+        for product in record['products']:
+            destination = os.path.join(protected_area_date, product['path'])
+            source = os.path.join(entry_path, product['cache_name'])
+            if os.path.exists(destination) and os.path.samefile(source, destination):
+                continue
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            link_or_copy(source, destination)
+
+        return record
+
+    def store(self, key, protected_area_date, product_paths, statistics):
+        """
+        Adds the products of a date to the cache. The entry is written to a temporary folder and renamed, so readers
+        never see a partial entry; when another process stored the same key first, its entry is kept.
+
+        Args:
+            key (str): Cache key, see scene_key.
+            protected_area_date (str): Folder of the date.
+            product_paths (list): Product filepaths, inside the date folder.
+            statistics (dict): JSON serializable statistics returned on a cache hit.
+        """
+        entry_path = self.entry_path(key)
+        temp_path = f'{entry_path}.{uuid.uuid4().hex}.part'
+        os.makedirs(temp_path)
+
+        products = []
+        for i, product_path in enumerate(product_paths):
+            cache_name = f'{i}_{os.path.basename(product_path)}'
+            link_or_copy(product_path, os.path.join(temp_path, cache_name))
+            products.append({
+                'path': os.path.relpath(product_path, protected_area_date),
+                'cache_name': cache_name,
+                'size': os.path.getsize(product_path),
+            })
+
+        with open(os.path.join(temp_path, RECORD_NAME), 'w') as record_file:
+            json.dump({'key': key, 'products': products, 'statistics': statistics}, record_file, indent=2)
+
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Stored concurrently, or an invalid entry is in the way
+            if self.lookup(key) is None:
+                shutil.rmtree(entry_path, ignore_errors=True)
+                os.rename(temp_path, entry_path)
+            else:
+                shutil.rmtree(temp_path, ignore_errors=True)
@@ -0,0 +1,70 @@
+# Standard library imports
+
+# Third-party library imports
+from decouple import Csv, config
+
+# External library imports
+
+# Project-specific library imports
+
+
+# Bands extracted from the downloaded Landsat bundles, besides QA_PIXEL and MTL, see ingest.py
+INGEST_BANDS = config('INGEST_BANDS', default='2,3,4,5,8', cast=Csv(int))
+
+# Ingest of the downloaded bundles: 'extract' writes the needed members to the bands folder, 'archive' keeps the
+# bundle as it is and reads the members through GDAL /vsitar/ paths
+INGEST_MODE = config('INGEST_MODE', default='extract')
+
+# Per-area time series of the NDVI, forest mask and QA band in a Zarr datacube, see datacube.py
+DATACUBE = config('DATACUBE', default=True, cast=bool)
+DATACUBE_CHUNKSIZE = config('DATACUBE_CHUNKSIZE', default=512, cast=int)
+
+# Persistent cache of the per-scene products, keyed by product ID, area geometry and pipeline version, see
+# scene_cache.py. SCENE_CACHE_DIR defaults to a 'scene_cache' folder next to the protected area folders
+SCENE_CACHE = config('SCENE_CACHE', default=True, cast=bool)
+SCENE_CACHE_DIR = config('SCENE_CACHE_DIR', default='')
+
+# NDVI: calculate block by block instead of reading whole bands
+NDVI_STREAMING = config('NDVI_STREAMING', default=False, cast=bool)
+
+# Storage of the NDVI products: 'float32' (NaN nodata) or 'int16' (NDVI x 10000, -32768 nodata), see NDVI.py
+NDVI_STORAGE = config('NDVI_STORAGE', default='float32')
+
+# Per-scene pipeline: 'staged' writes a GeoTIFF per stage, 'fused' reads the bands once and only writes the products
+PIPELINE_MODE = config('PIPELINE_MODE', default='staged')
+
+# Raster arithmetic kernels: 'numpy', 'numexpr' or 'numba', see kernels.py
+KERNEL_BACKEND = config('KERNEL_BACKEND', default='numpy')
+
+# Number of dates processed in parallel, each one in its own process
+DATE_WORKERS = config('DATE_WORKERS', default=4, cast=int)
+
+# Number of bands of a scene read, processed and written concurrently
+BAND_WORKERS = config('BAND_WORKERS', default=4, cast=int)
+
+# Intermediate rasters of a scene: 'memory', 'scratch' (temporary folder under SCRATCH_DIR) or 'disk' (next to the
+# bands, trashing each input once it is consumed)
+INTERMEDIATE_STORAGE = config('INTERMEDIATE_STORAGE', default='memory')
+SCRATCH_DIR = config('SCRATCH_DIR', default='')
+
+# QA_PIXEL masking of the NDVI, see AtmosphericCorrection.QA_PIXEL_BITS for the flag names
+CLOUD_MASKING = config('CLOUD_MASKING', default=True, cast=bool)
+CLOUD_MASK_FLAGS = config('CLOUD_MASK_FLAGS', default='Fill,Dilated Cloud,Cloud,Cloud Shadow', cast=Csv())
+
+# Deliverable products as Cloud-Optimized GeoTIFFs (tiled, compressed, internal overviews), see profiles.py
+COG_OUTPUT = config('COG_OUTPUT', default=True, cast=bool)
+COG_COMPRESSION = config('COG_COMPRESSION', default='DEFLATE')
+COG_BLOCKSIZE = config('COG_BLOCKSIZE', default=512, cast=int)
+
+# Background jobs of the /processing endpoint, see jobs.py. JOBS_DB defaults to 'jobs.sqlite3' in the landsat
+# directory; the workers share the downloads directory, so more than one can mix the downloads of different areas
+JOBS_DB = config('JOBS_DB', default='')
+JOB_WORKERS = config('JOB_WORKERS', default=1, cast=int)
+
+# In-memory cache of the results of the protected areas, keyed by area ID, footprint and latest ingested scene date,
+# see result_cache.py. A request whose key is cached is answered without processing. RESULT_CACHE_SIZE is in MB and
+# RESULT_CACHE_MAX_AGE in seconds; once a result expires, the next request queues a job again, which also downloads
+# the new scenes
+RESULT_CACHE = config('RESULT_CACHE', default=True, cast=bool)
+RESULT_CACHE_SIZE = config('RESULT_CACHE_SIZE', default=64, cast=int)
+RESULT_CACHE_MAX_AGE = config('RESULT_CACHE_MAX_AGE', default=3600, cast=int)
@@ -0,0 +1,12 @@
+# Standard library imports
+import os
+import sys
+
+# Third-party library imports
+
+# External library imports
+
+# Project-specific library imports
+
+# The modules of the service import each other by name, from the downloading-images folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
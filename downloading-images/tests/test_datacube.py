@@ -0,0 +1,131 @@
+# Standard library imports
+import os
+
+# Third-party library imports
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+# External library imports
+
+# Project-specific library imports
+from compositing import CompositeState, update_composite
+from datacube import QA_FILL, DataCube
+from NDVI import write_ndvi
+from profiles import write_product
+
+BANDS_FOLDER = 'bands_folder'
+NDVI_FOLDER = 'ndvi_folder_folder'
+DATES = ('2020-01-01-LC08', '2020-02-01-LC08', '2020-03-01-LC08')
+SHAPE = (48, 56)
+
+
+def write_dates(protected_area_dir, dates=DATES):
+    """
+    Writes the NDVI, forest NDVI, clipped QA and multiband products of three dates, as the pipeline does. The QA_PIXEL
+    band of the bands folder is gone, as in the 'disk' intermediate storage.
+    """
+    rng = np.random.default_rng(2)
+    profile = {'driver': 'GTiff', 'crs': CRS.from_epsg(32618), 'transform': from_origin(500000, 9000000, 30, 30)}
+
+    protected_area_dates = []
+    for date_name in dates:
+        protected_area_date = os.path.join(protected_area_dir, date_name)
+        ndvi_folder = os.path.join(protected_area_date, NDVI_FOLDER)
+        os.makedirs(ndvi_folder)
+        os.makedirs(os.path.join(protected_area_date, BANDS_FOLDER))
+
+        ndvi = rng.uniform(-0.2, 0.9, size=SHAPE).astype('float32')
+        ndvi[rng.random(SHAPE) < 0.25] = np.nan
+        forest = np.where(ndvi >= 0.3, ndvi, np.nan)
+        write_ndvi(os.path.join(ndvi_folder, 'NDVI_mask_clipped.TIF'), ndvi, profile)
+        write_ndvi(os.path.join(ndvi_folder, 'forest_NDVI_mask_clipped.TIF'), forest, profile, 'forest')
+        write_product(os.path.join(ndvi_folder, 'QA_PIXEL_clipped.TIF'),
+                      rng.integers(0, 2 ** 16, size=SHAPE).astype('uint16'), profile, 'mask')
+        write_product(os.path.join(protected_area_date, date_name + '_B2_B3_B4_B5_multiband.TIF'),
+                      rng.uniform(0, 0.3, size=(4,) + SHAPE).astype('float32'), dict(profile, nodata=np.nan),
+                      'composite')
+        protected_area_dates.append(protected_area_date)
+    return protected_area_dates
+
+
+def append_dates(protected_area_dir, protected_area_dates):
+    datacube = DataCube.open_or_create(protected_area_dir)
+    for protected_area_date in protected_area_dates:
+        datacube.append_date(protected_area_date, BANDS_FOLDER, NDVI_FOLDER)
+    return datacube
+
+
+def test_qa_of_the_clipped_product(tmp_path):
+    protected_area_dates = write_dates(str(tmp_path))
+    datacube = append_dates(str(tmp_path), protected_area_dates)
+
+    _, qa = datacube.read('qa')
+    with rasterio.open(os.path.join(protected_area_dates[1], NDVI_FOLDER, 'QA_PIXEL_clipped.TIF')) as src:
+        np.testing.assert_array_equal(qa[1], src.read(1))
+    assert not (qa == QA_FILL).all()
+
+
+def test_is_current(tmp_path):
+    protected_area_dates = write_dates(str(tmp_path))
+    datacube = append_dates(str(tmp_path), protected_area_dates[:2])
+
+    assert datacube.is_current(protected_area_dates[0], NDVI_FOLDER)
+    assert not datacube.is_current(protected_area_dates[2], NDVI_FOLDER)
+
+    with rasterio.open(os.path.join(protected_area_dates[0], NDVI_FOLDER, 'NDVI_mask_clipped.TIF')) as src:
+        profile, ndvi = src.meta.copy(), src.read(1)
+    write_ndvi(os.path.join(protected_area_dates[0], NDVI_FOLDER, 'NDVI_mask_clipped.TIF'), ndvi[::-1], profile)
+    assert not datacube.is_current(protected_area_dates[0], NDVI_FOLDER)
+
+
+def test_composite_from_the_datacube(tmp_path):
+    protected_area_dates = write_dates(str(tmp_path / 'area'))
+    datacube = append_dates(str(tmp_path / 'area'), protected_area_dates)
+
+    steps = {}
+    for name, cube in (('files', None), ('datacube', datacube)):
+        deforestation_dir = str(tmp_path / name)
+        os.makedirs(deforestation_dir)
+        steps[name] = update_composite(deforestation_dir, protected_area_dates, NDVI_FOLDER, '', cube)
+
+    assert [(step['area'], step['loss_area'], step['gain_area']) for step in steps['files']] == \
+        [(step['area'], step['loss_area'], step['gain_area']) for step in steps['datacube']]
+
+    # The last checkpoint is the composite of the cube over every date, above the forest threshold of the dates
+    checkpoint = CompositeState(str(tmp_path / 'datacube')).load_checkpoint(DATES[-1])
+    np.testing.assert_array_equal(checkpoint['ndvi'], datacube.composite())
+
+
+def test_scenes_of_the_same_day_are_two_time_steps(tmp_path):
+    dates = ('2020-01-01-LC08', '2020-01-01-LC09', '2020-02-01-LC08')
+    protected_area_dates = write_dates(str(tmp_path / 'area'), dates)
+    datacube = append_dates(str(tmp_path / 'area'), protected_area_dates)
+
+    assert datacube.scenes == list(dates)
+    for protected_area_date, date_name in zip(protected_area_dates, dates):
+        with rasterio.open(os.path.join(protected_area_date, NDVI_FOLDER, 'QA_PIXEL_clipped.TIF')) as src:
+            np.testing.assert_array_equal(datacube.read('qa', scene=date_name)[1][0], src.read(1))
+
+    steps = {}
+    for name, cube in (('files', None), ('datacube', datacube)):
+        deforestation_dir = str(tmp_path / name)
+        os.makedirs(deforestation_dir)
+        steps[name] = update_composite(deforestation_dir, protected_area_dates, NDVI_FOLDER, '', cube)
+    assert [step['area'] for step in steps['files']] == [step['area'] for step in steps['datacube']]
+
+
+def test_rebuild_only_once(tmp_path, capsys):
+    protected_area_dates = write_dates(str(tmp_path / 'area'))
+    deforestation_dir = str(tmp_path / 'deforestation')
+    os.makedirs(deforestation_dir)
+
+    steps = update_composite(deforestation_dir, protected_area_dates, NDVI_FOLDER)
+    capsys.readouterr()
+    assert update_composite(deforestation_dir, protected_area_dates, NDVI_FOLDER, DATES[1]) == steps
+    assert f'Composite rebuilt from {DATES[1]}' in capsys.readouterr().out
+
+    # The rebuild is not repeated by the next update
+    assert update_composite(deforestation_dir, protected_area_dates, NDVI_FOLDER) == steps
+    assert 'Composite rebuilt' not in capsys.readouterr().out
@@ -0,0 +1,124 @@
+# Standard library imports
+import sqlite3
+import time
+
+# Third-party library imports
+import pytest
+
+# External library imports
+
+# Project-specific library imports
+import jobs
+from jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+def restart(monkeypatch):
+    # A new run of this process, with the same PID
+    monkeypatch.setattr(jobs, '_process_token', None)
+
+
+def test_a_job_is_claimed_once_and_finished_with_its_result(queue):
+    job_id, coalesced = queue.enqueue('processing', {'area': 7})
+    assert not coalesced
+    assert queue.get(job_id)['status'] == QUEUED
+
+    job = queue.claim()
+    assert job['id'] == job_id and job['status'] == RUNNING and job['payload'] == {'area': 7}
+    assert queue.claim() is None
+
+    queue.finish(job_id, result={'area': 27.18})
+    job = queue.get(job_id)
+    assert job['status'] == SUCCEEDED and job['result'] == {'area': 27.18} and job['progress'] == 1.0
+
+
+def test_jobs_are_claimed_in_order(queue):
+    first, _ = queue.enqueue('processing', {'n': 1})
+    second, _ = queue.enqueue('processing', {'n': 2})
+    assert [queue.claim()['id'], queue.claim()['id']] == [first, second]
+
+
+def test_a_failed_job_keeps_its_error(queue):
+    job_id, _ = queue.enqueue('processing', {})
+    queue.claim()
+    queue.finish(job_id, error='ValueError: no scenes')
+    job = queue.get(job_id)
+    assert job['status'] == FAILED and job['error'] == 'ValueError: no scenes'
+
+
+def test_submissions_with_the_same_key_share_a_job(queue):
+    job_id, _ = queue.enqueue('processing', {}, 'area:7')
+    assert queue.enqueue('processing', {}, 'area:7') == (job_id, True)
+
+    queue.claim()
+    assert queue.enqueue('processing', {}, 'area:7') == (job_id, True)
+    assert queue.get(job_id)['submissions'] == 3
+
+    queue.finish(job_id, result={})
+    assert queue.enqueue('processing', {}, 'area:7')[1] is False
+    assert queue.enqueue('processing', {}, 'area:8')[1] is False
+
+
+def test_the_events_keep_their_order(queue):
+    job_id, _ = queue.enqueue('processing', {})
+    queue.claim()
+    queue.report(job_id, 'downloading')
+    queue.report(job_id, 'downloading', 0.5)
+    queue.emit(job_id, 'date', {'date': '2023-02-18-LC08'})
+    queue.report(job_id, 'compositing')
+    queue.finish(job_id, result={'area': 1})
+
+    events = queue.events(job_id)
+    assert [(event['event'], event['data']) for event in events] == [
+        ('stage', {'stage': 'downloading'}),
+        ('date', {'date': '2023-02-18-LC08'}),
+        ('stage', {'stage': 'compositing'}),
+        (SUCCEEDED, {'result': {'area': 1}}),
+    ]
+    assert [event['event'] for event in queue.events(job_id, after=events[1]['seq'])] == ['stage', SUCCEEDED]
+
+
+def test_the_running_jobs_of_this_process_are_kept(queue):
+    job_id, _ = queue.enqueue('processing', {})
+    queue.claim()
+    assert queue.recover() == 0
+    assert queue.get(job_id)['status'] == RUNNING
+
+
+def test_a_restart_with_the_same_pid_queues_the_running_jobs_again(queue, monkeypatch):
+    job_id, _ = queue.enqueue('processing', {})
+    queue.claim()
+
+    restart(monkeypatch)
+    assert queue.recover() == 1
+    assert queue.get(job_id)['status'] == QUEUED
+    assert queue.events(job_id)[-1]['event'] == 'restarted'
+    assert queue.claim()['id'] == job_id
+
+
+def test_the_jobs_of_a_worker_without_heartbeat_are_queued_again(queue, tmp_path):
+    job_id, _ = queue.enqueue('processing', {})
+    queue.claim()
+    with sqlite3.connect(str(tmp_path / 'jobs.sqlite3')) as connection:
+        connection.execute("INSERT INTO workers VALUES ('peer', 'other-host', 1, ?)", (time.time(),))
+        connection.execute("UPDATE jobs SET owner = 'peer'")
+    assert queue.recover() == 0
+
+    with sqlite3.connect(str(tmp_path / 'jobs.sqlite3')) as connection:
+        connection.execute('UPDATE workers SET heartbeat_at = ?', (time.time() - jobs.WORKER_LEASE - 1,))
+    assert queue.recover() == 1
+    assert queue.get(job_id)['status'] == QUEUED
+
+
+def test_a_submission_does_not_attach_to_a_job_of_a_dead_worker(queue, monkeypatch):
+    job_id, _ = queue.enqueue('processing', {}, 'area:7')
+    queue.claim()
+
+    restart(monkeypatch)
+    assert queue.enqueue('processing', {}, 'area:7') == (job_id, True)
+    assert queue.get(job_id)['status'] == QUEUED
+    assert queue.claim()['id'] == job_id
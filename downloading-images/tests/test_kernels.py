@@ -0,0 +1,66 @@
+# Standard library imports
+
+# Third-party library imports
+import numpy as np
+import pytest
+
+# External library imports
+
+# Project-specific library imports
+from kernels import available_backends, get_backend
+
+SHAPE = (257, 311)
+
+
+@pytest.fixture(scope='module')
+def bands():
+    """
+    Random bands, including nodata and zero-sum pixels.
+    """
+    rng = np.random.default_rng(0)
+    dn = rng.integers(0, 30000, size=SHAPE).astype('uint16')
+    dn[:3] = 0
+    red = rng.uniform(0, 0.5, size=SHAPE).astype('float32')
+    nir = rng.uniform(0, 0.8, size=SHAPE).astype('float32')
+    red[0, :5] = nir[0, :5] = 0
+    red_dn = rng.integers(0, 30000, size=SHAPE).astype('uint16')
+    nir_dn = rng.integers(0, 30000, size=SHAPE).astype('uint16')
+    red_dn[0, :5] = nir_dn[0, :5] = 0
+    previous = rng.uniform(-1, 1, size=SHAPE).astype('float32')
+    previous[1] = np.nan
+    return {'dn': dn, 'invalid': dn == 0, 'red': red, 'nir': nir, 'red_dn': red_dn, 'nir_dn': nir_dn,
+            'previous': previous}
+
+
+def run_kernels(backend, bands):
+    ndvi = backend.ndvi(bands['red'], bands['nir'], np.empty(SHAPE, dtype='float32'))
+    ndvi_dn = backend.ndvi(bands['red_dn'], bands['nir_dn'], np.empty(SHAPE, dtype='float32'))
+    rescaled = backend.rescale(bands['dn'], 2.75e-05, -0.2, 0.8, bands['invalid'], np.empty(SHAPE, dtype='float32'))
+    forest = backend.forest_threshold(ndvi.copy(), 0.3)
+    filled = backend.fill_nan(forest, bands['previous'], np.empty(SHAPE, dtype='float32'))
+    return {'ndvi': ndvi, 'ndvi_dn': ndvi_dn, 'rescale': rescaled, 'forest_threshold': forest, 'fill_nan': filled}
+
+
+@pytest.mark.parametrize('name', available_backends())
+def test_backend_matches_numpy(name, bands):
+    reference = run_kernels(get_backend('numpy'), bands)
+    results = run_kernels(get_backend(name, fallback=False), bands)
+    for kernel, result in results.items():
+        np.testing.assert_allclose(result, reference[kernel], rtol=1e-5, atol=1e-6, equal_nan=True, err_msg=kernel)
+
+
+def test_numpy_ndvi_is_nan_where_the_sum_is_zero(bands):
+    ndvi = get_backend('numpy').ndvi(bands['red'], bands['nir'], np.empty(SHAPE, dtype='float32'))
+    assert np.isnan(ndvi[0, :5]).all()
+
+
+@pytest.mark.parametrize('name', available_backends())
+def test_ndvi_of_unsigned_bands_does_not_wrap_around(name):
+    red, nir = np.full((2, 2), 200, dtype='uint16'), np.full((2, 2), 100, dtype='uint16')
+    ndvi = get_backend(name, fallback=False).ndvi(red, nir, np.empty((2, 2), dtype='float32'))
+    np.testing.assert_allclose(ndvi, -1 / 3, rtol=1e-6)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend('fortran')
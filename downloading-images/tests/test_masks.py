@@ -0,0 +1,87 @@
+# Standard library imports
+
+# Third-party library imports
+import numpy as np
+import pytest
+
+# External library imports
+
+# Project-specific library imports
+from masks import ForestMasks, PackedMask, forest_change
+
+# Widths that are not a multiple of 8 leave padding bits in the last byte of every row
+SHAPES = [(5, 13), (3, 1), (4, 17), (2, 8), (7, 30)]
+
+
+def random_masks(shape, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random(shape) < 0.5 for _ in range(count)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_packing_round_trips(shape):
+    mask, = random_masks(shape, 1)
+    packed = PackedMask.from_array(mask)
+    assert packed.bits.shape == (shape[0], (shape[1] + 7) // 8)
+    np.testing.assert_array_equal(packed.to_array(), mask)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_counts_match_numpy(shape):
+    mask, = random_masks(shape, 1)
+    packed = PackedMask.from_array(mask)
+    assert packed.count() == np.count_nonzero(mask)
+    assert PackedMask.from_array(np.ones(shape, dtype=bool)).count() == shape[0] * shape[1]
+    assert PackedMask.zeros(shape).count() == 0
+    assert packed.area(900) == np.count_nonzero(mask) * 900 / 10000
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_the_complement_leaves_the_padding_bits_unset(shape):
+    mask, = random_masks(shape, 1)
+    inverted = ~PackedMask.from_array(mask)
+    np.testing.assert_array_equal(inverted.to_array(), ~mask)
+    assert inverted.count() == np.count_nonzero(~mask)
+    assert (~PackedMask.zeros(shape)).count() == shape[0] * shape[1]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_bitwise_operations_match_numpy(shape):
+    a, b = random_masks(shape, 2)
+    pa, pb = PackedMask.from_array(a), PackedMask.from_array(b)
+    for packed, expected in [(pa & pb, a & b), (pa | pb, a | b), (pa ^ pb, a ^ b), (pa.and_not(pb), a & ~b)]:
+        np.testing.assert_array_equal(packed.to_array(), expected)
+        assert packed.count() == np.count_nonzero(expected)
+
+
+def test_masks_of_other_shapes_are_rejected():
+    with pytest.raises(ValueError):
+        PackedMask.zeros((2, 9)) & PackedMask.zeros((2, 10))
+
+
+def test_nan_is_neither_forest_nor_valid():
+    forest_ndvi = np.array([[0.7, np.nan, 0.8], [np.nan, 0.9, np.nan]], dtype='float32')
+    ndvi = np.array([[0.7, 0.2, 0.8], [np.nan, 0.9, 0.1]], dtype='float32')
+    masks = ForestMasks.from_ndvi(forest_ndvi, ndvi)
+    np.testing.assert_array_equal(masks.forest.to_array(), [[True, False, True], [False, True, False]])
+    np.testing.assert_array_equal(masks.nodata.to_array(), np.isnan(ndvi))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_forest_change_matches_numpy(shape):
+    state_forest, state_valid, forest, valid = random_masks(shape, 4, seed=1)
+    state_forest &= state_valid
+    forest &= valid
+    state = ForestMasks(PackedMask.from_array(state_forest), PackedMask.from_array(state_valid))
+    current = ForestMasks(PackedMask.from_array(forest), PackedMask.from_array(valid))
+
+    loss, gain, updated = forest_change(state, current)
+
+    observed = state_valid & valid
+    expected_loss = state_forest & observed & ~forest
+    expected_gain = forest & observed & ~state_forest
+    np.testing.assert_array_equal(loss.to_array(), expected_loss)
+    np.testing.assert_array_equal(gain.to_array(), expected_gain)
+    assert (loss.count(), gain.count()) == (np.count_nonzero(expected_loss), np.count_nonzero(expected_gain))
+    np.testing.assert_array_equal(updated.forest.to_array(), np.where(valid, forest, state_forest))
+    np.testing.assert_array_equal(updated.valid.to_array(), state_valid | valid)
@@ -0,0 +1,85 @@
+# Standard library imports
+import os
+
+# Third-party library imports
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+# External library imports
+
+# Project-specific library imports
+from compositing import update_composite
+from NDVI import FOREST_COVER_THRESHOLD, NDVI_INT16_SCALE, decode_ndvi, encode_ndvi, write_ndvi
+from profiles import write_product
+
+NDVI_FOLDER = 'NDVI_folder'
+DATES = ('2020-01-01-LC08', '2020-02-01-LC08')
+
+
+def threshold_values():
+    """
+    Float32 NDVI values on both sides of the forest cover threshold, the closest ones included.
+    """
+    threshold = np.float32(FOREST_COVER_THRESHOLD)
+    values = np.linspace(FOREST_COVER_THRESHOLD - 0.01, FOREST_COVER_THRESHOLD + 0.01, 40001, dtype='float32')
+    closest = [np.nextafter(threshold, np.float32(0)), threshold, np.nextafter(threshold, np.float32(1))]
+    return np.concatenate((values, np.array(closest, dtype='float32')))
+
+
+def test_int16_keeps_the_forest_cover():
+    values = threshold_values()
+    decoded = decode_ndvi(encode_ndvi(values, 'int16'), None, 1 / NDVI_INT16_SCALE)
+    np.testing.assert_array_equal(decoded > FOREST_COVER_THRESHOLD, values > FOREST_COVER_THRESHOLD)
+    assert np.abs(decoded - values).max() <= 1.5 / NDVI_INT16_SCALE
+
+
+def test_int16_nodata():
+    encoded = encode_ndvi(np.array([np.nan, 0.5], dtype='float32'), 'int16')
+    assert np.isnan(decode_ndvi(encoded, encoded[0], 1 / NDVI_INT16_SCALE)[0])
+
+
+def write_dates(protected_area_dir, policy):
+    """
+    Writes the forest NDVI and multiband products of two dates, most of their values next to the forest cover
+    threshold.
+    """
+    rng = np.random.default_rng(1)
+    shape = (64, 80)
+    profile = {'driver': 'GTiff', 'crs': CRS.from_epsg(32618), 'transform': from_origin(500000, 9000000, 30, 30)}
+
+    protected_area_dates = []
+    for date_name in DATES:
+        values = rng.choice(threshold_values(), size=shape)
+        values[rng.random(shape) < 0.2] = np.nan
+        values[rng.random(shape) < 0.1] = 0.35
+
+        protected_area_date = os.path.join(protected_area_dir, date_name)
+        os.makedirs(os.path.join(protected_area_date, NDVI_FOLDER))
+        write_ndvi(os.path.join(protected_area_date, NDVI_FOLDER, 'forest_NDVI_mask_clipped.TIF'), values,
+                   profile, 'forest', policy)
+        multiband = rng.uniform(0, 0.3, size=(4,) + shape).astype('float32')
+        write_product(os.path.join(protected_area_date, date_name + '_B2_B3_B4_B5_multiband.TIF'), multiband,
+                      dict(profile, nodata=np.nan), 'composite')
+        protected_area_dates.append(protected_area_date)
+    return protected_area_dates
+
+
+def composite_areas(tmp_path, policy):
+    protected_area_dir = str(tmp_path / policy)
+    deforestation_dir = os.path.join(protected_area_dir, 'deforestation')
+    os.makedirs(deforestation_dir)
+    steps = update_composite(deforestation_dir, write_dates(protected_area_dir, policy), NDVI_FOLDER, '')
+    return [(step['area'], step['loss_area'], step['gain_area']) for step in steps]
+
+
+@pytest.mark.parametrize('cog_output', [True, False])
+def test_forest_areas_do_not_depend_on_the_storage(tmp_path, monkeypatch, cog_output):
+    monkeypatch.setattr('settings.COG_OUTPUT', cog_output)
+    float32_areas = composite_areas(tmp_path, 'float32')
+    int16_areas = composite_areas(tmp_path, 'int16')
+    assert float32_areas == int16_areas
+    with rasterio.open(os.path.join(tmp_path, 'int16', DATES[0], NDVI_FOLDER, 'forest_NDVI_mask_clipped.TIF')) as src:
+        assert src.dtypes[0] == 'int16'
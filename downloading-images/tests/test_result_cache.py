@@ -0,0 +1,109 @@
+# Standard library imports
+import json
+
+# Third-party library imports
+import pytest
+
+# External library imports
+
+# Project-specific library imports
+from jobs import JobQueue
+from result_cache import ResultCache
+
+AREA = {'idInteger': 7, 'name': 'area', 'geoJson': '[[[1, 1], [2, 1], [2, 2], [1, 1]]]'}
+
+
+def test_a_stored_result_is_served_with_the_etag_of_its_body():
+    cache = ResultCache(1024, 60)
+    entry = cache.put('k', {'b': 1, 'a': [1.5]})
+
+    assert cache.get('k') == entry
+    assert json.loads(entry.body) == {'b': 1, 'a': [1.5]}
+    assert cache.put('other', {'a': [1.5], 'b': 1}).etag == entry.etag
+    assert cache.put('k', {'a': [2.5], 'b': 1}).etag != entry.etag
+
+
+def test_results_expire(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr('result_cache.time.monotonic', lambda: clock[0])
+    cache = ResultCache(1024, 60)
+    cache.put('k', [1], 'g')
+
+    clock[0] += 61
+    assert cache.get('k') is None
+    assert cache.latest('g') is None
+    assert cache.size == 0
+
+
+def test_the_least_recently_used_results_are_evicted_over_the_size():
+    cache = ResultCache(100, 60)
+    cache.put('k1', 'a' * 40)
+    cache.put('k2', 'b' * 40)
+    cache.get('k1')
+    cache.put('k3', 'c' * 40)
+
+    assert cache.get('k2') is None
+    assert cache.get('k1') is not None and cache.get('k3') is not None
+    assert cache.size <= 100
+
+
+def test_a_new_result_of_a_group_replaces_the_previous_one():
+    cache = ResultCache(1024, 60)
+    cache.put('area:old', [1], 'area')
+    entry = cache.put('area:new', [2], 'area')
+
+    assert cache.get('area:old') is None
+    assert cache.latest('area') == entry
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    import main
+
+    class Workers:
+        def notify(self):
+            pass
+
+    monkeypatch.setenv('LANDSAT_DIR', str(tmp_path))
+    monkeypatch.setenv('DEFORESTATION_FOLDER', 'deforestation')
+    monkeypatch.setattr('settings.RESULT_CACHE', True)
+    monkeypatch.setattr(main, 'result_cache', ResultCache(1024 * 1024, 60))
+    monkeypatch.setattr(main, 'result_areas', {})
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(main, 'get_job_queue', lambda: queue)
+    monkeypatch.setattr(main, 'get_job_workers', Workers)
+    return main.app.test_client()
+
+
+def test_a_cached_result_is_served_without_a_job(client):
+    import main
+
+    assert client.get('/forest-cover/7').status_code == 404
+    assert client.post('/processing', json={'data': AREA}).status_code == 202
+    main.cache_result(AREA, {'id': 7, 'total_extension_forest_cover_list': [27.18]})
+
+    for response in (client.post('/processing', json={'data': AREA}), client.get('/forest-cover/7')):
+        assert response.status_code == 200
+        assert response.get_json() == {'id': 7, 'total_extension_forest_cover_list': [27.18]}
+
+    etag = response.headers['ETag']
+    assert client.post('/processing', json={'data': AREA}, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/forest-cover/7', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_a_new_scene_or_footprint_is_a_cache_miss(client, tmp_path):
+    import main
+
+    main.cache_result(AREA, {'id': 7})
+    assert client.get('/forest-cover/7').status_code == 200
+
+    (tmp_path / 'area' / '2023-02-18-LC08').mkdir(parents=True)
+    assert client.get('/forest-cover/7').status_code == 404
+    assert client.post('/processing', json={'data': AREA}).status_code == 202
+
+    main.cache_result(AREA, {'id': 7})
+    assert client.get('/forest-cover/7').status_code == 200
+
+    moved = dict(AREA, geoJson='[[[1, 1], [3, 1], [3, 3], [1, 1]]]')
+    assert client.post('/processing', json={'data': moved}).status_code == 202
+    assert client.get('/forest-cover/7').status_code == 404
@@ -0,0 +1,27 @@
+# Standard library imports
+
+# Third-party library imports
+import pytest
+
+# External library imports
+
+# Project-specific library imports
+from scene_cache import OUTPUT_SETTINGS, scene_key
+
+
+def test_the_pipeline_mode_changes_the_key():
+    assert scene_key('LC08_L1TP', 'geometry', '3', 'staged') != scene_key('LC08_L1TP', 'geometry', '3', 'fused')
+
+
+@pytest.mark.parametrize('name', OUTPUT_SETTINGS)
+def test_every_output_setting_changes_the_key(name, monkeypatch):
+    key = scene_key('LC08_L1TP', 'geometry', '3', 'staged')
+    monkeypatch.setattr(f'settings.{name}', 'changed')
+    assert scene_key('LC08_L1TP', 'geometry', '3', 'staged') != key
+
+
+def test_streaming_products_are_not_restored_in_the_whole_band_mode(monkeypatch):
+    monkeypatch.setattr('settings.NDVI_STREAMING', True)
+    streaming_key = scene_key('LC08_L1TP', 'geometry', '3', 'staged')
+    monkeypatch.setattr('settings.NDVI_STREAMING', False)
+    assert scene_key('LC08_L1TP', 'geometry', '3', 'staged') != streaming_key